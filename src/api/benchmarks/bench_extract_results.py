@@ -0,0 +1,135 @@
+"""
+Benchmarks doc_intel_utilities.extract_results on large synthetic AnalyzeResult dictionaries.
+
+The current implementation is compared with the previous character-by-character implementation
+(kept below as the baseline), and both are checked to produce the same page text.
+
+Run from src/api:
+
+    python -m benchmarks.bench_extract_results --pages 200 --tables-per-page 3 --rows 40 --columns 6
+"""
+import argparse
+import html
+import re
+import time
+
+from azure.ai.documentintelligence.models import AnalyzeResult
+
+from doc_intel_utilities import extract_results
+
+def make_analyze_result(pages, tables_per_page, rows, columns, text_per_page=4000):
+    """
+    Builds a synthetic prebuilt-layout result: every page has free text followed by dense tables,
+    with page and table spans pointing into a single document content string.
+    """
+    content = []
+    offset = 0
+    result_pages = []
+    result_tables = []
+    for page_number in range(1, pages + 1):
+        page_start = offset
+        text = (f"Page {page_number} drawing notes. " * (text_per_page // 24 + 1))[:text_per_page]
+        content.append(text)
+        offset += len(text)
+        for table_index in range(tables_per_page):
+            cells = []
+            table_start = offset
+            for row in range(rows):
+                for column in range(columns):
+                    cell_content = f"R{row}C{column}T{table_index}"
+                    content.append(cell_content + " ")
+                    cells.append({'kind': 'columnHeader' if row == 0 else 'content', 'rowIndex': row, 'columnIndex': column,
+                                  'rowSpan': 1, 'columnSpan': 1, 'content': cell_content,
+                                  'spans': [{'offset': offset, 'length': len(cell_content)}]})
+                    offset += len(cell_content) + 1
+            # Emit the cells in reverse order, as the service does not guarantee any ordering
+            result_tables.append({'rowCount': rows, 'columnCount': columns, 'cells': cells[::-1],
+                                  'boundingRegions': [{'pageNumber': page_number, 'polygon': []}],
+                                  'spans': [{'offset': table_start, 'length': offset - table_start}]})
+        result_pages.append({'pageNumber': page_number, 'angle': 0, 'width': 11, 'height': 8.5, 'unit': 'inch',
+                             'spans': [{'offset': page_start, 'length': offset - page_start}]})
+    return {'apiVersion': '2024-07-31-preview', 'modelId': 'prebuilt-layout', 'stringIndexType': 'textElements',
+            'content': ''.join(content), 'pages': result_pages, 'tables': result_tables}
+
+def legacy_table_to_html(table):
+    table_html = "<table>"
+    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    for row_cells in rows:
+        table_html += "<tr>"
+        for cell in row_cells:
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+        table_html +="</tr>"
+    table_html += "</table>"
+    return table_html
+
+def legacy_extract_results(afr_result, source_file_name):
+    afr_result = AnalyzeResult(afr_result)
+    match = re.search(r'__(\d+)-(\d+)\.pdf', source_file_name)
+    start_page = int(match.group(1)) if match else 1
+    page_map = []
+    for page_num, page in enumerate(afr_result.pages):
+        tables_on_page = [table for table in afr_result.tables if table.bounding_regions[0].page_number == page_num + 1]
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        table_chars = [-1] * page_length
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                for i in range(span.length):
+                    idx = span.offset - page_offset + i
+                    if 0 <= idx < page_length:
+                        table_chars[idx] = table_id
+        page_text = ""
+        added_tables = set()
+        for idx, table_id in enumerate(table_chars):
+            if table_id == -1:
+                page_text += afr_result.content[page_offset + idx]
+            elif table_id not in added_tables:
+                page_text += legacy_table_to_html(tables_on_page[table_id])
+                added_tables.add(table_id)
+        actual_page_num = page_num + start_page
+        page_text += " "
+        new_file_name = source_file_name.replace('.pdf', '') + '_' + str(actual_page_num) + '.pdf'
+        page_map.append((actual_page_num, page_text, new_file_name, source_file_name))
+    return page_map
+
+def time_call(func, *args, repeat=3):
+    # Best of several runs, to reduce noise from other processes
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--tables-per-page', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=40)
+    parser.add_argument('--columns', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-legacy', action='store_true', help='Only time the current implementation')
+    args = parser.parse_args()
+
+    analyze_result = make_analyze_result(args.pages, args.tables_per_page, args.rows, args.columns)
+    print(f"Synthetic result: {args.pages} pages, {args.pages * args.tables_per_page} tables, "
+          f"{args.pages * args.tables_per_page * args.rows * args.columns} cells, {len(analyze_result['content'])} characters")
+
+    current_seconds, current_map = time_call(extract_results, analyze_result, 'drawing.pdf', repeat=args.repeat)
+    print(f"extract_results:        {current_seconds:8.3f}s")
+
+    if not args.skip_legacy:
+        legacy_seconds, legacy_map = time_call(legacy_extract_results, analyze_result, 'drawing.pdf', repeat=args.repeat)
+        print(f"legacy extract_results: {legacy_seconds:8.3f}s")
+        print(f"speedup:                {legacy_seconds / current_seconds:8.1f}x")
+        if legacy_map != current_map:
+            raise SystemExit('Page maps differ between the current and legacy implementations')
+        print('Page maps match')
+
+if __name__ == '__main__':
+    main()
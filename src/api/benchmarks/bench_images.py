@@ -0,0 +1,62 @@
+"""
+Compares the image profiles of image_profiles.py on the pages of a PDF, reporting for every profile and page
+the encoded size, the payload bytes of its base64 data URL, the estimated prompt tokens and the render time.
+
+Crop profiles (e.g. 'title_block') crop to the tables of a canned layout result, as no Document Intelligence
+analysis is run.
+
+Run from src/api, on a synthetic drawing or on your own PDF:
+
+    python -m benchmarks.bench_images --pages 3
+    python -m benchmarks.bench_images --pdf drawing.pdf --profiles default line_art webp --dpi 150
+"""
+import argparse
+import base64
+import time
+
+import fitz as pymupdf
+
+from image_profiles import IMAGE_PROFILES, get_image_profile, region_boxes, render_page_image
+
+from benchmarks.fakes import make_layout_result, make_pdf
+
+def format_bytes(value):
+    return f"{value / 1024 / 1024:.2f} MB" if value >= 1024 * 1024 else f"{value / 1024:.1f} KB"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pdf', help='A PDF to render, instead of a synthetic drawing')
+    parser.add_argument('--pages', type=int, default=3, help='Page count of the synthetic drawing')
+    parser.add_argument('--profiles', nargs='+', default=list(IMAGE_PROFILES), help='Built-in profile names or JSON profile settings')
+    parser.add_argument('--dpi', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.pdf:
+        with open(args.pdf, 'rb') as f:
+            data = f.read()
+    else:
+        data = make_pdf(args.pages)
+
+    with pymupdf.open("pdf", data) as document:
+        page_count = document.page_count
+        print(f"{'profile':<14}{'page':>6}{'size':>12}{'encoded':>12}{'payload':>12}{'tokens':>8}{'ms':>8}")
+        for name in args.profiles:
+            profile = get_image_profile(name)
+            regions = region_boxes(make_layout_result(page_count), profile.crop) if profile.crop else {}
+            totals = {'encoded': 0, 'payload': 0, 'tokens': 0, 'ms': 0.0}
+            for page_index in range(page_count):
+                start = time.perf_counter()
+                image_bytes, info = render_page_image(document.load_page(page_index), args.dpi, profile, regions.get(page_index + 1))
+                milliseconds = (time.perf_counter() - start) * 1000
+                # The agents receive every image as a base64 data URL
+                payload = len(base64.b64encode(image_bytes))
+                totals['encoded'] += info['bytes']
+                totals['payload'] += payload
+                totals['tokens'] += info['tokens']
+                totals['ms'] += milliseconds
+                print(f"{name:<14}{page_index + 1:>6}{str(info['width']) + 'x' + str(info['height']):>12}{format_bytes(info['bytes']):>12}"
+                      f"{format_bytes(payload):>12}{info['tokens']:>8}{milliseconds:>8.1f}")
+            print(f"{name:<14}{'total':>6}{'':>12}{format_bytes(totals['encoded']):>12}{format_bytes(totals['payload']):>12}{totals['tokens']:>8}{totals['ms']:>8.1f}\n")
+
+if __name__ == '__main__':
+    main()
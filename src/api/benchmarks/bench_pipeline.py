@@ -0,0 +1,250 @@
+"""
+Runs the document analysis orchestration end to end against in-process fakes of Blob Storage, Cosmos DB,
+Document Intelligence and the agents (see benchmarks/fakes.py), and reports for synthetic PDFs of each size:
+
+    - per-stage throughput and peak process memory (RSS), from the telemetry spans emitted by the activities
+    - per-activity time, peak Python memory (tracemalloc) and input/output payload sizes
+
+No Azure resources are needed. Activities run one at a time, so that time and memory are attributed to a
+single activity; parallel branches of the orchestration (e.g. Document Intelligence and rasterization) are
+executed sequentially.
+
+Run from src/api:
+
+    python -m benchmarks.bench_pipeline --pages 1 10 100 500 --converge-after 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+# The pipeline modules read their configuration at call time, set defaults for anything they expect
+os.environ.setdefault('ANALYST_AGENT_ID', 'analyst')
+os.environ.setdefault('REVIEWER_AGENT_ID', 'reviewer')
+os.environ.setdefault('FORMATTER_AGENT_ID', 'formatter')
+os.environ.setdefault('COSMOS_CONTAINER', 'status')
+os.environ.setdefault('TELEMETRY_SINKS', 'benchmarks.fakes:get_span_collector')
+
+import doc_intel_utilities
+import function_app
+import schema_registry
+import utils
+from pdf_spool import clear_spools
+
+from benchmarks.fakes import get_span_collector, install_fakes, make_pdf
+
+# A drawing schema with scalar and list-valued fields, so that --max-field-groups has fields to split
+BENCHMARK_SCHEMA = {
+    'Drawing_Number': {'description': 'The drawing number', 'sample': 'D-1000'},
+    'Name': {'description': 'The title of the drawing', 'sample': 'Bracket'},
+    'Revision_History': {'description': 'Every revision of the drawing', 'sample': [{'revision': 'A', 'date': '2024-01-01'}]},
+    'Bill_of_Materials': {'description': 'Every part of the assembly', 'sample': [{'item': 1, 'part_number': 'P-1', 'quantity': 2}]},
+}
+
+# The format template of the fake analyst's extract, which the local formatter converts without an agent run
+BENCHMARK_FORMAT = {'fields': {'type': 'object', 'properties': {f'field_{i}': {'type': 'nvarchar', 'example': f'value {i}'} for i in range(20)}}}
+
+class _Task:
+    def __init__(self, kind, name, payload):
+        self.kind = kind
+        self.name = name
+        self.payload = payload
+        self.result = None
+
+class _TaskSet:
+    def __init__(self, kind, tasks):
+        self.kind = kind
+        self.tasks = tasks
+
+class BenchmarkContext:
+    """Minimal orchestration context executing every scheduled task immediately, without replays."""
+
+    def __init__(self, payload, instance_id):
+        self._payload = payload
+        self.instance_id = instance_id
+        self.custom_status = None
+
+    @property
+    def current_utc_datetime(self):
+        from datetime import datetime, timezone
+        return datetime.now(timezone.utc)
+
+    def get_input(self):
+        return self._payload
+
+    def call_activity(self, name, payload):
+        return _Task('activity', name, payload)
+
+    def call_activity_with_retry(self, name, retry_options, payload):
+        return _Task('activity', name, payload)
+
+    def call_sub_orchestrator(self, name, payload=None, instance_id=None):
+        return _Task('orchestrator', name, (payload, instance_id))
+
+    def task_all(self, tasks):
+        return _TaskSet('all', tasks)
+
+    def task_any(self, tasks):
+        return _TaskSet('any', tasks)
+
+    def set_custom_status(self, status):
+        self.custom_status = status
+
+class ActivityStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.peak_bytes = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+class PipelineRunner:
+    """Drives the orchestrator generators, running each activity on the current event loop and measuring it."""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.activities = {}
+
+    def _user_function(self, name):
+        function = getattr(function_app, name)._function._func
+        # Orchestrators are wrapped by the Durable Functions decorator, the generator function is in its closure
+        for cell in function.__closure__ or []:
+            if callable(cell.cell_contents) and cell.cell_contents.__name__ == name:
+                return cell.cell_contents
+        return function
+
+    async def run_activity(self, name, payload):
+        stats = self.activities.setdefault(name, ActivityStats())
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = await self._user_function(name)(payload)
+        stats.seconds += time.perf_counter() - start
+        if self.trace_memory:
+            stats.peak_bytes = max(stats.peak_bytes, tracemalloc.get_traced_memory()[1] - baseline)
+        stats.calls += 1
+        stats.input_bytes += len(payload)
+        stats.output_bytes += len(json.dumps(result, default=str))
+        return result
+
+    async def resolve(self, task):
+        if isinstance(task, _TaskSet):
+            results = []
+            for child in task.tasks:
+                try:
+                    child.result = await self.resolve(child)
+                except Exception as e:
+                    if task.kind == 'all':
+                        raise
+                    child.result = e
+                if task.kind == 'any':
+                    return child
+                results.append(child.result)
+            return results
+        if task.kind == 'orchestrator':
+            payload, instance_id = task.payload
+            return await self.run_orchestrator(task.name, payload, instance_id)
+        return await self.run_activity(task.name, task.payload)
+
+    async def run_orchestrator(self, name, payload, instance_id):
+        context = BenchmarkContext(payload, instance_id)
+        generator = self._user_function(name)(context)
+        try:
+            task = next(generator)
+            while True:
+                try:
+                    result = await self.resolve(task)
+                except Exception as e:
+                    task = generator.throw(e)
+                    continue
+                task = generator.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+def format_bytes(value):
+    return f"{value / 1024 / 1024:.2f} MB" if value >= 1024 * 1024 else f"{value / 1024:.1f} KB"
+
+async def run_benchmark(page_count, args):
+    fakes = install_fakes([function_app, utils, doc_intel_utilities, schema_registry],
+                          {os.environ['ANALYST_AGENT_ID']: 'analyze', os.environ['REVIEWER_AGENT_ID']: 'review', os.environ['FORMATTER_AGENT_ID']: 'format'},
+                          converge_after=args.converge_after)
+    fakes.blob_service_client.put('drawings', f'drawing_{page_count}.pdf', make_pdf(page_count))
+    get_span_collector().spans.clear()
+
+    runner = PipelineRunner(trace_memory=not args.no_trace_memory)
+    payload = {'container': 'drawings', 'filename': f'drawing_{page_count}.pdf', 'target_schema': BENCHMARK_SCHEMA,
+               'schema_types': BENCHMARK_FORMAT, 'max_iterations': args.max_iterations, 'cosmos_logging': args.cosmos_logging,
+               'message_mode': args.message_mode, 'max_field_groups': args.max_field_groups,
+               'page_routing_top_k': args.page_routing_top_k, 'image_profile': args.image_profile,
+               'local_formatter': args.local_formatter}
+
+    start = time.perf_counter()
+    await runner.run_orchestrator('agent_document_analysis_orchestrator', payload, f'bench-{page_count}')
+    total_seconds = time.perf_counter() - start
+    clear_spools()
+
+    # Time extract_results separately, on the result the pipeline stored for the document
+    doc_intel_result = json.loads(fakes.blob_service_client.blobs[('drawings-document-intelligence-results', f'drawing_{page_count}.json')][0])
+    extract_start = time.perf_counter()
+    doc_intel_utilities.extract_results(doc_intel_result, f'drawing_{page_count}.pdf')
+    extract_seconds = time.perf_counter() - extract_start
+
+    print(f"\n=== {page_count} page(s): {total_seconds:.2f}s end to end, peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB ===")
+
+    stages = {}
+    for span in get_span_collector().spans:
+        stage = stages.setdefault(span['stage'], {'count': 0, 'ms': 0.0, 'read': 0, 'written': 0, 'peak_rss': 0})
+        stage['count'] += 1
+        stage['peak_rss'] = max(stage['peak_rss'], span.get('peak_rss_bytes', 0))
+        stage['ms'] += span['duration_ms']
+        stage['read'] += span.get('bytes_read', 0)
+        stage['written'] += span.get('bytes_written', 0)
+    stages['extract_results'] = {'count': 1, 'ms': extract_seconds * 1000, 'read': 0, 'written': 0, 'peak_rss': 0}
+
+    print(f"{'stage':<18}{'count':>6}{'total ms':>12}{'pages/s':>12}{'read':>12}{'written':>12}{'peak RSS':>12}")
+    for name, stage in stages.items():
+        # Throughput only means something for stages that take measurable time
+        pages_per_second = f"{page_count * stage['count'] / (stage['ms'] / 1000):.1f}" if stage['ms'] >= 1 else '-'
+        print(f"{name:<18}{stage['count']:>6}{stage['ms']:>12.1f}{pages_per_second:>12}{format_bytes(stage['read']):>12}{format_bytes(stage['written']):>12}"
+              f"{format_bytes(stage['peak_rss']) if stage['peak_rss'] else '-':>12}")
+
+    print(f"\n{'activity':<40}{'calls':>6}{'seconds':>10}{'peak mem':>12}{'input':>12}{'output':>12}")
+    for name, stats in runner.activities.items():
+        peak = format_bytes(stats.peak_bytes) if not args.no_trace_memory else '-'
+        print(f"{name:<40}{stats.calls:>6}{stats.seconds:>10.3f}{peak:>12}{format_bytes(stats.input_bytes):>12}{format_bytes(stats.output_bytes):>12}")
+
+    return {'pages': page_count, 'seconds': total_seconds, 'stages': stages,
+            'activities': {name: vars(stats) for name, stats in runner.activities.items()},
+            'agent_runs': fakes.project_client.agents.runs}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 10, 100], help='Page counts of the synthetic PDFs')
+    parser.add_argument('--converge-after', type=int, default=2, help='Number of reviews before the reviewer accepts the extract')
+    parser.add_argument('--max-iterations', type=int, default=8)
+    parser.add_argument('--message-mode', choices=['delta', 'full'], default='delta')
+    parser.add_argument('--max-field-groups', type=int, default=1, help='Split the schema into up to this many field groups analyzed in parallel')
+    parser.add_argument('--page-routing-top-k', type=int, default=0, help='Send the agents only this many pages per schema field')
+    parser.add_argument('--image-profile', default='default', help='Image profile name or JSON settings, see image_profiles.py')
+    parser.add_argument('--local-formatter', choices=['auto', 'only', 'off'], default='auto')
+    parser.add_argument('--cosmos-logging', action='store_true')
+    parser.add_argument('--no-trace-memory', action='store_true', help='Skip tracemalloc, which slows down allocation-heavy stages')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    if not args.no_trace_memory:
+        tracemalloc.start()
+
+    results = [asyncio.run(run_benchmark(page_count, args)) for page_count in args.pages]
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,371 @@
+"""
+In-process fakes of the Azure services used by function_app.py, for running the orchestrators and activities
+offline in benchmarks:
+
+    - FakeBlobServiceClient: in-memory async Blob Storage with ETags, metadata and conditional uploads
+    - FakeCosmosDatabase: in-memory async Cosmos DB database and containers
+    - FakeDocIntelClient: returns a canned prebuilt-layout result for every page of the submitted PDF
+    - FakeProjectClient: deterministic agents; the reviewer marks the extract complete after a fixed number of reviews
+    - SpanCollector: telemetry sink collecting the spans emitted by the activities
+
+install_fakes() swaps the client getters of every pipeline module for these fakes.
+"""
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+import itertools
+import json
+
+import fitz as pymupdf
+
+from pdf_spool import PYMUPDF_LOCK
+
+_etags = itertools.count(1)
+
+class _Properties:
+    def __init__(self, name, data, metadata, etag):
+        self.name = name
+        self.size = len(data)
+        self.metadata = metadata
+        self.etag = etag
+
+class _Downloader:
+    def __init__(self, properties, data):
+        self.properties = properties
+        self._data = data
+
+    async def readall(self):
+        return self._data
+
+    async def _chunks(self, chunk_size):
+        for start in range(0, len(self._data), chunk_size):
+            yield self._data[start:start + chunk_size]
+
+    def chunks(self, chunk_size=4 * 1024 * 1024):
+        return self._chunks(chunk_size)
+
+class FakeBlobClient:
+    def __init__(self, store, container, name):
+        self._store = store
+        self.container_name = container
+        self.blob_name = name
+
+    def _key(self):
+        return (self.container_name, self.blob_name)
+
+    async def download_blob(self, etag=None, match_condition=None, **kwargs):
+        if self._key() not in self._store.blobs:
+            raise ResourceNotFoundError(f'Blob {self.blob_name} not found')
+        data, properties = self._store.blobs[self._key()]
+        if match_condition == MatchConditions.IfNotModified and properties.etag != etag:
+            raise ResourceModifiedError(f'Blob {self.blob_name} was modified')
+        return _Downloader(properties, data)
+
+    async def get_blob_properties(self):
+        if self._key() not in self._store.blobs:
+            raise ResourceNotFoundError(f'Blob {self.blob_name} not found')
+        return self._store.blobs[self._key()][1]
+
+    async def upload_blob(self, data, overwrite=False, metadata=None, etag=None, match_condition=None, **kwargs):
+        existing = self._store.blobs.get(self._key())
+        if existing is not None and not overwrite:
+            raise ResourceExistsError(f'Blob {self.blob_name} already exists')
+        if match_condition == MatchConditions.IfNotModified and (existing is None or existing[1].etag != etag):
+            raise ResourceModifiedError(f'Blob {self.blob_name} was modified')
+        data = data.encode() if isinstance(data, str) else bytes(data)
+        self._store.bytes_written += len(data)
+        self._store.blobs[self._key()] = (data, _Properties(self.blob_name, data, metadata or {}, f'"{next(_etags)}"'))
+
+class FakeContainerClient:
+    def __init__(self, store, container):
+        self._store = store
+        self.container_name = container
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self._store, self.container_name, blob)
+
+    async def exists(self):
+        return self.container_name in self._store.containers
+
+    async def create_container(self):
+        if self.container_name in self._store.containers:
+            raise ResourceExistsError(f'Container {self.container_name} already exists')
+        self._store.containers.add(self.container_name)
+
+    async def delete_blob(self, blob):
+        if self._store.blobs.pop((self.container_name, blob), None) is None:
+            raise ResourceNotFoundError(f'Blob {blob} not found')
+
+    async def _list_blobs(self, name_starts_with):
+        for (container, name), (data, properties) in sorted(self._store.blobs.items()):
+            if container == self.container_name and name.startswith(name_starts_with or ''):
+                yield properties
+
+    def list_blobs(self, name_starts_with=None, **kwargs):
+        return self._list_blobs(name_starts_with)
+
+class FakeBlobServiceClient:
+    """In-memory stand-in for azure.storage.blob.aio.BlobServiceClient."""
+
+    def __init__(self):
+        self.containers = set()
+        self.blobs = {}
+        self.bytes_written = 0
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self, container)
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self, container, blob)
+
+    async def create_container(self, name):
+        await self.get_container_client(name).create_container()
+
+    def put(self, container, name, data):
+        # Seed a blob synchronously, e.g. the source PDFs of a benchmark run
+        self.containers.add(container)
+        self.blobs[(container, name)] = (data, _Properties(name, data, {}, f'"{next(_etags)}"'))
+
+class FakeCosmosContainer:
+    def __init__(self):
+        self.items = {}
+
+    async def create_item(self, body):
+        if body['id'] in self.items:
+            raise ResourceExistsError(f"Item {body['id']} already exists")
+        self.items[body['id']] = dict(body)
+        return dict(body)
+
+    async def upsert_item(self, body):
+        self.items[body['id']] = dict(body)
+        return dict(body)
+
+    async def patch_item(self, item, partition_key, patch_operations):
+        record = self.items[item]
+        for operation in patch_operations:
+            # Follow JSON pointer paths such as /extracts/drawing.pdf
+            *parents, key = [part.replace('~1', '/').replace('~0', '~') for part in operation['path'].lstrip('/').split('/')]
+            target = record
+            for parent in parents:
+                target = target[parent]
+            if operation['op'] == 'incr':
+                target[key] = target.get(key, 0) + operation['value']
+            else:
+                target[key] = operation['value']
+        return dict(record)
+
+class FakeCosmosDatabase:
+    """In-memory stand-in for azure.cosmos.aio.DatabaseProxy."""
+
+    def __init__(self):
+        self.containers = {}
+
+    def get_container_client(self, container):
+        return self.containers.setdefault(container, FakeCosmosContainer())
+
+    async def create_container_if_not_exists(self, id, partition_key=None, **kwargs):
+        return self.get_container_client(id)
+
+def make_layout_result(page_count, text_per_page=2000, tables_per_page=1, rows=20, columns=6):
+    """
+    Builds a canned prebuilt-layout result with free text and tables on every page, shaped like the
+    dictionaries returned by the Document Intelligence SDK.
+    """
+    content = []
+    offset = 0
+    pages = []
+    tables = []
+    for page_number in range(1, page_count + 1):
+        page_start = offset
+        text = (f"Sheet {page_number} general notes and dimensions. " * (text_per_page // 48 + 1))[:text_per_page]
+        content.append(text)
+        offset += len(text)
+        for table_index in range(tables_per_page):
+            table_start = offset
+            cells = []
+            for row in range(rows):
+                for column in range(columns):
+                    cell_content = f"P{page_number}T{table_index}R{row}C{column}"
+                    content.append(cell_content + " ")
+                    cells.append({'kind': 'columnHeader' if row == 0 else 'content', 'rowIndex': row, 'columnIndex': column,
+                                  'rowSpan': 1, 'columnSpan': 1, 'content': cell_content,
+                                  'spans': [{'offset': offset, 'length': len(cell_content)}]})
+                    offset += len(cell_content) + 1
+            tables.append({'rowCount': rows, 'columnCount': columns, 'cells': cells,
+                           'boundingRegions': [{'pageNumber': page_number, 'polygon': [1, 1, 10, 1, 10, 7, 1, 7]}],
+                           'spans': [{'offset': table_start, 'length': offset - table_start}]})
+        pages.append({'pageNumber': page_number, 'angle': 0, 'width': 11, 'height': 8.5, 'unit': 'inch',
+                      'spans': [{'offset': page_start, 'length': offset - page_start}]})
+    # Headings of a typical drawing package: the title block on the first page, the revision history on the
+    # second and the bill of materials on the last, so that page routing has something to find
+    headings = [(1, 'title', 'Title Block Drawing Number Name'), (min(2, page_count), 'sectionHeading', 'Revision History'),
+                (page_count, 'sectionHeading', 'Bill of Materials Part Number Quantity')]
+    paragraphs = [{'role': role, 'content': text, 'boundingRegions': [{'pageNumber': page_number, 'polygon': [0, 0, 1, 0, 1, 1, 0, 1]}]}
+                  for page_number, role, text in headings if page_count > 0]
+    return {'apiVersion': '2024-07-31-preview', 'modelId': 'prebuilt-layout', 'stringIndexType': 'textElements',
+            'content': ''.join(content), 'pages': pages, 'tables': tables, 'paragraphs': paragraphs, 'sections': []}
+
+class _AnalyzeResult:
+    def __init__(self, result):
+        self._result = result
+
+    def as_dict(self):
+        return self._result
+
+class _Poller:
+    def __init__(self, result):
+        self._result = result
+
+    async def result(self):
+        return _AnalyzeResult(self._result)
+
+class FakeDocIntelClient:
+    """Stand-in for the async DocumentIntelligenceClient returning a canned layout result per submitted PDF."""
+
+    def __init__(self, **layout_options):
+        self.layout_options = layout_options
+        self.calls = 0
+
+    async def begin_analyze_document(self, model_id, analyze_request=None, **kwargs):
+        self.calls += 1
+        data = analyze_request.bytes_source if analyze_request is not None else kwargs['body'].bytes_source
+        with PYMUPDF_LOCK, pymupdf.open("pdf", data) as document:
+            page_count = document.page_count
+        return _Poller(make_layout_result(page_count, **self.layout_options))
+
+class _Object:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+class _Messages:
+    def __init__(self, text):
+        self._text = text
+
+    def get_last_text_message_by_role(self, role):
+        return _Object(text=_Object(value=self._text))
+
+class FakeAgents:
+    """
+    Deterministic agents: the analyst fills every schema field, the reviewer asks for another revision until it
+    has reviewed `converge_after` extracts, and the formatter returns the extract unchanged. Token usage is
+    estimated from the size of each message (4 characters per token, 765 tokens per image).
+    """
+
+    def __init__(self, agent_ids, converge_after=2):
+        self.agent_ids = agent_ids
+        self.converge_after = converge_after
+        self.threads = {}
+        self._thread_ids = itertools.count(1)
+        self.runs = 0
+
+    async def create_thread(self):
+        thread_id = f'thread_{next(self._thread_ids)}'
+        self.threads[thread_id] = {'messages': [], 'turns': 0, 'prompt_tokens': 0, 'last': ''}
+        return _Object(id=thread_id)
+
+    async def delete_thread(self, thread_id):
+        self.threads.pop(thread_id)
+
+    async def create_message(self, thread_id, role, content):
+        tokens = 0
+        for block in content:
+            if getattr(block, 'text', None) is not None:
+                tokens += len(block.text) // 4
+            else:
+                tokens += 765
+        thread = self.threads[thread_id]
+        thread['messages'].append(tokens)
+        # Every run reads the whole thread, so prompt tokens grow with the conversation
+        thread['prompt_tokens'] = sum(thread['messages']) + thread['turns'] * 200
+        return _Object(id=f'msg_{len(thread["messages"])}')
+
+    async def create_and_process_run(self, thread_id, agent_id, **kwargs):
+        self.runs += 1
+        thread = self.threads[thread_id]
+        thread['turns'] += 1
+        agent = self.agent_ids[agent_id]
+        if agent == 'analyze':
+            response = {'fields': {f'field_{i}': f'value {i} (revision {thread["turns"]})' for i in range(20)}}
+        elif agent == 'review':
+            complete = thread['turns'] >= self.converge_after
+            # Field-level feedback in the reviewer's {'errors': [{'field': ...}]} format
+            response = {'complete': complete, 'errors': [] if complete else [{'field': f'fields.field_{thread["turns"]}', 'error': 'Check the value'}]}
+        else:
+            response = {'formatted': True, 'fields': {f'field_{i}': f'value {i}' for i in range(20)}}
+        thread['last'] = json.dumps(response)
+        completion_tokens = len(thread['last']) // 4
+        usage = _Object(prompt_tokens=thread['prompt_tokens'], completion_tokens=completion_tokens, total_tokens=thread['prompt_tokens'] + completion_tokens)
+        return _Object(id=f'run_{self.runs}', status='completed', usage=usage, last_error=None)
+
+    async def list_messages(self, thread_id):
+        return _Messages(self.threads[thread_id]['last'])
+
+class FakeProjectClient:
+    """Stand-in for the async AIProjectClient."""
+
+    def __init__(self, agent_ids, converge_after=2):
+        self.agents = FakeAgents(agent_ids, converge_after)
+
+def make_pdf(page_count, lines_per_page=40):
+    """Builds a synthetic drawing-like PDF with text and line work on every page."""
+    document = pymupdf.open()
+    for page_number in range(1, page_count + 1):
+        page = document.new_page(width=792, height=612)
+        for line in range(lines_per_page):
+            page.insert_text((36, 36 + line * 13), f"Sheet {page_number} note {line}: dimensions and tolerances per spec", fontsize=9)
+        for x in range(400, 760, 30):
+            page.draw_line((x, 40), (x, 580))
+        for y in range(40, 580, 30):
+            page.draw_line((400, y), (760, y))
+    data = document.tobytes()
+    document.close()
+    return data
+
+class SpanCollector:
+    """Telemetry sink keeping every emitted span in memory, configured with TELEMETRY_SINKS=benchmarks.fakes:get_span_collector."""
+
+    def __init__(self):
+        self.spans = []
+
+    def emit(self, span):
+        self.spans.append(span.to_dict())
+
+_span_collector = SpanCollector()
+
+def get_span_collector():
+    return _span_collector
+
+class Fakes:
+    """The set of fakes installed by install_fakes()."""
+
+    def __init__(self, agent_ids, converge_after=2, **layout_options):
+        self.blob_service_client = FakeBlobServiceClient()
+        self.cosmos_database = FakeCosmosDatabase()
+        self.doc_intel_client = FakeDocIntelClient(**layout_options)
+        self.project_client = FakeProjectClient(agent_ids, converge_after)
+
+def install_fakes(modules, agent_ids, converge_after=2, **layout_options):
+    """
+    Replaces the client getters imported by the given modules (e.g. function_app, utils and
+    doc_intel_utilities, which all use `from clients import *`) with in-process fakes.
+
+    Args:
+    modules (list): The modules to patch.
+    agent_ids (dict): Maps the analyst, reviewer and formatter agent IDs to 'analyze', 'review' and 'format'.
+    converge_after (int): The number of reviews after which the reviewer accepts the extract.
+
+    Returns:
+    fakes (Fakes): The installed fakes, for seeding data and inspecting the results.
+    """
+    fakes = Fakes(agent_ids, converge_after, **layout_options)
+    getters = {
+        'get_async_blob_service_client': lambda: fakes.blob_service_client,
+        'get_async_cosmos_database': lambda: fakes.cosmos_database,
+        'get_async_cosmos_container': lambda name=None: fakes.cosmos_database.get_container_client(name or 'status'),
+        'get_async_doc_intel_client': lambda api_version=None: fakes.doc_intel_client,
+        'get_async_project_client': lambda: fakes.project_client,
+    }
+    for module in modules:
+        for name, getter in getters.items():
+            if hasattr(module, name):
+                setattr(module, name, getter)
+    return fakes
@@ -0,0 +1,105 @@
+from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AsyncDocumentIntelligenceClient
+from azure.ai.projects.aio import AIProjectClient as AsyncAIProjectClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport, RequestsTransport
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from openai import AzureOpenAI
+import aiohttp
+import asyncio
+import os
+import requests
+import threading
+
+# Process-wide registry of service clients. Each Functions worker process builds its clients once, on
+# first use, and every activity invocation afterwards reuses their connection pools and cached tokens.
+_clients = {}
+_lock = threading.RLock()
+
+def _get_or_create(key, factory):
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            # Check again now that the lock is held, another thread may have created the client
+            client = _clients.get(key)
+            if client is None:
+                client = factory()
+                _clients[key] = client
+    return client
+
+def _pooled_transport():
+    # Keep-alive HTTP session sized for concurrent activity invocations within the worker
+    pool_size = int(os.getenv('CLIENT_POOL_MAXSIZE', 32))
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return RequestsTransport(session=session, session_owner=False)
+
+def get_blob_service_client():
+    return _get_or_create('blob', lambda: BlobServiceClient.from_connection_string(os.environ['STORAGE_CONN_STR'], transport=_pooled_transport()))
+
+def get_doc_intel_client(api_version):
+    return _get_or_create(('doc_intel', api_version), lambda: DocumentIntelligenceClient(endpoint=os.environ['DOC_INTEL_ENDPOINT'],
+                                                                                        credential=AzureKeyCredential(os.environ['DOC_INTEL_KEY']),
+                                                                                        api_version=api_version,
+                                                                                        transport=_pooled_transport()))
+
+def get_openai_client():
+    return _get_or_create('openai', lambda: AzureOpenAI(
+        azure_endpoint = os.getenv("AOAI_ENDPOINT"),
+        api_key=os.getenv("AOAI_KEY"),
+        api_version="2024-05-01-preview"
+    ))
+
+# Async clients hold connections bound to the event loop they were created on, so they are registered
+# per event loop. The Functions worker runs every async activity on the same loop, so in practice each
+# client is still created once per worker process.
+
+def _get_or_create_async(key, factory):
+    return _get_or_create((key, asyncio.get_running_loop()), factory)
+
+def _pooled_async_transport():
+    # Keep-alive aiohttp session sized for concurrent activity invocations within the worker
+    pool_size = int(os.getenv('CLIENT_POOL_MAXSIZE', 32))
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size))
+    return AioHttpTransport(session=session, session_owner=False)
+
+def get_async_credential():
+    return _get_or_create_async('credential', AsyncDefaultAzureCredential)
+
+def get_async_blob_service_client():
+    return _get_or_create_async('blob', lambda: AsyncBlobServiceClient.from_connection_string(os.environ['STORAGE_CONN_STR'], transport=_pooled_async_transport()))
+
+def get_async_cosmos_database():
+    def create_database_client():
+        cosmos_client = _get_or_create_async('cosmos', lambda: AsyncCosmosClient(os.environ['COSMOS_ENDPOINT'], os.environ['COSMOS_KEY'], transport=_pooled_async_transport()))
+        return cosmos_client.get_database_client(os.environ['COSMOS_DATABASE'])
+
+    return _get_or_create_async('cosmos_database', create_database_client)
+
+def get_async_cosmos_container(container_name=None):
+    """
+    Returns an async container client for the status database, defaulting to the COSMOS_CONTAINER container.
+    """
+    container_name = container_name or os.environ['COSMOS_CONTAINER']
+    return _get_or_create_async(('cosmos', container_name), lambda: get_async_cosmos_database().get_container_client(container_name))
+
+def get_status_log_container_name():
+    # Per-response status log entries live in their own container, partitioned by orchestration ID
+    return os.getenv('COSMOS_LOG_CONTAINER', os.environ['COSMOS_CONTAINER'] + '-log')
+
+def get_async_project_client():
+    return _get_or_create_async('project', lambda: AsyncAIProjectClient.from_connection_string(
+        credential=get_async_credential(),
+        conn_str=os.environ['AZURE_AI_FOUNDRY_CONNECTION_STRING'],
+    ))
+
+def get_async_doc_intel_client(api_version):
+    return _get_or_create_async(('doc_intel', api_version), lambda: AsyncDocumentIntelligenceClient(endpoint=os.environ['DOC_INTEL_ENDPOINT'],
+                                                                                                   credential=AzureKeyCredential(os.environ['DOC_INTEL_KEY']),
+                                                                                                   api_version=api_version,
+                                                                                                   transport=_pooled_async_transport()))
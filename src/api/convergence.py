@@ -0,0 +1,122 @@
+import re
+
+# Reasons recorded for ending the analyze/review loop
+STOP_REVIEWER_COMPLETE = 'reviewer_complete'
+STOP_MAX_ITERATIONS = 'max_iterations'
+STOP_NO_CHANGE = 'no_change'
+STOP_BELOW_THRESHOLD = 'below_threshold'
+STOP_ALL_FIELDS_VERIFIED = 'all_fields_verified'
+
+def flatten_extract(extract, path=''):
+    """
+    Flattens an extract into a dictionary of leaf values keyed by path, e.g. {'revisions[0].date': '2024-01-01'}.
+    Extracts that are not JSON objects (e.g. an unparsed agent response) are a single leaf.
+    """
+    leaves = {}
+    if isinstance(extract, dict):
+        for key, value in extract.items():
+            leaves.update(flatten_extract(value, f"{path}.{key}" if path else str(key)))
+        if len(extract) == 0:
+            leaves[path] = {}
+    elif isinstance(extract, list):
+        for index, value in enumerate(extract):
+            leaves.update(flatten_extract(value, f"{path}[{index}]"))
+        if len(extract) == 0:
+            leaves[path] = []
+    else:
+        leaves[path] = extract
+    return leaves
+
+def top_level_field(path):
+    # 'revisions[0].date' and 'revisions.date' both belong to the 'revisions' schema field
+    return re.split(r'[.\[]', path, maxsplit=1)[0]
+
+def flatten_fields(extract):
+    # The top-level schema fields present in an extract
+    return {top_level_field(path) for path in flatten_extract(extract) if path}
+
+def diff_extracts(previous, current):
+    """
+    Compares two successive extracts leaf by leaf.
+
+    Args:
+    previous: The extract of the previous analyze turn.
+    current: The extract of the latest analyze turn.
+
+    Returns:
+    changed_fields (list): The top-level schema fields with at least one added, removed or changed value.
+    change_ratio (float): The share of leaf values that were added, removed or changed.
+    """
+    previous_leaves = flatten_extract(previous)
+    current_leaves = flatten_extract(current)
+    paths = set(previous_leaves) | set(current_leaves)
+    changed = [path for path in paths if previous_leaves.get(path, KeyError) != current_leaves.get(path, KeyError)]
+    change_ratio = len(changed) / len(paths) if paths else 0.0
+    return sorted({top_level_field(path) for path in changed}), change_ratio
+
+def fields_with_errors(feedback):
+    # Top-level fields the reviewer reported errors on, following the reviewer's {'errors': [{'field': ...}]} format
+    if not isinstance(feedback, dict):
+        return set()
+    return {top_level_field(str(error.get('field', ''))) for error in feedback.get('errors') or [] if isinstance(error, dict)}
+
+class ConvergenceTracker:
+    """
+    Tracks successive extracts and reviews of one document, deciding when further analyze/review turns are
+    unlikely to improve the extract.
+
+    A field is verified once a review reports no error on it, and stays verified until the analyst changes it.
+    Verified fields are passed to the reviewer as Reviewed Fields, which it does not comment on again.
+
+    Args:
+    threshold (float): Stop when the share of changed values between two extracts is at or below this
+    value; 0 only stops when an extract is unchanged. A negative value disables change-based stopping.
+    """
+
+    def __init__(self, threshold=0.0):
+        self.threshold = threshold
+        self.previous_extract = None
+        self.verified_fields = set()
+        self.history = []
+        self.stop_reason = None
+
+    def add_extract(self, extract):
+        """Records a new extract and returns the reason to stop before reviewing it, if any."""
+        if self.previous_extract is None:
+            self.previous_extract = extract
+            self.history.append({'changed_fields': sorted(flatten_fields(extract)), 'change_ratio': 1.0})
+            return None
+
+        changed_fields, change_ratio = diff_extracts(self.previous_extract, extract)
+        self.previous_extract = extract
+        self.verified_fields -= set(changed_fields)
+        self.history.append({'changed_fields': changed_fields, 'change_ratio': round(change_ratio, 4)})
+
+        if self.threshold >= 0 and len(changed_fields) == 0:
+            self.stop_reason = STOP_NO_CHANGE
+        elif self.threshold > 0 and change_ratio <= self.threshold:
+            self.stop_reason = STOP_BELOW_THRESHOLD
+        return self.stop_reason
+
+    def add_review(self, feedback):
+        """Records a review of the latest extract and returns the reason to stop, if any."""
+        if isinstance(feedback, dict) and feedback.get('complete'):
+            self.stop_reason = STOP_REVIEWER_COMPLETE
+            return self.stop_reason
+
+        # Only a review with field-level feedback verifies fields; free text, an unparsed reply or feedback
+        # without an errors list says nothing about which fields were checked
+        if not (isinstance(feedback, dict) and isinstance(feedback.get('errors'), list)):
+            return self.stop_reason
+
+        all_fields = flatten_fields(self.previous_extract)
+        errors = fields_with_errors(feedback)
+        # Errors on fields verified by an earlier review are ignored, as the reviewer instructions require
+        new_errors = errors - self.verified_fields
+        self.verified_fields |= all_fields - errors
+        if len(new_errors) == 0 and len(all_fields) > 0 and all_fields <= self.verified_fields:
+            self.stop_reason = STOP_ALL_FIELDS_VERIFIED
+        return self.stop_reason
+
+    def summary(self):
+        return {'stop_reason': self.stop_reason, 'verified_fields': sorted(self.verified_fields), 'extract_changes': self.history}
@@ -0,0 +1,165 @@
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import logging
+import os
+
+# Cached Document Intelligence results live in the results container under this prefix, next to the
+# per-file results, along with a small index blob used for eviction
+CACHE_PREFIX = '_cache/'
+INDEX_BLOB_NAME = CACHE_PREFIX + 'index.json'
+
+# Cache hits record when an entry was last used at most this often, so that a busy cache does not rewrite the
+# index on every hit
+LAST_USED_RESOLUTION = timedelta(hours=1)
+
+def compute_cache_key(pdf_bytes, doc_intel_model, api_version):
+    """
+    Builds the content-addressed cache key for a Document Intelligence result.
+
+    Args:
+    pdf_bytes (bytes): The raw bytes of the PDF file.
+    doc_intel_model (str): The Document Intelligence model used for the analysis.
+    api_version (str): The Document Intelligence API version used for the analysis.
+
+    Returns:
+    cache_key (str): A key of the form '<sha256>:<model>:<api_version>'.
+    """
+    return digest_cache_key(hashlib.sha256(pdf_bytes).hexdigest(), doc_intel_model, api_version)
+
+def digest_cache_key(digest, doc_intel_model, api_version):
+    # The same key from the SHA-256 digest of a PDF, e.g. computed while it was spooled (see pdf_spool)
+    return f"{digest}:{doc_intel_model}:{api_version}"
+
+def cache_blob_name(cache_key):
+    digest, doc_intel_model, api_version = cache_key.split(':')
+    return f"{CACHE_PREFIX}{digest}/{doc_intel_model}/{api_version}.json"
+
+def _utc_now():
+    return datetime.now(timezone.utc)
+
+def _cache_limits():
+    # The age and size limits of the cache, the index is only kept when one of them is set
+    return float(os.getenv('DOC_INTEL_CACHE_MAX_AGE_DAYS', 0)), float(os.getenv('DOC_INTEL_CACHE_MAX_MB', 0)) * 1024 * 1024
+
+async def _load_index(container_client):
+    # Return the index together with its ETag so that updates can be made conditionally
+    try:
+        downloader = await container_client.get_blob_client(INDEX_BLOB_NAME).download_blob()
+        return json.loads(await downloader.readall()), downloader.properties.etag
+    except ResourceNotFoundError:
+        return {'entries': {}}, None
+
+async def _update_index(container_client, update, max_attempts=10):
+    """
+    Applies an update function to the cache index using optimistic concurrency, so that concurrent
+    activities writing to the same results container do not lose each other's entries.
+    """
+    index_blob_client = container_client.get_blob_client(INDEX_BLOB_NAME)
+    for _ in range(max_attempts):
+        index, etag = await _load_index(container_client)
+        result = update(index)
+        try:
+            if etag is None:
+                await index_blob_client.upload_blob(json.dumps(index), overwrite=False)
+            else:
+                await index_blob_client.upload_blob(json.dumps(index), overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified)
+            return result
+        except (ResourceExistsError, ResourceModifiedError):
+            # Another writer updated the index first, reload and try again
+            continue
+    logging.warning('Unable to update Document Intelligence cache index after %s attempts', max_attempts)
+    return None
+
+async def get_cached_result(container_client, cache_key):
+    """
+    Retrieves a cached Document Intelligence result.
+
+    Args:
+    container_client (ContainerClient): The async client for the Document Intelligence results container.
+    cache_key (str): The key returned by compute_cache_key.
+
+    Returns:
+    result (str): The serialized Document Intelligence result, or None on a cache miss.
+    """
+    try:
+        result = await (await container_client.get_blob_client(cache_blob_name(cache_key)).download_blob()).readall()
+    except ResourceNotFoundError:
+        return None
+
+    max_age_days, max_bytes = _cache_limits()
+    if max_age_days <= 0 and max_bytes <= 0:
+        # Nothing is evicted, so there is no need to track when entries were used
+        return result
+
+    # Only rewrite the index when the recorded last use is older than LAST_USED_RESOLUTION
+    index, _ = await _load_index(container_client)
+    entry = index['entries'].get(cache_key)
+    stale = (_utc_now() - LAST_USED_RESOLUTION).isoformat()
+    if entry is not None and entry['last_used'] < stale:
+        def touch(index):
+            if cache_key in index['entries']:
+                index['entries'][cache_key]['last_used'] = _utc_now().isoformat()
+
+        await _update_index(container_client, touch)
+    return result
+
+async def put_cached_result(container_client, cache_key, serialized_result, source_file):
+    """
+    Stores a Document Intelligence result in the cache and evicts entries exceeding the configured
+    age (DOC_INTEL_CACHE_MAX_AGE_DAYS) or total size (DOC_INTEL_CACHE_MAX_MB) limits. Without limits no
+    index is kept, results stored while both limits are 0 are never evicted.
+
+    Args:
+    container_client (ContainerClient): The async client for the Document Intelligence results container.
+    cache_key (str): The key returned by compute_cache_key.
+    serialized_result (str): The serialized Document Intelligence result.
+    source_file (str): The name of the PDF file the result was produced from.
+    """
+    blob_name = cache_blob_name(cache_key)
+    await container_client.get_blob_client(blob_name).upload_blob(serialized_result, overwrite=True)
+
+    max_age_days, max_bytes = _cache_limits()
+    if max_age_days <= 0 and max_bytes <= 0:
+        return
+
+    def add_entry(index):
+        now = _utc_now().isoformat()
+        index['entries'][cache_key] = {'blob': blob_name, 'size': len(serialized_result), 'created': now, 'last_used': now, 'source': source_file}
+        return select_evictions(index, max_age_days, max_bytes, protected=cache_key)
+
+    evicted = await _update_index(container_client, add_entry) or []
+    for entry in evicted:
+        try:
+            await container_client.delete_blob(entry['blob'])
+        except ResourceNotFoundError:
+            pass
+
+def select_evictions(index, max_age_days=0, max_bytes=0, protected=None):
+    """
+    Removes and returns the index entries that should be evicted.
+
+    Entries unused for longer than max_age_days are evicted first, then the least recently used
+    entries until the total cached size fits within max_bytes. A limit of 0 disables that rule.
+    """
+    entries = index['entries']
+    evicted = []
+
+    if max_age_days > 0:
+        cutoff = (_utc_now() - timedelta(days=max_age_days)).isoformat()
+        for key in [k for k, v in entries.items() if v['last_used'] < cutoff and k != protected]:
+            evicted.append(entries.pop(key))
+
+    if max_bytes > 0:
+        total_size = sum(v['size'] for v in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+            if total_size <= max_bytes:
+                break
+            if key == protected:
+                continue
+            total_size -= entries[key]['size']
+            evicted.append(entries.pop(key))
+
+    return evicted
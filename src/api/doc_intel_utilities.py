@@ -1,47 +1,68 @@
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, ContentFormat, AnalyzeResult, DocumentAnalysisFeature
 from azure.core.credentials import AzureKeyCredential
+import asyncio
+import fitz as pymupdf
 import os
+import re
 import time
 import logging
+from clients import get_doc_intel_client, get_async_doc_intel_client
+from retry_policy import get_retry_policy
+from pdf_spool import PYMUPDF_LOCK, open_pdf
+
+# Document Intelligence API version used for layout analysis (also part of the result cache key)
+DOC_INTEL_API_VERSION = os.getenv('DOC_INTEL_API_VERSION', '2024-07-31-preview')
+DEFAULT_DOC_INTEL_MODEL = 'prebuilt-layout'
+
+# Separator Document Intelligence writes between pages in markdown content, used when stitching chunk results
+PAGE_BREAK = '\n<!-- PageBreak -->\n'
 
 def table_to_html(table):
     """
     Converts a table object to an HTML table.
 
     Args:
-    table (Table): The table object to be converted.
+    table (DocumentTable or dict): The table object to be converted. Fields are read by their REST (camelCase)
+        names, so both SDK models and their serialized dictionaries are accepted.
 
     Returns:
     table_html (str): The HTML representation of the table.
     """
     import html
     
+    # Bucket the cells by row in a single pass, then order each row by column_index
+    rows = [[] for _ in range(table['rowCount'])]
+    for cell in table['cells']:
+        rows[cell['rowIndex']].append(cell)
+
     # Start the HTML table element
-    table_html = "<table>"
-    # Create rows based on the row_count and order cells by column_index
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    table_html = ["<table>"]
     # Generate HTML for each row and cell
     for row_cells in rows:
-        table_html += "<tr>"
+        row_cells.sort(key=lambda cell: cell['columnIndex'])
+        table_html.append("<tr>")
         for cell in row_cells:
             # Use "th" for header cells and "td" for data cells
-            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            kind = cell.get('kind')
+            tag = "th" if (kind == "columnHeader" or kind == "rowHeader") else "td"
             cell_spans = ""
-            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
-            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            column_span = cell.get('columnSpan') or 1
+            row_span = cell.get('rowSpan') or 1
+            if column_span > 1: cell_spans += f" colSpan={column_span}"
+            if row_span > 1: cell_spans += f" rowSpan={row_span}"
             # Escape the cell content to prevent HTML injection
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
+            table_html.append(f"<{tag}{cell_spans}>{html.escape(cell['content'])}</{tag}>")
+        table_html.append("</tr>")
+    table_html.append("</table>")
+    return "".join(table_html)
 
 def extract_results(afr_result, source_file_name):
     """
     Extracts text and tables from Azure Form Recognizer analysis results and maps them to page numbers.
 
     Args:
-    afr_result (AnalyzeResult): The result from Azure Form Recognizer analysis.
+    afr_result (AnalyzeResult or dict): The result from Azure Form Recognizer analysis.
     source_file_name (str): The name of the source PDF file.
 
     Returns:
@@ -49,7 +70,8 @@ def extract_results(afr_result, source_file_name):
     """
     import re
 
-    afr_result = AnalyzeResult.from_dict(afr_result)
+    # Read the result through its REST field names rather than SDK model attributes, which deserialize on every access
+    content = afr_result['content']
     
     # Define the regex pattern to extract page ranges from file names
     pattern = r'__(\d+)-(\d+)\.pdf'
@@ -61,93 +83,209 @@ def extract_results(afr_result, source_file_name):
     # If a range is found, use the starting page from the range
     if match:
         start_page = int(match.group(1))
+
+    # Index the tables by the page they start on, once for the whole document
+    tables_by_page = {}
+    for table in afr_result.get('tables') or []:
+        tables_by_page.setdefault(table['boundingRegions'][0]['pageNumber'], []).append(table)
         
     page_map = []
     
     # Process each page in the analysis result
-    for page_num, page in enumerate(afr_result.pages):
+    for page_num, page in enumerate(afr_result['pages']):
         # Identify tables present on the current page
-        tables_on_page = [table for table in afr_result.tables if table.bounding_regions[0].page_number == page_num + 1]
+        tables_on_page = tables_by_page.get(page_num + 1, [])
 
-        # Prepare to mark table characters in the page text
-        page_offset = page.spans[0].offset
-        page_length = page.spans[0].length
-        table_chars = [-1] * page_length
+        # Collect the character ranges covered by tables, relative to the start of the page
+        page_offset = page['spans'][0]['offset']
+        page_length = page['spans'][0]['length']
+        table_ranges = []
         for table_id, table in enumerate(tables_on_page):
-            for span in table.spans:
-                for i in range(span.length):
-                    idx = span.offset - page_offset + i
-                    if 0 <= idx < page_length:
-                        table_chars[idx] = table_id
-
-        # Build the page text and insert HTML tables where appropriate
-        page_text = ""
+            for span in table['spans']:
+                start = max(span['offset'] - page_offset, 0)
+                end = min(span['offset'] - page_offset + span['length'], page_length)
+                if start < end:
+                    table_ranges.append((start, end, table_id))
+        table_ranges.sort()
+
+        # Build the page text from slices of the content, inserting each HTML table where it first appears
+        page_text = []
         added_tables = set()
-        for idx, table_id in enumerate(table_chars):
-            if table_id == -1:
-                page_text += afr_result.content[page_offset + idx]
-            elif table_id not in added_tables:
-                page_text += table_to_html(tables_on_page[table_id])
+        position = 0
+        for start, end, table_id in table_ranges:
+            if end <= position:
+                continue
+            if start > position:
+                page_text.append(content[page_offset + position:page_offset + start])
+            if table_id not in added_tables:
+                page_text.append(table_to_html(tables_on_page[table_id]))
                 added_tables.add(table_id)
+            position = end
+        page_text.append(content[page_offset + position:page_offset + page_length])
         
         # Calculate the actual page number in the document
         actual_page_num = page_num + start_page
-        page_text += " "
+        page_text.append(" ")
         # Create a file name for the extracted page
         new_file_name = source_file_name.replace('.pdf', '') + '_' + str(actual_page_num) + '.pdf'
         # Add the page details to the page map
-        page_map.append((actual_page_num, page_text, new_file_name, source_file_name))
+        page_map.append((actual_page_num, "".join(page_text), new_file_name, source_file_name))
     return page_map
 
 # Analyze a document using Azure Document Intelligence's "prebuilt-document" model
-def analyze_pdf(data, document_model):
-
-    document_analysis_client = DocumentIntelligenceClient(endpoint=os.environ['DOC_INTEL_ENDPOINT'], credential=AzureKeyCredential(os.environ['DOC_INTEL_KEY']))
-    json_result = {}
-
-    processed = False
-    while not processed:
-        try:
-            # Begin analysis of the document  
-            poller = document_analysis_client.begin_analyze_document("prebuilt-layout", AnalyzeDocumentRequest(bytes_source=data), 
-                                                                     output_content_format=ContentFormat.MARKDOWN,
-                                                                     )  
-            processed = True
-            
-            # Get the result of the analysis  
-            result = poller.result()  
-            
-            # Convert the result to a dictionary  
-            json_result = result.as_dict()  
-        except Exception as e:
-            time.sleep(5)
-            print(e)
-            logging.info(e)
-
-    return json_result
+def analyze_pdf(data, document_model, retry_stats=None):
+
+    document_analysis_client = get_doc_intel_client(DOC_INTEL_API_VERSION)
+
+    def analyze():
+        # Begin analysis of the document  
+        poller = document_analysis_client.begin_analyze_document(document_model or DEFAULT_DOC_INTEL_MODEL, AnalyzeDocumentRequest(bytes_source=data), 
+                                                                 output_content_format=ContentFormat.MARKDOWN,
+                                                                 )  
+        
+        # Get the result of the analysis and convert it to a dictionary  
+        return poller.result().as_dict()  
+
+    # Retry transient failures with backoff, within the per-process Document Intelligence concurrency limit
+    return get_retry_policy('doc_intel').call(analyze, retry_stats=retry_stats)
+
+# Analyze a document with the async Document Intelligence client, so that polling for the result does not block a worker thread
+async def analyze_pdf_async(data, document_model, retry_stats=None):
+
+    document_analysis_client = get_async_doc_intel_client(DOC_INTEL_API_VERSION)
+
+    async def analyze():
+        # Begin analysis of the document  
+        poller = await document_analysis_client.begin_analyze_document(document_model or DEFAULT_DOC_INTEL_MODEL, AnalyzeDocumentRequest(bytes_source=data), 
+                                                                       output_content_format=ContentFormat.MARKDOWN,
+                                                                       )  
+        
+        # Get the result of the analysis and convert it to a dictionary  
+        return (await poller.result()).as_dict()  
+
+    return await get_retry_policy('doc_intel').call_async(analyze, retry_stats=retry_stats)
+
+def pdf_chunk_ranges(source, chunk_pages):
+    """
+    Splits the pages of a PDF into page ranges of at most chunk_pages pages.
+
+    Args:
+    source (bytes or str): The raw bytes of the PDF file, or the path of a local copy (see pdf_spool).
+    chunk_pages (int): The maximum number of pages per chunk, 0 for a single chunk.
+
+    Returns:
+    ranges (list of tuples): The first and last page number (starting at 1) of every chunk.
+    """
+    with PYMUPDF_LOCK, open_pdf(source) as document:
+        page_count = document.page_count
+    if chunk_pages <= 0 or page_count <= chunk_pages:
+        return [(1, page_count)]
+    return [(start + 1, min(start + chunk_pages, page_count)) for start in range(0, page_count, chunk_pages)]
+
+def extract_pdf_pages(source, first_page, last_page):
+    # Copy a page range of a PDF into a PDF of its own
+    with PYMUPDF_LOCK, open_pdf(source) as document, pymupdf.open() as chunk:
+        chunk.insert_pdf(document, from_page=first_page - 1, to_page=last_page - 1)
+        return chunk.tobytes(garbage=1, deflate=True)
+
+def read_pdf_bytes(source):
+    if isinstance(source, (bytes, bytearray)):
+        return source
+    with open(source, 'rb') as f:
+        return f.read()
+
+def _shift_positions(item, char_offset, page_offset, index_offsets):
+    # Move every span, page number and element reference (e.g. '/paragraphs/3') of a chunk result to its place
+    # in the stitched document
+    if isinstance(item, list):
+        for value in item:
+            _shift_positions(value, char_offset, page_offset, index_offsets)
+    elif isinstance(item, dict):
+        for key, value in item.items():
+            if key == 'spans' and isinstance(value, list):
+                for span in value:
+                    span['offset'] += char_offset
+            elif key == 'span' and isinstance(value, dict):
+                value['offset'] += char_offset
+            elif key == 'pageNumber' and isinstance(value, int):
+                item[key] = value + page_offset
+            elif key == 'elements' and isinstance(value, list):
+                item[key] = [re.sub(r'^/(\w+)/(\d+)', lambda m: f"/{m.group(1)}/{int(m.group(2)) + index_offsets.get(m.group(1), 0)}", element)
+                             for element in value]
+            else:
+                _shift_positions(value, char_offset, page_offset, index_offsets)
+
+def stitch_results(chunk_results):
+    """
+    Stitches the results of page-range chunks into a single result, as if the whole document had been
+    analyzed at once: the contents are joined with page breaks, and the spans, page numbers and element
+    references of every chunk are offset by the chunks before it.
+
+    Args:
+    chunk_results (list of tuples): The first page number and the result dictionary of every chunk, in page order.
+
+    Returns:
+    result (dict): The stitched result.
+    """
+    if len(chunk_results) == 1:
+        return chunk_results[0][1]
+
+    result = {key: value for key, value in chunk_results[0][1].items() if not isinstance(value, list)}
+    contents = []
+    char_offset = 0
+    index_offsets = {}
+    for start_page, chunk_result in chunk_results:
+        if len(contents) > 0:
+            contents.append(PAGE_BREAK)
+            char_offset += len(PAGE_BREAK)
+        _shift_positions({key: value for key, value in chunk_result.items() if key != 'content'}, char_offset, start_page - 1, index_offsets)
+        for key, value in chunk_result.items():
+            if isinstance(value, list):
+                result.setdefault(key, []).extend(value)
+                index_offsets[key] = index_offsets.get(key, 0) + len(value)
+        contents.append(chunk_result['content'])
+        char_offset += len(chunk_result['content'])
+    result['content'] = ''.join(contents)
+    return result
+
+async def analyze_pdf_chunked_async(source, document_model, chunk_pages=50, max_concurrency=4, retry_stats=None):
+    """
+    Analyzes a PDF in page-range chunks of at most chunk_pages pages, running up to max_concurrency chunk
+    analyses at once (within the process-wide DOC_INTEL_MAX_CONCURRENCY limit), and stitches the chunk
+    results into one result with document page numbers. PDFs that fit in one chunk are analyzed whole.
+
+    The PDF is given as its bytes or as the path of a local copy. Chunks are cut from the PDF only when their
+    analysis starts, so at most max_concurrency chunks are held in memory at once.
+
+    Returns:
+    result (dict): The stitched result.
+    chunk_count (int): The number of chunks analyzed.
+    """
+    ranges = await asyncio.to_thread(pdf_chunk_ranges, source, chunk_pages)
+    if len(ranges) == 1:
+        data = await asyncio.to_thread(read_pdf_bytes, source)
+        return await analyze_pdf_async(data, document_model, retry_stats=retry_stats), 1
+
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def analyze_chunk(first_page, last_page):
+        async with semaphore:
+            chunk_data = await asyncio.to_thread(extract_pdf_pages, source, first_page, last_page)
+            return first_page, await analyze_pdf_async(chunk_data, document_model, retry_stats=retry_stats)
+
+    chunk_results = await asyncio.gather(*[analyze_chunk(first_page, last_page) for first_page, last_page in ranges])
+    return stitch_results(chunk_results), len(ranges)
 
 # Read a document using Azure Document Intelligence's "prebuilt-read" model
-def read_document(data):
-
-    document_analysis_client = DocumentIntelligenceClient(endpoint=os.environ['DOC_INTEL_ENDPOINT'], credential=AzureKeyCredential(os.environ['DOC_INTEL_KEY']), api_version='2024-11-30')
-    json_result = {}
-
-    processed = False
-    while not processed:
-        try:
-            # Begin analysis of the document  
-            start = time.time()
-            poller = document_analysis_client.begin_analyze_document(model_id="prebuilt-layout", document=data)  
-            processed = True
-            stop = time.time()
-            
-            # Get the result of the analysis  
-            result = poller.result()  
-
-            # Convert the result to a dictionary  
-            json_result = result.to_dict()  
-        except Exception as e:
-            time.sleep(5)
-            print(e)
-
-    return json_result
\ No newline at end of file
+def read_document(data, retry_stats=None):
+
+    document_analysis_client = get_doc_intel_client('2024-11-30')
+
+    def read():
+        # Begin analysis of the document  
+        poller = document_analysis_client.begin_analyze_document(model_id="prebuilt-layout", document=data)  
+        
+        # Get the result of the analysis and convert it to a dictionary  
+        return poller.result().to_dict()  
+
+    return get_retry_policy('doc_intel').call(read, retry_stats=retry_stats)
@@ -0,0 +1,218 @@
+import json
+import re
+from datetime import datetime, timezone
+
+# Type names of format.json templates, grouped by the Python type they are coerced to
+STRING_TYPES = {'nvarchar', 'varchar', 'nchar', 'char', 'text', 'ntext', 'string', 'str'}
+INTEGER_TYPES = {'integer', 'int', 'bigint', 'smallint', 'tinyint', 'long'}
+DECIMAL_TYPES = {'decimal', 'numeric', 'float', 'real', 'double', 'money', 'number'}
+BOOLEAN_TYPES = {'boolean', 'bool', 'bit'}
+DATETIME_TYPES = {'datetime', 'datetime2', 'datetimeoffset', 'date', 'timestamp'}
+ARRAY_TYPES = {'array of objects', 'array', 'list'}
+OBJECT_TYPES = {'object'}
+
+# Date formats accepted besides ISO 8601. Formats with the day and month both as numbers are ambiguous
+# (03/04/2025), so they are only accepted when the reading is unambiguous.
+DATE_FORMATS = ['%Y/%m/%d', '%d-%b-%Y', '%d %b %Y', '%d-%B-%Y', '%d %B %Y', '%b %d, %Y', '%B %d, %Y', '%b %d %Y', '%B %d %Y', '%Y%m%d']
+AMBIGUOUS_DATE_FORMATS = [('%m/%d/%Y', '%d/%m/%Y'), ('%m/%d/%y', '%d/%m/%y'), ('%m-%d-%Y', '%d-%m-%Y'), ('%m.%d.%Y', '%d.%m.%Y')]
+
+NUMBER_PATTERN = re.compile(r'^[+-]?(\d{1,3}(,\d{3})+|\d+)(\.\d+)?$')
+
+class Uncertain(Exception):
+    """Raised by a converter when a value cannot be coerced to its type with confidence."""
+
+def _is_null(value):
+    return value is None or (isinstance(value, str) and value.strip().lower() in ('', 'null', 'none'))
+
+def _to_string(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return str(value)
+    raise Uncertain()
+
+def _to_number(value):
+    if isinstance(value, bool):
+        raise Uncertain()
+    if isinstance(value, (int, float)):
+        return value
+    text = str(value).strip()
+    if not NUMBER_PATTERN.match(text):
+        raise Uncertain()
+    return float(text.replace(',', ''))
+
+def _to_integer(value):
+    if _is_null(value):
+        return None
+    number = _to_number(value)
+    if isinstance(number, float):
+        if not number.is_integer():
+            raise Uncertain()
+        number = int(number)
+    return number
+
+def _to_decimal(value):
+    if _is_null(value):
+        return None
+    return float(_to_number(value))
+
+def _to_boolean(value):
+    if _is_null(value):
+        return None
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('true', 'yes', 'y', '1'):
+        return True
+    if text in ('false', 'no', 'n', '0'):
+        return False
+    raise Uncertain()
+
+def _parse_datetime(text):
+    try:
+        parsed = datetime.fromisoformat(text.replace('Z', '+00:00'))
+        return parsed if parsed.tzinfo is None else parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+    for month_first, day_first in AMBIGUOUS_DATE_FORMATS:
+        readings = set()
+        for date_format in (month_first, day_first):
+            try:
+                readings.add(datetime.strptime(text, date_format))
+            except ValueError:
+                pass
+        if len(readings) == 1:
+            return readings.pop()
+        if len(readings) > 1:
+            raise Uncertain()
+    raise Uncertain()
+
+def _datetime_converter(example):
+    # Write dates the way the template example does: a date only, or an ISO 8601 timestamp (in UTC when it ends with Z)
+    if isinstance(example, str) and re.match(r'^\d{4}-\d{2}-\d{2}$', example):
+        output_format = '%Y-%m-%d'
+    elif isinstance(example, str) and example.endswith('Z'):
+        output_format = '%Y-%m-%dT%H:%M:%SZ'
+    else:
+        output_format = '%Y-%m-%dT%H:%M:%S'
+
+    def convert(value):
+        if _is_null(value):
+            return None
+        if not isinstance(value, str):
+            raise Uncertain()
+        return _parse_datetime(value.strip()).strftime(output_format)
+    return convert
+
+def _string_converter(value):
+    return None if value is None else _to_string(value)
+
+def _compile_field(spec):
+    """Builds the converter of one template field, or returns None for a type the engine does not know."""
+    if not isinstance(spec, dict):
+        return None
+    field_type = str(spec.get('type', '')).strip().lower()
+    properties = spec.get('properties')
+
+    if field_type in STRING_TYPES:
+        return _string_converter
+    if field_type in INTEGER_TYPES:
+        return _to_integer
+    if field_type in DECIMAL_TYPES:
+        return _to_decimal
+    if field_type in BOOLEAN_TYPES:
+        return _to_boolean
+    if field_type in DATETIME_TYPES:
+        return _datetime_converter(spec.get('example'))
+    if field_type in OBJECT_TYPES and isinstance(properties, dict):
+        return _object_converter(properties)
+    if field_type in ARRAY_TYPES and isinstance(properties, dict):
+        convert_item = _object_converter(properties)
+
+        def convert(value):
+            if value is None:
+                return None
+            if isinstance(value, dict):
+                value = [value]
+            if not isinstance(value, list):
+                raise Uncertain()
+            return [convert_item(item) for item in value]
+        return convert
+    return None
+
+def _object_converter(properties):
+    converters = {name: _compile_field(spec) for name, spec in properties.items()}
+
+    def convert(value):
+        if value is None:
+            return None
+        if not isinstance(value, dict) or any(converter is None for converter in converters.values()):
+            raise Uncertain()
+        # The output has exactly the properties of the template, missing ones are null
+        return {name: converter(value.get(name)) for name, converter in converters.items()}
+    return convert
+
+class FormatCoercer:
+    """
+    Converts extracts to the types of a format.json template without an agent run.
+
+    The template is compiled once into a converter per top-level field. Fields whose values cannot be converted
+    with confidence (e.g. 'A' for an integer, an ambiguous date, or a type the engine does not know) are left
+    to the Formatter agent.
+
+    Args:
+    template (dict or str): The format template, as a dictionary of fields or its JSON string.
+    """
+
+    def __init__(self, template):
+        if isinstance(template, str):
+            template = json.loads(template)
+        if not isinstance(template, dict):
+            raise ValueError('The format template must be a JSON object')
+        self.template = template
+        self.converters = {name: _compile_field(spec) for name, spec in template.items()}
+
+    def coerce(self, extract):
+        """
+        Converts an extract to the template.
+
+        Returns:
+        formatted (dict): The template fields, converted where possible and as extracted otherwise. Fields
+        missing from the extract are null and fields not in the template are dropped.
+        uncertain_fields (list): The top-level fields that could not be converted with confidence. When the
+        extract has keys the template does not know (e.g. the unparsed response of a field group), the
+        fields missing from the extract are uncertain too, as their values may be in that data.
+        """
+        formatted = {}
+        uncertain_fields = []
+        unknown_keys = [name for name in extract if name not in self.converters]
+        for name, converter in self.converters.items():
+            value = extract.get(name)
+            try:
+                if converter is None or (name not in extract and len(unknown_keys) > 0):
+                    raise Uncertain()
+                formatted[name] = converter(value)
+            except Uncertain:
+                formatted[name] = value
+                uncertain_fields.append(name)
+        return formatted, uncertain_fields
+
+_coercers = {}
+
+def get_format_coercer(template):
+    """Returns the compiled coercer of a template, compiling each template only once per process."""
+    key = template if isinstance(template, str) else json.dumps(template, sort_keys=True)
+    if key not in _coercers:
+        _coercers[key] = FormatCoercer(template)
+    return _coercers[key]
@@ -13,11 +13,16 @@ import logging
 import json
 import os
 import hashlib
-from azure.cosmos import CosmosClient
+import asyncio
+import threading
+import fnmatch
+import uuid
+from azure.cosmos import CosmosClient, PartitionKey
 from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
 from pypdf import PdfReader, PdfWriter
 from io import BytesIO
-from datetime import datetime
+from datetime import datetime, timezone
 import filetype
 import fitz as pymupdf
 from PIL import Image
@@ -27,6 +32,15 @@ from doc_intel_utilities import *
 from datetime import date
 from openai import AzureOpenAI
 from utils import *
+from doc_intel_cache import *
+from clients import *
+from retry_policy import *
+from telemetry import *
+from convergence import *
+from page_routing import *
+from image_profiles import *
+from formatter import *
+from schema_registry import *
 
 from azure.ai.projects.models import (
     MessageTextContent,
@@ -48,12 +62,245 @@ app = df.DFApp(http_auth_level=func.AuthLevel.FUNCTION)
 @app.durable_client_input(client_name="client")
 async def http_start(req: func.HttpRequest, client):
     function_name = req.route_params.get('functionName')
-    payload = json.loads(req.get_body())
+    # Inline schemas are registered and replaced by their IDs before they enter the orchestration history
+    payload = await register_payload_schemas(json.loads(req.get_body()))
 
     instance_id = await client.start_new(function_name, client_input=payload)
     response = client.create_check_status_response(req, instance_id)
     return response
 
+# Register a target schema or format template (request body) and return the ID to reference it by
+@app.route(route="schemas", methods=["POST"])
+async def schema_register(req: func.HttpRequest):
+    try:
+        schema = json.loads(req.get_body())
+    except json.JSONDecodeError:
+        return func.HttpResponse(json.dumps({'error': 'The schema must be a JSON document'}), status_code=400, mimetype="application/json")
+    schema_id = await register_schema(schema)
+    return func.HttpResponse(json.dumps({'schema_id': schema_id}), status_code=200, mimetype="application/json")
+
+@app.route(route="schemas/{schemaId}", methods=["GET"])
+async def schema_get(req: func.HttpRequest):
+    try:
+        schema = await load_schema(req.route_params.get('schemaId'))
+    except ValueError as e:
+        return func.HttpResponse(json.dumps({'error': str(e)}), status_code=404, mimetype="application/json")
+    return func.HttpResponse(json.dumps(schema), status_code=200, mimetype="application/json")
+
+TERMINAL_RUNTIME_STATUSES = {'Completed', 'Failed', 'Terminated', 'Canceled'}
+
+def get_batch_container_client():
+    # Batch manifests map every file of a batch to the orchestration started for it
+    return get_async_blob_service_client().get_container_client(os.getenv('BATCH_CONTAINER', 'orchestration-batches'))
+
+async def list_batch_files(container, prefix='', extensions=['.pdf'], pattern=None):
+    """
+    Lists the files of a container to submit as a batch.
+
+    Args:
+    container (str): The name of the container holding the documents.
+    prefix (str): Only include blobs whose name starts with this prefix.
+    extensions (list): Only include blobs with one of these file extensions.
+    pattern (str): Optional shell-style pattern (e.g. 'drawings/*-rev2.pdf') the blob names must match.
+
+    Returns:
+    files (list): The names of the matching blobs.
+    """
+    container_client = get_async_blob_service_client().get_container_client(container)
+    extensions = [x.lower() for x in extensions]
+    files = []
+    async for blob in container_client.list_blobs(name_starts_with=prefix or None):
+        if '.' + blob.name.lower().split('.')[-1] not in extensions:
+            continue
+        if pattern and not fnmatch.fnmatch(blob.name, pattern):
+            continue
+        files.append(blob.name)
+    return files
+
+async def get_batch_status(client, manifest):
+    # Query every orchestration of the batch concurrently and aggregate their runtime statuses
+    async def get_status(instance_id):
+        status = await client.get_status(instance_id)
+        if status is None or status.runtime_status is None:
+            return 'Pending', None
+        return status.runtime_status.name, status.custom_status
+
+    statuses = await asyncio.gather(*[get_status(x) for x in manifest['instances'].values()])
+    counts = {}
+    for runtime_status, _ in statuses:
+        counts[runtime_status] = counts.get(runtime_status, 0) + 1
+
+    return {'batchId': manifest['batch_id'],
+            'functionName': manifest['function_name'],
+            'createdTime': manifest['created_time'],
+            'total': len(statuses),
+            'counts': counts,
+            'done': all(runtime_status in TERMINAL_RUNTIME_STATUSES for runtime_status, _ in statuses),
+            'instances': [{'filename': filename, 'id': instance_id, 'runtimeStatus': runtime_status, 'customStatus': custom_status}
+                          for (filename, instance_id), (runtime_status, custom_status) in zip(manifest['instances'].items(), statuses)]}
+
+# Starts one orchestration per file for a list of filenames, or for every file in the container matching a prefix
+# and filters. The request body holds the same settings as a single orchestration payload plus:
+#   "filenames": [...] or "prefix": "...", "extensions": [".pdf"], "pattern": "*.pdf"
+#   "idempotency_key": "..." (or an Idempotency-Key header)
+# Resubmitting a batch with the same idempotency key returns the existing batch instead of starting new
+# orchestrations, and only starts the files that were not started by an earlier, interrupted submission.
+@app.route(route="batches/start/{functionName}", methods=["POST"])
+@app.durable_client_input(client_name="client")
+async def batch_start(req: func.HttpRequest, client):
+    function_name = req.route_params.get('functionName')
+    # Register inline schemas once rather than copying them into the input of every orchestration of the batch
+    payload = await register_payload_schemas(json.loads(req.get_body()))
+
+    filenames = payload.pop('filenames', None)
+    prefix = payload.pop('prefix', None)
+    extensions = payload.pop('extensions', ['.pdf'])
+    pattern = payload.pop('pattern', None)
+    idempotency_key = payload.pop('idempotency_key', None) or req.headers.get('Idempotency-Key')
+
+    if filenames is None and prefix is None:
+        return func.HttpResponse(json.dumps({'error': "Either 'filenames' or 'prefix' is required"}), status_code=400, mimetype="application/json")
+    if filenames is None and not payload.get('container'):
+        return func.HttpResponse(json.dumps({'error': "'container' is required to list the files of a batch"}), status_code=400, mimetype="application/json")
+
+    # The batch ID, and with it every orchestration instance ID, is derived from the idempotency key
+    if idempotency_key:
+        batch_id = 'batch-' + hashlib.sha256(f"{function_name}:{idempotency_key}".encode()).hexdigest()[:24]
+    else:
+        batch_id = 'batch-' + uuid.uuid4().hex[:24]
+
+    batch_container_client = get_batch_container_client()
+    if not await batch_container_client.exists():
+        try:
+            await batch_container_client.create_container()
+        except ResourceExistsError:
+            pass
+
+    manifest_blob_client = batch_container_client.get_blob_client(f"{batch_id}.json")
+    try:
+        manifest = json.loads(await (await manifest_blob_client.download_blob()).readall())
+    except ResourceNotFoundError:
+        if filenames is None:
+            filenames = await list_batch_files(payload['container'], prefix, extensions, pattern)
+        instances = {filename: f"{batch_id}-{hashlib.sha256(filename.encode()).hexdigest()[:12]}" for filename in dict.fromkeys(filenames)}
+        manifest = {'batch_id': batch_id, 'function_name': function_name, 'created_time': datetime.now(timezone.utc).isoformat(), 'instances': instances}
+        # Save the manifest before starting anything so that a retried submission can find the instances
+        try:
+            await manifest_blob_client.upload_blob(json.dumps(manifest), overwrite=False)
+        except ResourceExistsError:
+            manifest = json.loads(await (await manifest_blob_client.download_blob()).readall())
+
+    semaphore = asyncio.Semaphore(int(os.getenv('BATCH_START_CONCURRENCY', 50)))
+
+    async def start(filename, instance_id):
+        async with semaphore:
+            # Never replace an orchestration that was already started for this file
+            status = await client.get_status(instance_id)
+            if status is not None and status.runtime_status is not None:
+                return False
+            await client.start_new(function_name, instance_id, {**payload, 'filename': filename})
+            return True
+
+    started = await asyncio.gather(*[start(filename, instance_id) for filename, instance_id in manifest['instances'].items()])
+
+    batch_status = await get_batch_status(client, manifest)
+    batch_status['started'] = sum(started)
+    return func.HttpResponse(json.dumps(batch_status, default=str), status_code=202, mimetype="application/json")
+
+# Aggregated status of every orchestration in a batch
+@app.route(route="batches/{batchId}", methods=["GET"])
+@app.durable_client_input(client_name="client")
+async def batch_status(req: func.HttpRequest, client):
+    batch_id = req.route_params.get('batchId')
+    try:
+        manifest = json.loads(await (await get_batch_container_client().get_blob_client(f"{batch_id}.json").download_blob()).readall())
+    except ResourceNotFoundError:
+        return func.HttpResponse(json.dumps({'error': f"Batch {batch_id} not found"}), status_code=404, mimetype="application/json")
+    return func.HttpResponse(json.dumps(await get_batch_status(client, manifest), default=str), mimetype="application/json")
+
+# Retry counts and time spent retrying for each service, for the worker process serving the request
+@app.route(route="diagnostics/retries", methods=["GET"])
+def retry_statistics(req: func.HttpRequest):
+    return func.HttpResponse(json.dumps(get_retry_stats()), mimetype="application/json")
+
+def status_fingerprint(status):
+    # Only the runtime status and custom status are meaningful to clients, so ignore other history updates
+    return hashlib.sha256(json.dumps([status.get('runtimeStatus'), status.get('customStatus')], sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+# Long-poll progress stream for one or more orchestrations. The request holds until the runtime or custom status
+# of at least one instance differs from the client's cursor (or the timeout elapses) and returns only the changed
+# instances, so that a client can follow a whole batch of orchestrations over a single request at a time.
+#
+# Request body: {"instances": [...], "cursor": {instance_id: fingerprint}, "timeout": 25, "include_children": false}
+# Response body: {"changes": {instance_id: status}, "cursor": {instance_id: fingerprint}, "done": bool}
+@app.route(route="progress", methods=["POST"])
+@app.durable_client_input(client_name="client")
+async def progress_stream(req: func.HttpRequest, client):
+    payload = json.loads(req.get_body())
+    instances = list(dict.fromkeys(payload['instances']))
+    cursor = payload.get('cursor', {}) or {}
+    timeout = min(float(payload.get('timeout', 25)), float(os.getenv('PROGRESS_MAX_TIMEOUT', 55)))
+    poll_interval = float(os.getenv('PROGRESS_POLL_INTERVAL', 1.0))
+    max_poll_interval = max(poll_interval, float(os.getenv('PROGRESS_MAX_POLL_INTERVAL', 5.0)))
+    include_children = payload.get('include_children', False)
+    # Status reads run concurrently, up to this many at once
+    semaphore = asyncio.Semaphore(max(1, int(os.getenv('PROGRESS_MAX_CONCURRENCY', 16))))
+
+    def to_status(status):
+        if status is None or status.runtime_status is None:
+            return {'runtimeStatus': 'Pending', 'customStatus': None, 'lastUpdatedTime': None}
+        return {'runtimeStatus': status.runtime_status.name,
+                'customStatus': status.custom_status,
+                'lastUpdatedTime': status.last_updated_time.isoformat() if status.last_updated_time else None}
+
+    async def get_status(instance_id):
+        async with semaphore:
+            try:
+                return to_status(await client.get_status(instance_id))
+            except Exception as e:
+                logging.warning(f'Failed to get the status of {instance_id}: {e}')
+                return None
+
+    statuses = {}
+
+    async def read_statuses(instance_ids, parent_ids=None):
+        # Terminal statuses never change, so they are read once per request. A status that could not be read, or
+        # that reads as Pending after it was seen, keeps its last known value rather than going back to Pending.
+        to_read = [x for x in instance_ids if statuses.get(x, {}).get('runtimeStatus') not in TERMINAL_RUNTIME_STATUSES]
+        for instance_id, status in zip(to_read, await asyncio.gather(*[get_status(x) for x in to_read])):
+            if status is None or (status['runtimeStatus'] == 'Pending' and instance_id in statuses):
+                continue
+            if parent_ids is not None:
+                status['parentId'] = parent_ids[instance_id]
+            statuses[instance_id] = status
+
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        await read_statuses(instances)
+
+        if include_children:
+            # Sub-orchestrations are started with '<parent id>-<document index>' instance IDs
+            children = {}
+            for parent_id in instances:
+                custom_status = statuses.get(parent_id, {}).get('customStatus')
+                document_count = custom_status.get('Documents', 0) if isinstance(custom_status, dict) else 0
+                children.update({f"{parent_id}-{i}": parent_id for i in range(document_count)})
+            await read_statuses(list(children), children)
+
+        fingerprints = {instance_id: status_fingerprint(status) for instance_id, status in statuses.items()}
+        changes = {instance_id: statuses[instance_id] for instance_id in statuses if cursor.get(instance_id) != fingerprints[instance_id]}
+        # Instances that could not be read keep the fingerprint the client already has
+        fingerprints.update({instance_id: cursor[instance_id] for instance_id in instances if instance_id not in statuses and instance_id in cursor})
+        done = all(statuses.get(x, {}).get('runtimeStatus') in TERMINAL_RUNTIME_STATUSES for x in instances)
+
+        if changes or done or asyncio.get_running_loop().time() + poll_interval > deadline:
+            break
+        await asyncio.sleep(poll_interval)
+        # Back off while nothing changes
+        poll_interval = min(poll_interval * 2, max_poll_interval)
+
+    return func.HttpResponse(json.dumps({'changes': changes, 'cursor': fingerprints, 'done': done}, default=str), mimetype="application/json")
+
 # Orchestrators
 @app.orchestration_trigger(context_name="context")
 def agent_document_analysis_orchestrator(context):
@@ -76,17 +323,28 @@ def agent_document_analysis_orchestrator(context):
     format_template = payload.get("schema_types")
     max_iterations = payload.get("max_iterations", 8)
     cosmos_logging = payload.get("cosmos_logging", False)
+    message_mode = payload.get("message_mode", os.getenv("AGENT_MESSAGE_MODE", "delta"))
+    max_concurrent_documents = max(1, int(payload.get("max_concurrent_documents", os.getenv("MAX_CONCURRENT_DOCUMENTS", 4))))
+    convergence_threshold = float(payload.get("convergence_threshold", os.getenv("CONVERGENCE_THRESHOLD", 0.0)))
+    max_field_groups = int(payload.get("max_field_groups", os.getenv("MAX_FIELD_GROUPS", 1)))
+    # Send the agents only the best scoring pages for every field (0 sends the whole document)
+    page_routing_top_k = int(payload.get("page_routing_top_k", os.getenv("PAGE_ROUTING_TOP_K", 0)))
+    page_routing_fallback = payload.get("page_routing_fallback", os.getenv("PAGE_ROUTING_FALLBACK", "full"))
+    # How page images are rendered for the agents, a built-in profile name or a dictionary of profile settings
+    image_profile = payload.get("image_profile", os.getenv("IMAGE_PROFILE", "default"))
+    # Convert extracts to the format template locally, calling the Formatter agent only for fields that cannot be converted
+    local_formatter = payload.get("local_formatter", os.getenv("LOCAL_FORMATTER", "auto"))
 
     status_record = payload.copy()
 
     status_record['tokens_consumed'] = 0
-    status_record['responses'] = []
-    status_record['extract'] = ''
+    # The final extract of every file, keyed by file name
+    status_record['extracts'] = {}
     status_record['id'] = context.instance_id
 
-    analyst_agent_id = os.environ['ANALYST_AGENT_ID']
-    reviewer_agent_id = os.environ['REVIEWER_AGENT_ID'] 
-    formatter_agent_id = os.environ['FORMATTER_AGENT_ID']
+    # Per-stage timings, bytes, tokens and retries reported by the activities of this orchestration
+    started_time = context.current_utc_datetime
+    telemetry = {}
 
     try:
         if cosmos_logging:
@@ -100,6 +358,7 @@ def agent_document_analysis_orchestrator(context):
     # Confirm that all storage locations exist to support document ingestion
     try:
         container_check = yield context.call_activity_with_retry("check_containers", retry_options, json.dumps({'source_container': container}))
+        summarize_spans(container_check['telemetry'], telemetry)
         context.set_custom_status('Intermediate Processing Containers Checked')
         
     except Exception as e:
@@ -107,84 +366,375 @@ def agent_document_analysis_orchestrator(context):
         logging.error(e)
         raise e
     
-    image_container = f"{container}-images"
-    document_intelligence_results_container = f"{container}-document-intelligence-results"
-    processed_results_container = f"{container}-processed-results"
-
-    # Initialize lists to store parent and extracted files
-    parent_files = []
-    extracted_files = []
-    
      # Get the list of files in the source container
     try:
-        files = yield context.call_activity_with_retry("get_source_files", retry_options, json.dumps({'source_container': container, 'extensions': ['.pdf'], 'prefix': filename}))
-        context.set_custom_status('Retrieved Source Files')
+        source_files = yield context.call_activity_with_retry("get_source_files", retry_options, json.dumps({'source_container': container, 'extensions': ['.pdf'], 'prefix': filename}))
+        files = source_files['files']
+        summarize_spans(source_files['telemetry'], telemetry)
     except Exception as e:
         context.set_custom_status('Ingestion Failed During File Retrieval')
         logging.error(e)
         raise e
-    
-    context.set_custom_status('Retrieved Source Files')
 
+    # Report the document count as soon as the files are known, so that progress clients can follow the
+    # per-document sub-orchestrations from the start
+    context.set_custom_status({'Documents': len(files), 'Completed': 0, 'Failed': 0})
+
+    # Register the schemas (schema.json and format.json when none are given) and split the target schema into
+    # field groups, each extracted by its own analyze/review loop running in parallel. Only the schema IDs are
+    # passed on, the schemas themselves stay out of the orchestration history.
+    schema_refs = yield context.call_activity_with_retry("register_schemas", retry_options, json.dumps({
+        'target_schema': schema, 'target_schema_id': payload.get("target_schema_id"),
+        'schema_types': format_template, 'schema_types_id': payload.get("schema_types_id"),
+        'field_groups': payload.get("field_groups"), 'max_field_groups': max_field_groups,
+    }))
+
+    # Process every matching file in its own sub-orchestration, keeping at most max_concurrent_documents running at once
+    pending = []
+    saved_files = []
+    failed_files = []
+    stop_reasons = {}
+
+    def wait_for_document():
+        completed = yield context.task_any(pending)
+        pending.remove(completed)
+        if isinstance(completed.result, Exception):
+            failed_files.append(str(completed.result))
+        else:
+            saved_files.append(completed.result['file'])
+            merge_summaries(telemetry, completed.result['telemetry'])
+            # Documents split into field groups report the stop reason of every group
+            convergence = completed.result['convergence']
+            for group in convergence.get('field_groups') or [convergence]:
+                stop_reasons[group['stop_reason']] = stop_reasons.get(group['stop_reason'], 0) + 1
+        context.set_custom_status({'Documents': len(files), 'Completed': len(saved_files), 'Failed': len(failed_files)})
+
+    for index, file in enumerate(files):
+        if len(pending) >= max_concurrent_documents:
+            yield from wait_for_document()
+        document_input = {
+            'container': container,
+            'file': file,
+            'doc_intel_model': doc_intel_model,
+            'target_schema_id': schema_refs['target_schema_id'],
+            'schema_types_id': schema_refs['schema_types_id'],
+            'max_iterations': max_iterations,
+            'cosmos_logging': cosmos_logging,
+            'cosmos_id': context.instance_id,
+            'message_mode': message_mode,
+            'convergence_threshold': convergence_threshold,
+            'field_group_ids': schema_refs['field_group_ids'],
+            'field_group_tokens': schema_refs.get('field_group_tokens'),
+            'page_routing_top_k': page_routing_top_k,
+            'page_routing_fallback': page_routing_fallback,
+            'image_profile': image_profile,
+            'local_formatter': local_formatter,
+        }
+        pending.append(context.call_sub_orchestrator("document_analysis_sub_orchestrator", document_input, f"{context.instance_id}-{index}"))
+
+    while len(pending) > 0:
+        yield from wait_for_document()
+
+    # Record the end-to-end duration from orchestration timestamps, which are replay-safe
+    summarize_spans([{'stage': 'orchestration', 'duration_ms': (context.current_utc_datetime - started_time).total_seconds() * 1000, 'documents': len(files), 'failed_documents': len(failed_files)}], telemetry)
+    context.set_custom_status({'Documents': len(files), 'Completed': len(saved_files), 'Failed': len(failed_files), 'Stop Reasons': stop_reasons, 'Telemetry': telemetry})
 
-    try:
-        extract_pdf_tasks = []
-        for file in files:
-            # Create a task to process the PDF page and append it to the extract_pdf_tasks list
-            extract_pdf_tasks.append(context.call_activity("process_pdf_with_document_intelligence", json.dumps({'file':file, 'container': container, 'doc_intel_results_container': document_intelligence_results_container , 'doc_intel_model': doc_intel_model})))
-        # Execute all the extract PDF tasks and get the results
-        extracted_pdf_files = yield context.task_all(extract_pdf_tasks)
-        extracted_pdf_files = [x for x in extracted_pdf_files if x is not None]
+    if cosmos_logging:
+        try:
+            yield context.call_activity("save_status_telemetry", json.dumps({'cosmos_id': context.instance_id, 'telemetry': telemetry}))
+        except Exception as e:
+            logging.warning(f'Failed to save telemetry to the status record: {e}')
 
-    except Exception as e:
-        context.set_custom_status('Ingestion Failed During Document Intelligence Extraction')
-        logging.error(e)
-        raise e
-    
+    if len(files) > 0 and len(saved_files) == 0:
+        context.set_custom_status('Processing Failed For All Documents')
+        raise Exception(f'All documents failed processing: {failed_files}')
+
+    return saved_files
+
+
+@app.orchestration_trigger(context_name="context")
+def document_analysis_sub_orchestrator(context):
+
+    first_retry_interval_in_milliseconds = 5000
+    max_number_of_attempts = 2
+    retry_options = df.RetryOptions(first_retry_interval_in_milliseconds, max_number_of_attempts)
+
+    # Get the input payload from the context
+    payload = context.get_input()
+
+    container = payload.get("container")
+    file = payload.get("file")
+    doc_intel_model = payload.get("doc_intel_model")
+    schema_id = payload.get("target_schema_id")
+    format_template_id = payload.get("schema_types_id")
+    field_group_ids = payload.get("field_group_ids") or [schema_id]
+    # Estimated prompt tokens of the schema of every field group, used to report the tokens saved by not resending it
+    field_group_tokens = payload.get("field_group_tokens") or [0] * len(field_group_ids)
+    max_iterations = payload.get("max_iterations", 8)
+    cosmos_logging = payload.get("cosmos_logging", False)
+    cosmos_id = payload.get("cosmos_id")
+    message_mode = payload.get("message_mode", "delta")
+    convergence_threshold = payload.get("convergence_threshold", 0.0)
+    page_routing_top_k = payload.get("page_routing_top_k", 0)
+    page_routing_fallback = payload.get("page_routing_fallback", "full")
+    image_profile = payload.get("image_profile", "default")
+    image_crop = get_image_profile(image_profile).crop
+    local_formatter = payload.get("local_formatter", "auto")
+
+    image_container = f"{container}-images"
+    document_intelligence_results_container = f"{container}-document-intelligence-results"
+    processed_results_container = f"{container}-processed-results"
+
+    spans = []
+
+    # Only schema IDs pass through the orchestration, the activities load the schemas to route pages to field
+    # groups and to format the extract
+    doc_intel_input = json.dumps({'file':file, 'container': container, 'doc_intel_results_container': document_intelligence_results_container , 'doc_intel_model': doc_intel_model,
+                                  'target_schema_id': schema_id, 'field_group_ids': field_group_ids, 'page_routing_top_k': page_routing_top_k,
+                                  'page_routing_fallback': page_routing_fallback, 'image_crop': image_crop})
+
+    # Run Document Intelligence and page rasterization for the file in parallel, unless the page images are
+    # cropped to regions found by Document Intelligence
     try:
-        extract_image_tasks = []
-        for file in files:
-            # Create a task to process the PDF page and append it to the extract_pdf_tasks list
-            extract_image_tasks.append(context.call_activity("save_pdf_images", json.dumps({'filename':file, 'source_container': container})))
-        # Execute all the extract PDF tasks and get the results
-        extracted_image_files = yield context.task_all(extract_image_tasks)
-        extracted_image_files = [item for sublist in extracted_image_files for item in sublist]
+        if image_crop:
+            extracted_pdf_file = yield context.call_activity("process_pdf_with_document_intelligence", doc_intel_input)
+            saved_images = yield context.call_activity("save_pdf_images", json.dumps({'filename':file, 'source_container': container, 'image_profile': image_profile,
+                                                                                      'regions': extracted_pdf_file['regions']}))
+        else:
+            extracted_pdf_file, saved_images = yield context.task_all([
+                context.call_activity("process_pdf_with_document_intelligence", doc_intel_input),
+                context.call_activity("save_pdf_images", json.dumps({'filename':file, 'source_container': container, 'image_profile': image_profile})),
+            ])
 
     except Exception as e:
-        context.set_custom_status('Processing Failed During Image Extraction')
+        context.set_custom_status('Ingestion Failed During Document Intelligence Extraction or Image Extraction')
         logging.error(e)
         raise e
 
     context.set_custom_status('Converted PDF to Images')
 
-    if len(schema)==0:
-        schema = json.loads(open('schema.json', 'r').read())
-    if len(format_template)==0:
-        format_template = json.loads(open('format.json', 'r').read())
+    extracted_image_files = saved_images['images']
+    spans += extracted_pdf_file['telemetry'] + saved_images['telemetry']
+    ocr_text = extracted_pdf_file['OCR']
+    key_value_pairs = extracted_pdf_file['DefaultDocumentExtract']
+    routing = extracted_pdf_file.get('routing')
+
+    def routed_inputs(index):
+        # The OCR text and page images of the pages routed to the fields of a field group, or the whole document
+        if routing is None:
+            return ocr_text, extracted_image_files
+        pages = routing['group_pages'][index]
+        return join_page_text(extracted_pdf_file['pages'], pages), [image for image in extracted_image_files if image['page'] in pages]
+
+    if routing is not None:
+        context.set_custom_status({'Routed Pages': len(routing['pages']), 'Page Count': routing['page_count'], 'Fallback Fields': routing['fallback_fields']})
+
+    if len(field_group_ids) > 1:
+        # Run the analyze/review loop of every field group in parallel, then format the merged extract
+        group_inputs = [routed_inputs(index) for index in range(len(field_group_ids))]
+        group_results = yield context.task_all([
+            context.call_sub_orchestrator("field_group_sub_orchestrator", {
+                'file': file,
+                'target_schema_id': group_id,
+                'schema_tokens': field_group_tokens[index],
+                'ocr_text': group_inputs[index][0],
+                'key_value_pairs': key_value_pairs,
+                'image_container': image_container,
+                'image_files': group_inputs[index][1],
+                'max_iterations': max_iterations,
+                'cosmos_logging': cosmos_logging,
+                'cosmos_id': cosmos_id,
+                'message_mode': message_mode,
+                'convergence_threshold': convergence_threshold,
+            }, f"{context.instance_id}-g{index}")
+            for index, group_id in enumerate(field_group_ids)
+        ])
+
+        current_extract, current_feedback, token_usage, convergence = merge_field_group_results(group_results)
+        context.set_custom_status({'Field Groups': len(field_group_ids), 'Consumed Tokens': token_usage['total_tokens'], 'Stop Reason': convergence['stop_reason']})
+
+        threads = yield context.call_activity_with_retry("create_agent_threads", retry_options, json.dumps({'agents': ['format']}))
+        try:
+            current_extract = yield from run_format_step(context, threads['format'], None, current_extract, current_feedback, token_usage, convergence,
+                                                         cosmos_logging, cosmos_id, file, spans, local_formatter, format_template_id)
+        except Exception:
+            # Delete the threads on failure as well, without a finally block (see below)
+            yield context.call_activity("delete_agent_threads", json.dumps({'thread_ids': list(threads.values())}))
+            raise
+        yield context.call_activity("delete_agent_threads", json.dumps({'thread_ids': list(threads.values())}))
+
+        telemetry = summarize_spans(spans)
+        for group_result in group_results:
+            merge_summaries(telemetry, group_result['telemetry'])
+    else:
+        # Create the agent threads in an activity so that replays reuse the recorded thread IDs
+        # rather than creating new threads in Foundry on every replay
+        threads = yield context.call_activity_with_retry("create_agent_threads", retry_options, json.dumps({'agents': ['analyze', 'review', 'format']}))
+        document_text, document_images = routed_inputs(0)
+
+        try:
+            current_extract, current_feedback, token_usage, convergence = yield from run_agent_loop(context, threads, None, None, document_text, key_value_pairs,
+                                                                                                     image_container, document_images, max_iterations, cosmos_logging,
+                                                                                                     message_mode, cosmos_id, file, spans, convergence_threshold, local_formatter,
+                                                                                                     schema_id, format_template_id, field_group_tokens[0])
+        except Exception:
+            # Delete the threads when the run failed (not in finally, which also runs when the paused
+            # generator is closed after an episode), then surface the failure
+            yield context.call_activity("delete_agent_threads", json.dumps({'thread_ids': list(threads.values())}))
+            raise
+        # Delete the threads once the run has finished
+        yield context.call_activity("delete_agent_threads", json.dumps({'thread_ids': list(threads.values())}))
+
+        telemetry = summarize_spans(spans)
+
+    saved_file = yield context.call_activity("save_extract", json.dumps({'result_container': processed_results_container, 'filename': file, 'extract': current_extract}))
+    summarize_spans(saved_file['telemetry'], telemetry)
+
+    return {'file': saved_file['file'], 'telemetry': telemetry, 'convergence': convergence}
+
+
+@app.orchestration_trigger(context_name="context")
+def field_group_sub_orchestrator(context):
+    """
+    Runs the analyze/review loop for one group of schema fields of a document, on its own agent threads.
+    The document inputs (OCR text, key-value pairs and page images) are prepared once by the calling
+    document_analysis_sub_orchestrator and shared by every group.
+    """
+    first_retry_interval_in_milliseconds = 5000
+    max_number_of_attempts = 2
+    retry_options = df.RetryOptions(first_retry_interval_in_milliseconds, max_number_of_attempts)
+
+    payload = context.get_input()
+
+    spans = []
+
+    threads = yield context.call_activity_with_retry("create_agent_threads", retry_options, json.dumps({'agents': ['analyze', 'review']}))
+
+    try:
+        current_extract, current_feedback, token_usage, convergence = yield from run_review_loop(context, threads, payload.get('target_schema'), payload['ocr_text'],
+                                                                                                  payload['key_value_pairs'], payload['image_container'], payload['image_files'],
+                                                                                                  payload.get('max_iterations', 8), payload.get('cosmos_logging', False),
+                                                                                                  payload.get('message_mode', 'delta'), payload.get('cosmos_id'),
+                                                                                                  payload.get('file'), spans, payload.get('convergence_threshold', 0.0),
+                                                                                                  payload.get('target_schema_id'), payload.get('schema_tokens'))
+    except Exception:
+        # Delete the threads on failure as well, without a finally block (see document_analysis_sub_orchestrator)
+        yield context.call_activity("delete_agent_threads", json.dumps({'thread_ids': list(threads.values())}))
+        raise
+    yield context.call_activity("delete_agent_threads", json.dumps({'thread_ids': list(threads.values())}))
+
+    return {'extract': current_extract, 'feedback': current_feedback, 'token_usage': token_usage, 'convergence': convergence, 'telemetry': summarize_spans(spans)}
+
+
+def merge_field_group_results(group_results):
+    """
+    Combines the results of the field group sub-orchestrations of a document.
+
+    Returns:
+    tuple: The merged extract, the feedback of every group, the total token usage and a convergence summary
+    with the stop reason of every group.
+    """
+    current_extract = {}
+    token_usage = {}
+    for index, group_result in enumerate(group_results):
+        if isinstance(group_result['extract'], dict):
+            current_extract.update(group_result['extract'])
+        else:
+            # Keep a group's response that could not be parsed as JSON for the Formatter to interpret, the fields of
+            # the group are missing from the extract so the local formatter leaves them to the agent
+            current_extract[f'field_group_{index}'] = group_result['extract']
+        for key, value in group_result['token_usage'].items():
+            token_usage[key] = token_usage.get(key, 0) + (value or 0)
+
+    group_convergence = [group_result['convergence'] for group_result in group_results]
+    convergence = {
+        'stop_reason': '+'.join(sorted({group['stop_reason'] for group in group_convergence})),
+        'verified_fields': sorted({field for group in group_convergence for field in group['verified_fields']}),
+        'field_groups': group_convergence,
+    }
+    return current_extract, [group_result['feedback'] for group_result in group_results], token_usage, convergence
+
+
+def run_agent_loop(context, threads, schema, format_template, ocr_text, key_value_pairs, image_container, extracted_image_files, max_iterations, cosmos_logging, message_mode='delta', cosmos_id=None, file=None, spans=None, convergence_threshold=0.0, local_formatter='auto', schema_id=None, format_template_id=None, schema_tokens=None):
+    """
+    Runs the analyze/review loop followed by the format step, yielding Durable tasks to the calling orchestrator.
+
+    Returns:
+    tuple: The final extract, the last reviewer feedback, a summary of the token usage and a summary of the
+    convergence checks, including the rule that ended the loop.
+    """
+    current_extract, current_feedback, token_usage, convergence = yield from run_review_loop(context, threads, schema, ocr_text, key_value_pairs, image_container,
+                                                                                              extracted_image_files, max_iterations, cosmos_logging, message_mode,
+                                                                                              cosmos_id, file, spans, convergence_threshold, schema_id, schema_tokens)
+
+    current_extract = yield from run_format_step(context, threads['format'], format_template, current_extract, current_feedback, token_usage, convergence,
+                                                 cosmos_logging, cosmos_id, file, spans, local_formatter, format_template_id)
 
+    return current_extract, current_feedback, token_usage, convergence
+
+
+def run_review_loop(context, threads, schema, ocr_text, key_value_pairs, image_container, extracted_image_files, max_iterations, cosmos_logging, message_mode='delta', cosmos_id=None, file=None, spans=None, convergence_threshold=0.0, schema_id=None, schema_tokens=None):
+    """
+    Runs the analyze/review loop, yielding Durable tasks to the calling orchestrator.
+
+    In 'delta' message mode the schema, OCR text, key-value pairs and page images are only sent on the first
+    turn of each agent thread; later turns only carry the new extract or feedback. In 'full' mode the whole
+    document context is sent on every turn. The telemetry spans of every agent turn are appended to `spans`.
+
+    The loop also ends early once successive extracts converge: when an analyze turn changes nothing (or at most
+    `convergence_threshold` of the extracted values), or when every field has passed review. Fields that passed
+    review are sent to the reviewer as Reviewed Fields so that they are not reviewed again.
+
+    When the schema is registered, the agent turns reference it by `schema_id` rather than carrying it, and
+    `schema_tokens` gives its estimated size so that the schema itself is not needed here.
+
+    Returns:
+    tuple: The reviewed extract, the last reviewer feedback, a summary of the token usage and a summary of the
+    convergence checks, including the rule that ended the loop.
+    """
+    analyst_agent_id = os.environ['ANALYST_AGENT_ID']
+    reviewer_agent_id = os.environ['REVIEWER_AGENT_ID'] 
+
+    document_context = {
+        **({'template_schema_id': schema_id} if schema_id else {'template_schema': schema}),
+        'ocr_text': ocr_text,
+        'key_value_pairs': key_value_pairs,
+        'image_container': image_container,
+        'image_files': extracted_image_files,
+    }
+    # Estimated size of the document context, used to report the tokens saved by not resending it
+    context_tokens = estimate_context_tokens(estimate_schema_tokens(schema) if schema_tokens is None else schema_tokens, ocr_text, key_value_pairs, extracted_image_files)
 
     analyze = True
     review = False
     current_extract = ''
     current_feedback = ''
-    previous_feedback = []
-    ocr_text = extracted_pdf_files[0]['OCR']
-    key_value_pairs = extracted_pdf_files[0]['DefaultDocumentExtract']
-    total_tokens = 0
+    token_usage = {'total_tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'estimated_tokens_saved': 0, 'retries': 0, 'retry_wait_seconds': 0}
+    context_sent = set()
     responses = []
     iterations = 0
-
-    # Connect to Foundry
-    # Creaate 3 Threads
-    # Start analysis loop
-    project_client = AIProjectClient.from_connection_string(
-        credential=DefaultAzureCredential(),
-        conn_str=os.environ['AZURE_AI_FOUNDRY_CONNECTION_STRING'],
-    )
-
-    analyst_thread = project_client.agents.create_thread()
-    reviewer_thread = project_client.agents.create_thread()
-    formatter_thread = project_client.agents.create_thread()
+    convergence = ConvergenceTracker(convergence_threshold)
+
+    def agent_payload(agent, agent_id):
+        include_context = message_mode == 'full' or agent not in context_sent
+        payload = {
+            'agent': agent,
+            'agent_id': agent_id,
+            'thread_id': threads[agent],
+            'current_extract': current_extract,
+            'current_feedback': current_feedback,
+            'include_context': include_context,
+            'reviewed_fields': sorted(convergence.verified_fields),
+        }
+        if include_context:
+            payload.update(document_context)
+            context_sent.add(agent)
+        else:
+            token_usage['estimated_tokens_saved'] += context_tokens
+        return json.dumps(payload)
+
+    def add_usage(usage):
+        add_agent_usage(token_usage, usage, spans)
 
     while True:
         iterations += 1
@@ -192,107 +742,185 @@ def agent_document_analysis_orchestrator(context):
             break
         if analyze:
             # call run agent workflow with analyze arguments
-            resp, tokens = yield context.call_activity("run_agent_workflow", json.dumps({
-                                                                                    'agent': 'analyze',
-                                                                                    'agent_id': analyst_agent_id,
-                                                                                    'thread_id': analyst_thread.id,
-                                                                                    'template_schema': schema,
-                                                                                    'ocr_text': ocr_text,
-                                                                                    'key_value_pairs': key_value_pairs,                 
-                                                                                    'image_files': extracted_image_files, 
-                                                                                    'current_extract': current_extract,
-                                                                                    'current_feedback': current_feedback, 
-                                                                                }))
+            resp, usage = yield context.call_activity("run_agent_workflow", agent_payload('analyze', analyst_agent_id))
             current_extract = resp
-            total_tokens += tokens
+            add_usage(usage)
 
-            responses.append({'AI Agent - Analyze - Output': resp, 'Response Timestamp': datetime.now().strftime("%m/%d/%Y, %H:%M:%S")})
-            context.set_custom_status(({'Consumed Tokens': total_tokens, 'Current Agent Response': resp}))
+            responses.append({'AI Agent - Analyze - Output': resp, 'Response Timestamp': context.current_utc_datetime.strftime("%m/%d/%Y, %H:%M:%S")})
+            context.set_custom_status(({'Consumed Tokens': token_usage['total_tokens'], 'Estimated Tokens Saved': token_usage['estimated_tokens_saved'], 'Agent Retries': token_usage['retries'], 'Current Agent Response': resp}))
 
             analyze = False
             review = True
             if cosmos_logging:
 
-                yield context.call_activity("update_status_record", json.dumps({'cosmos_id': context.instance_id, 'response': resp, 'agent': 'analyze'}))
+                yield context.call_activity("update_status_record", json.dumps({'cosmos_id': cosmos_id or context.instance_id, 'entry_id': f"{context.instance_id}-{len(responses):04d}", 'file': file, 'response': resp, 'agent': 'analyze', 'tokens': usage.get('total_tokens')}))
+
+            # Skip the review when the extract stopped changing, the reviewer would only repeat its feedback
+            if convergence.add_extract(current_extract):
+                break
 
             
         elif review:
             # call agent with review arguments
-            resp, tokens = yield context.call_activity("run_agent_workflow", json.dumps({
-                                                                                    'agent': 'review',
-                                                                                    'agent_id':reviewer_agent_id,
-                                                                                    'thread_id': reviewer_thread.id,
-                                                                                    'template_schema': schema,
-                                                                                    'ocr_text': ocr_text,
-                                                                                    'key_value_pairs': key_value_pairs,                 
-                                                                                    'image_files': extracted_image_files, 
-                                                                                    'current_extract': current_extract,
-                                                                                    'current_feedback': current_feedback, 
-                                                                                }))
+            resp, usage = yield context.call_activity("run_agent_workflow", agent_payload('review', reviewer_agent_id))
             current_feedback = resp
             review = False
-            total_tokens += tokens
+            add_usage(usage)
             
-            responses.append({'AI Agent - Review - Output': resp, 'Response Timestamp': datetime.now().strftime("%m/%d/%Y, %H:%M:%S")})
-            context.set_custom_status(({'Consumed Tokens': total_tokens, 'Current Agent Response': resp}))
+            responses.append({'AI Agent - Review - Output': resp, 'Response Timestamp': context.current_utc_datetime.strftime("%m/%d/%Y, %H:%M:%S")})
+            context.set_custom_status(({'Consumed Tokens': token_usage['total_tokens'], 'Estimated Tokens Saved': token_usage['estimated_tokens_saved'], 'Agent Retries': token_usage['retries'], 'Current Agent Response': resp}))
             if cosmos_logging:
 
-                yield context.call_activity("update_status_record", json.dumps({'cosmos_id': context.instance_id, 'response': resp, 'agent': 'review'}))
+                yield context.call_activity("update_status_record", json.dumps({'cosmos_id': cosmos_id or context.instance_id, 'entry_id': f"{context.instance_id}-{len(responses):04d}", 'file': file, 'response': resp, 'agent': 'review', 'tokens': usage.get('total_tokens')}))
 
             
-            if current_feedback['complete']:
+            if convergence.add_review(current_feedback):
                 break
             else:
                 analyze = True
             pass
 
+    if convergence.stop_reason is None:
+        convergence.stop_reason = STOP_MAX_ITERATIONS
 
-    # Call with format arguments
-    resp, tokens = yield context.call_activity("run_agent_workflow", json.dumps({
-                                                                            'agent': 'format',
-                                                                            'agent_id':formatter_agent_id,
-                                                                            'thread_id': formatter_thread.id,
-                                                                            'template_schema': format_template,
-                                                                            'ocr_text': ocr_text,
-                                                                            'key_value_pairs': key_value_pairs,                 
-                                                                            'image_files': extracted_image_files, 
-                                                                            'current_extract': current_extract,
-                                                                            'current_feedback': current_feedback, 
-                                                                        }))
-    
-    current_extract = resp
-    total_tokens += tokens
+    return current_extract, current_feedback, token_usage, convergence.summary()
 
-    responses.append({'AI Agent - Format - Output': resp, 'Response Timestamp': datetime.now().strftime("%m/%d/%Y, %H:%M:%S")})
-    context.set_custom_status(({'Consumed Tokens': total_tokens, 'Final Agent Response': resp}))
 
-    if cosmos_logging:
-        yield context.call_activity("update_status_record", json.dumps({'cosmos_id': context.instance_id, 'response': resp, 'agent': 'format', 'extract': current_extract}))
-    # Format should be separate
+def add_agent_usage(token_usage, usage, spans=None):
+    # Add the usage reported by one agent turn to the running totals, and keep its telemetry spans
+    for key in ['total_tokens', 'prompt_tokens', 'completion_tokens', 'retries', 'retry_wait_seconds']:
+        token_usage[key] += usage.get(key) or 0
+    if spans is not None:
+        spans.extend(usage.get('telemetry', []))
+
+
+def run_format_step(context, thread_id, format_template, current_extract, current_feedback, token_usage, convergence, cosmos_logging, cosmos_id=None, file=None, spans=None, local_formatter='auto', format_template_id=None):
+    """
+    Converts a reviewed extract to the format template, yielding Durable tasks to the calling orchestrator.
+
+    With local_formatter 'auto' the extract is converted by the FormatCoercer of the template and only the fields
+    it cannot convert with confidence are sent to the Formatter agent; 'only' never calls the agent, keeping
+    those fields as extracted (and the whole extract when it is not a JSON object or the template cannot be
+    compiled), and 'off' sends the whole extract to the agent. The conversion runs in the
+    coerce_extract activity, which loads a registered template by `format_template_id` so that the template
+    stays out of the orchestration history.
+
+    Returns:
+    The formatted extract.
+    """
+    formatter_agent_id = os.environ['FORMATTER_AGENT_ID']
 
-    saved_file = yield context.call_activity("save_extract", json.dumps({'result_container': processed_results_container, 'filename': filename, 'extract': current_extract}))
+    # Reference a registered template by ID
+    template = {'template_schema_id': format_template_id} if format_template_id else {'template_schema': format_template}
+
+    formatted = None
+    uncertain_fields = []
+    if local_formatter != 'off' and isinstance(current_extract, dict):
+        coerced = yield context.call_activity("coerce_extract", json.dumps({**template, 'extract': current_extract}))
+        formatted, uncertain_fields = coerced['formatted'], coerced['uncertain_fields']
+
+    resp = formatted
+    usage = {}
+    if formatted is None and local_formatter == 'only':
+        # Nothing could be converted locally, keep the extract as it is rather than calling the agent
+        resp = current_extract
+    elif formatted is None or (len(uncertain_fields) > 0 and local_formatter != 'only'):
+        if formatted is None:
+            agent_extract = current_extract
+        else:
+            # Only send the fields the local conversion was not confident about, along with any data the template
+            # does not know (e.g. the unparsed response of a field group) that their values may be in
+            template = {**template, 'template_fields': uncertain_fields}
+            agent_extract = {name: current_extract.get(name) for name in uncertain_fields + coerced['unknown_fields']}
+
+        # Call with format arguments
+        resp, usage = yield context.call_activity("run_agent_workflow", json.dumps({
+                                                                                'agent': 'format',
+                                                                                'agent_id':formatter_agent_id,
+                                                                                'thread_id': thread_id,
+                                                                                **template,
+                                                                                'current_extract': agent_extract,
+                                                                                'current_feedback': current_feedback, 
+                                                                            }))
+        add_agent_usage(token_usage, usage, spans)
+
+    if formatted is None:
+        current_extract = resp
+    else:
+        if isinstance(resp, dict) and resp is not formatted:
+            formatted.update({name: resp.get(name, formatted[name]) for name in uncertain_fields})
+        current_extract = formatted
 
-    return (saved_file)
+    if formatted is None:
+        formatter = 'agent' if len(usage) > 0 else 'none'
+    else:
+        formatter = 'local' if len(usage) == 0 else 'local+agent'
+    context.set_custom_status(({'Consumed Tokens': token_usage['total_tokens'], 'Estimated Tokens Saved': token_usage['estimated_tokens_saved'], 'Agent Retries': token_usage['retries'], 'Stop Reason': convergence['stop_reason'],
+                                'Formatter': formatter, 'Uncertain Fields': uncertain_fields, 'Final Agent Response': resp}))
+
+    if cosmos_logging:
+        yield context.call_activity("update_status_record", json.dumps({'cosmos_id': cosmos_id or context.instance_id, 'entry_id': f"{context.instance_id}-format", 'file': file, 'response': resp, 'agent': 'format', 'extract': current_extract, 'tokens': usage.get('total_tokens', 0), 'convergence': convergence,
+                                                                       'formatter': formatter, 'uncertain_fields': uncertain_fields}))
+
+    return current_extract
 
 
 
 @app.activity_trigger(input_name="activitypayload")
-def run_agent_workflow(activitypayload: str):
+async def run_agent_workflow(activitypayload: str):
 
     data = json.loads(activitypayload)
     ocr_text = data.get("ocr_text")
     key_value_pairs = data.get("key_value_pairs")
+    image_container = data.get("image_container")
     image_files = data.get("image_files")
     current_extract = data.get("current_extract")
     agent = data.get("agent")
     agent_id = data.get("agent_id")
     thread_id = data.get("thread_id")
-    schema = data.get("template_schema")
     current_feedback = data.get("current_feedback")
+    # When False, the document context was already posted to this thread on an earlier turn
+    include_context = data.get("include_context", True)
+    # Fields that passed an earlier review and have not changed since
+    reviewed_fields = data.get("reviewed_fields") or []
+
+    # Registered schemas are referenced by ID and rendered once per process; inline schemas are rendered here
+    schema_heading = 'Format Template' if agent == 'format' else 'Target Schema'
+    # The Formatter may only be sent the template fields the local formatter could not convert
+    template_fields = data.get("template_fields")
+    if data.get("template_schema_id"):
+        schema_prompt = await get_prompt_prefix(data.get("template_schema_id"), schema_heading, template_fields)
+    else:
+        template_schema = data.get('template_schema')
+        if template_fields is not None and isinstance(template_schema, dict):
+            template_schema = {name: template_schema[name] for name in template_fields if name in template_schema}
+        schema_prompt = f"## {schema_heading}: {render_schema(template_schema)}"
+
+    if agent=='analyze' and not include_context:
+
+        user_prompt = f'''## Current Feedback: {current_feedback}
+
+        -------------------------------------------------------
+
+        Revise your previous extract to address the feedback above. The target schema, document OCR text,
+        key-value pairs and document images were provided earlier in this thread.
+        '''
+    elif agent=='review' and not include_context:
+
+        user_prompt = f'''## Updated Extract: {current_extract}
+
+        -------------------------------------------------------
 
-    if agent=='analyze':
+        ## Reviewed Fields: {reviewed_fields}
 
-        user_prompt = f'''## Target Schema: {schema}
+        -------------------------------------------------------
+
+        Review the updated extract. The target schema, product diagram OCR text, key-value pairs and
+        document images were provided earlier in this thread.
+        '''
+    elif agent=='analyze':
+
+        user_prompt = f'''{schema_prompt}
 
         -------------------------------------------------------
         
@@ -314,7 +942,7 @@ def run_agent_workflow(activitypayload: str):
         '''
     elif agent=='review':
 
-        user_prompt = f'''## Target Schema: {schema}
+        user_prompt = f'''{schema_prompt}
 
         -------------------------------------------------------
 
@@ -330,11 +958,15 @@ def run_agent_workflow(activitypayload: str):
 
         -------------------------------------------------------
 
+        ## Reviewed Fields: {reviewed_fields}
+
+        -------------------------------------------------------
+
         '''
 
     elif agent=='format':
             
-        user_prompt = f'''## Format Template: {schema}
+        user_prompt = f'''{schema_prompt}
 
         -------------------------------------------------------
 
@@ -345,49 +977,137 @@ def run_agent_workflow(activitypayload: str):
     # img_url = f"data:image/png;base64,{image_base64}"
     # url_param = MessageImageUrlParam(url=img_url, detail="high")
 
-    project_client = AIProjectClient.from_connection_string(
-        credential=DefaultAzureCredential(),
-        conn_str=os.environ['AZURE_AI_FOUNDRY_CONNECTION_STRING'],
-    )
+    project_client = get_async_project_client()
+
+    with stage_span(f'agent.{agent}', thread_id=thread_id, include_context=include_context) as span:
+        span.add('prompt_bytes', len(user_prompt))
+        if agent!='format' and include_context:
+            content_blocks: List[MessageInputContentBlock] = [
+                MessageInputTextBlock(text=user_prompt),
+                # MessageInputImageUrlBlock(image_url=url_param),
+            ]
+            # Page images are passed by blob name and only resolved here, inside the activity
+            images = await load_page_images_async(image_container, [x['file'] for x in image_files])
+            for image_file, image in zip(image_files, images):
+                span.add('bytes_read', len(image))
+                span.add('image_tokens', image_file.get('tokens', 0))
+                img_url = f"data:{image_mime_type(image_file['file'])};base64,{image}"
+                url_param = MessageImageUrlParam(url=img_url, detail=image_file.get('detail', 'high'))
+                content_blocks.append(MessageInputImageUrlBlock(image_url=url_param))
     
-    if agent!='format':
-        content_blocks: List[MessageInputContentBlock] = [
-            MessageInputTextBlock(text=user_prompt),
-            # MessageInputImageUrlBlock(image_url=url_param),
-        ]
-        for image in image_files:
-            img_url = f"data:image/png;base64,{image['image']}"
-            url_param = MessageImageUrlParam(url=img_url, detail="high")
-            content_blocks.append(MessageInputImageUrlBlock(image_url=url_param))
-    
-        message = project_client.agents.create_message(thread_id=thread_id, role="user", content=content_blocks)
+            message = await project_client.agents.create_message(thread_id=thread_id, role="user", content=content_blocks)
+        else:
+            message = await project_client.agents.create_message(thread_id=thread_id, role="user", content=[MessageInputTextBlock(text=user_prompt)])
+
+        async def run_agent():
+            # Polling for the run to finish awaits instead of blocking a worker thread
+            agent_run = await project_client.agents.create_and_process_run(thread_id=thread_id, agent_id=agent_id, response_format={ "type": "json_object" })
+            if agent_run.status == 'failed':
+                # Failed runs (e.g. rate limits or server errors) are transient, start a new run on the same thread
+                raise RetryableError(f'Agent run {agent_run.id} failed: {agent_run.last_error}')
+            return agent_run
+
+        retry_stats = RetryStats()
+        agent_run = await get_retry_policy('agents').call_async(run_agent, retry_stats=retry_stats)
+
+        messages = await project_client.agents.list_messages(thread_id=thread_id)
+        last_msg = messages.get_last_text_message_by_role(role="assistant")
+        msg = last_msg.text.value.replace('```json', '').replace('```', '')
+        span.set(prompt_tokens=agent_run.usage.prompt_tokens, completion_tokens=agent_run.usage.completion_tokens, total_tokens=agent_run.usage.total_tokens,
+                 retries=retry_stats.retries, retry_wait_seconds=round(retry_stats.wait_seconds, 3), response_bytes=len(msg))
+
+    usage = {'prompt_tokens': agent_run.usage.prompt_tokens, 'completion_tokens': agent_run.usage.completion_tokens, 'total_tokens': agent_run.usage.total_tokens,
+             'retries': retry_stats.retries, 'retry_wait_seconds': retry_stats.wait_seconds, 'telemetry': [span.to_dict()]}
+    try:
+        return json.loads(msg), usage
+    except Exception as e:
+        return msg, usage
+
+
+@app.activity_trigger(input_name="activitypayload")
+async def register_schemas(activitypayload: str):
+
+    # Load the activity payload as a JSON string
+    data = json.loads(activitypayload)
+
+    # Schemas given inline are registered, otherwise the registered IDs or the default schema files are used
+    target_schema_id = await resolve_schema(data.get("target_schema"), data.get("target_schema_id"), 'schema.json')
+    schema_types_id = await resolve_schema(data.get("schema_types"), data.get("schema_types_id"), 'format.json')
+
+    # Register the schema of every field group, so that the groups are referenced by ID as well
+    field_groups = split_schema_fields(await load_schema(target_schema_id), data.get("field_groups"), int(data.get("max_field_groups") or 1))
+    field_group_ids = [target_schema_id] if len(field_groups) == 1 else [await register_schema(group) for group in field_groups]
+
+    # The orchestrations only see the estimated size of every field group schema, to report the tokens saved
+    field_group_tokens = [estimate_schema_tokens(group) for group in field_groups]
+
+    return {'target_schema_id': target_schema_id, 'schema_types_id': schema_types_id, 'field_group_ids': field_group_ids, 'field_group_tokens': field_group_tokens}
+
+@app.activity_trigger(input_name="activitypayload")
+async def coerce_extract(activitypayload: str):
+    """
+    Converts an extract to the types of a format template with its FormatCoercer, without an agent run.
+
+    Returns:
+    dict: The formatted extract (None when the template cannot be compiled), the template fields that could not
+    be converted with confidence, and the keys of the extract the template does not know.
+    """
+    # Load the activity payload as a JSON string
+    data = json.loads(activitypayload)
+    extract = data.get("extract")
+
+    if data.get("template_schema_id"):
+        template = await load_schema(data.get("template_schema_id"))
     else:
-        message = project_client.agents.create_message(thread_id=thread_id, role="user", content=[MessageInputTextBlock(text=user_prompt)])
+        template = data.get("template_schema")
 
-    processed = False
-    while not processed:
-        try:
+    try:
+        coercer = get_format_coercer(template)
+    except ValueError as e:
+        logging.warning(f'Unable to compile the format template, using the Formatter agent: {e}')
+        return {'formatted': None, 'uncertain_fields': [], 'unknown_fields': []}
 
-            agent_run = project_client.agents.create_and_process_run(thread_id=thread_id, agent_id=agent_id, response_format={ "type": "json_object" })
+    formatted, uncertain_fields = coercer.coerce(extract)
+    return {'formatted': formatted, 'uncertain_fields': uncertain_fields, 'unknown_fields': [name for name in extract if name not in coercer.template]}
 
-            print(agent_run.usage, flush=True)
-            messages = project_client.agents.list_messages(thread_id=thread_id)
-            last_msg = messages.get_last_text_message_by_role(role="assistant")
-            print(last_msg, flush=True)
-            print(type(last_msg), flush=True)
-            msg = last_msg.text.value.replace('```json', '').replace('```', '')
-            try:
-                return json.loads(msg), agent_run.usage.total_tokens
-            except Exception as e:
-                return msg
+@app.activity_trigger(input_name="activitypayload")
+async def create_agent_threads(activitypayload: str):
+
+    # Load the activity payload as a JSON string
+    data = json.loads(activitypayload)
+    agents = data.get("agents")
+
+    project_client = get_async_project_client()
+
+    # Create one thread per agent and return the thread IDs keyed by agent
+    created_threads = await asyncio.gather(*[project_client.agents.create_thread() for agent in agents])
+
+    return {agent: thread.id for agent, thread in zip(agents, created_threads)}
+
+@app.activity_trigger(input_name="activitypayload")
+async def delete_agent_threads(activitypayload: str):
+
+    # Load the activity payload as a JSON string
+    data = json.loads(activitypayload)
+    thread_ids = data.get("thread_ids")
+
+    project_client = get_async_project_client()
+
+    async def delete_thread(thread_id):
+        try:
+            await project_client.agents.delete_thread(thread_id)
+            return thread_id
         except Exception as e:
-            time.sleep(5)
-            print('Run Failed. Retrying...', flush=True)
-            pass
+            # A failed cleanup should never fail the orchestration
+            logging.warning(f'Failed to delete thread {thread_id}: {e}')
+            return None
 
+    deleted = await asyncio.gather(*[delete_thread(thread_id) for thread_id in thread_ids])
+
+    return [thread_id for thread_id in deleted if thread_id is not None]
 
 @app.activity_trigger(input_name="activitypayload")
-def get_source_files(activitypayload: str):
+async def get_source_files(activitypayload: str):
 
     # Load the activity payload as a JSON string
     data = json.loads(activitypayload)
@@ -397,37 +1117,32 @@ def get_source_files(activitypayload: str):
     extensions = data.get("extensions")
     prefix = data.get("prefix")
     
-    # Create a BlobServiceClient object which will be used to create a container client
-    blob_service_client = BlobServiceClient.from_connection_string(os.environ['STORAGE_CONN_STR'])
-    
-    try:
-        # Get a ContainerClient object from the BlobServiceClient
-        container_client = blob_service_client.get_container_client(source_container)
-        # List all blobs in the container that start with the specified prefix
-        blobs = container_client.list_blobs(name_starts_with=prefix)
+    # Get the shared BlobServiceClient object which will be used to create a container client
+    blob_service_client = get_async_blob_service_client()
 
-    except Exception as e:
-        # If the container does not exist, return an empty list
-        return []
-
-    if not container_client.exists():
-        return []
-    
     # Initialize an empty list to store the names of the files
     files = []
 
-    # For each blob in the container
-    for blob in blobs:
-        # If the blob's name ends with the specified extension
-        if '.' + blob.name.lower().split('.')[-1] in extensions:
-            # Append the blob's name to the files list
-            files.append(blob.name)
+    with stage_span('list_files', container=source_container) as span:
+        # Get a ContainerClient object from the BlobServiceClient
+        container_client = blob_service_client.get_container_client(source_container)
+
+        # If the container does not exist, return an empty list
+        if await container_client.exists():
+            # For each blob in the container that starts with the specified prefix
+            async for blob in container_client.list_blobs(name_starts_with=prefix):
+                span.add('blobs_listed', 1)
+                # If the blob's name ends with the specified extension
+                if '.' + blob.name.lower().split('.')[-1] in extensions:
+                    # Append the blob's name to the files list
+                    files.append(blob.name)
+        span.set(files=len(files))
 
     # Return the list of file names
-    return files
+    return {'files': files, 'telemetry': [span.to_dict()]}
 
 @app.activity_trigger(input_name="activitypayload")
-def process_pdf_with_document_intelligence(activitypayload: str):
+async def process_pdf_with_document_intelligence(activitypayload: str):
     """
     Process a PDF file using Document Intelligence.
 
@@ -446,45 +1161,69 @@ def process_pdf_with_document_intelligence(activitypayload: str):
     container = data.get("container")
     doc_intel_results_container = data.get("doc_intel_results_container")
     doc_intel_model = data.get("doc_intel_model")
+    schema_id = data.get("target_schema_id")
+    field_group_ids = data.get("field_group_ids") or [schema_id]
+    page_routing_top_k = int(data.get("page_routing_top_k") or 0)
+    page_routing_fallback = data.get("page_routing_fallback") or "full"
+    image_crop = data.get("image_crop")
 
-    # Create a BlobServiceClient object which will be used to create a container client
-    blob_service_client = BlobServiceClient.from_connection_string(os.environ['STORAGE_CONN_STR'])
+    # Get the shared BlobServiceClient object which will be used to create a container client
+    blob_service_client = get_async_blob_service_client()
 
     pdf_blob_client = blob_service_client.get_blob_client(container, file)
 
     # Get a ContainerClient object for the pages, Document Intelligence results, and DI formatted results containers
     doc_intel_results_container_client = blob_service_client.get_container_client(container=doc_intel_results_container)
 
-    # Initialize a flag to indicate whether the PDF file has been processed
-    processed = False
-
     # Create a new file name for the processed PDF file
     updated_filename = file.replace('.pdf', '.json')
 
     # Get a BlobClient object for the Document Intelligence results file
-    doc_results_blob_client = doc_intel_results_container_client.get_blob_client(blob=updated_filename)
-    # Check if the Document Intelligence results file exists
-    if doc_results_blob_client.exists():
+    doc_intel_result_client = doc_intel_results_container_client.get_blob_client(updated_filename)
 
-        # Get a BlobClient object for the Document Intelligence results file
-        doc_intel_result_client = doc_intel_results_container_client.get_blob_client(updated_filename)
+    retry_stats = RetryStats()
 
-        doc_intel_result = json.loads(doc_intel_result_client.download_blob().readall())
-
-    # If the PDF file has not been processed
-    else:
-        # Extract the PDF file with AFR, save the AFR results, and save the extract results
+    with stage_span('doc_intel', file=file) as span, track_peak_memory(span):
+        # Spool the PDF to a local file shared with save_pdf_images, and key the results by the content of the
+        # PDF (plus model and API version) rather than its name, from the digest computed while spooling
+        async with spooled_pdf(pdf_blob_client, span) as pdf:
+            cache_key = digest_cache_key(pdf.sha256, doc_intel_model or DEFAULT_DOC_INTEL_MODEL, DOC_INTEL_API_VERSION)
 
-        # Download the PDF file
-        pdf_data = pdf_blob_client.download_blob().readall()
-        # Analyze the PDF file with Document Intelligence
-        doc_intel_result = analyze_pdf(pdf_data, doc_intel_model)
+            # Check if the per-file results were produced from this exact revision of the PDF
+            try:
+                file_cache_key = (await doc_intel_result_client.get_blob_properties()).metadata.get('cachekey')
+            except ResourceNotFoundError:
+                file_cache_key = None
 
-        # Get a BlobClient object for the Document Intelligence results file
-        doc_intel_result_client = doc_intel_results_container_client.get_blob_client(updated_filename)
+            if file_cache_key == cache_key:
+                serialized_result = await (await doc_intel_result_client.download_blob()).readall()
+                span.add('bytes_read', len(serialized_result))
+                span.set(cache='file')
+                doc_intel_result = json.loads(serialized_result)
 
-        # Upload the Document Intelligence results to the Document Intelligence results container
-        doc_intel_result_client.upload_blob(json.dumps(doc_intel_result, default=custom_serializer), overwrite=True)
+            else:
+                # Reuse the results of a byte-identical PDF analyzed under any name, otherwise analyze it
+                serialized_result = await get_cached_result(doc_intel_results_container_client, cache_key)
+                if serialized_result is None:
+                    span.set(cache='miss')
+                    # Analyze the PDF file with Document Intelligence
+                    # Large PDFs are analyzed in page-range chunks running concurrently, then stitched back together
+                    doc_intel_result, chunk_count = await analyze_pdf_chunked_async(pdf.path, doc_intel_model, int(os.getenv('DOC_INTEL_CHUNK_PAGES', 50)),
+                                                                                        int(os.getenv('DOC_INTEL_CHUNK_CONCURRENCY', 4)), retry_stats=retry_stats)
+                    span.set(chunks=chunk_count)
+                    serialized_result = json.dumps(doc_intel_result, default=custom_serializer)
+                    await put_cached_result(doc_intel_results_container_client, cache_key, serialized_result, file)
+                    span.add('bytes_written', len(serialized_result))
+                else:
+                    span.set(cache='shared')
+                    span.add('bytes_read', len(serialized_result))
+                    doc_intel_result = json.loads(serialized_result)
+
+                # Upload the Document Intelligence results to the Document Intelligence results container
+                await doc_intel_result_client.upload_blob(serialized_result, overwrite=True, metadata={'cachekey': cache_key})
+                span.add('bytes_written', len(serialized_result))
+
+        span.set(retries=retry_stats.retries, retry_wait_seconds=round(retry_stats.wait_seconds, 3))
 
     document_key_values = {}
     # for item in doc_intel_result['keyValuePairs']:
@@ -494,66 +1233,100 @@ def process_pdf_with_document_intelligence(activitypayload: str):
     #         pass
     
     
-    return {'OCR': doc_intel_result['content'], 'DefaultDocumentExtract': document_key_values, 'file': file}
+    result = {'OCR': doc_intel_result['content'], 'DefaultDocumentExtract': document_key_values, 'file': file, 'retries': retry_stats.as_dict(), 'telemetry': [span.to_dict()]}
+
+    if page_routing_top_k > 0:
+        # Score the pages for every schema field and only return the text of the selected pages
+        with stage_span('page_routing', file=file, top_k=page_routing_top_k) as routing_span:
+            page_texts = {page_number: text for page_number, text, _, _ in extract_results(doc_intel_result, file)}
+            routing = route_pages(await load_schema(schema_id), doc_intel_result, page_texts, page_routing_top_k, page_routing_fallback)
+            # The pages of every field group, so that the orchestration routes pages without loading the schemas
+            routing['group_pages'] = [select_pages(routing, await load_schema(group_id)) for group_id in field_group_ids]
+            routing_span.set(pages=routing['page_count'], routed_pages=len(routing['pages']), fallback_fields=len(routing['fallback_fields']))
+        routed_texts = {str(page): page_texts[page] for page in routing['pages']}
+        result.update({'OCR': join_page_text(routed_texts, routing['pages']), 'pages': routed_texts, 'routing': routing})
+        result['telemetry'].append(routing_span.to_dict())
+
+    if image_crop:
+        # Regions the page images are cropped to, as fractions of the page
+        result['regions'] = region_boxes(doc_intel_result, image_crop)
+
+    return result
 
     # Return the updated file name
     return updated_filename
 
 
 @app.activity_trigger(input_name="activitypayload")
-def save_pdf_images(activitypayload: str):
+async def save_pdf_images(activitypayload: str):
 
     data = json.loads(activitypayload)
     source_container = data.get('source_container')
     filename = data.get('filename')
-
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv('STORAGE_CONN_STR'))
+    # Rendering resolution and concurrency can be set per request or for the whole app
+    dpi = int(data.get('dpi') or os.getenv('PDF_IMAGE_DPI', 100))
+    max_workers = int(data.get('max_workers') or os.getenv('PDF_IMAGE_WORKERS', 1))
+    max_buffered = int(data.get('max_buffered') or os.getenv('PDF_IMAGE_MAX_BUFFERED', 4))
+    profile = get_image_profile(data.get('image_profile'))
+    # Crop boxes come back from the orchestration history keyed by strings
+    regions = {int(page_number): box for page_number, box in (data.get('regions') or {}).items()}
+
+    blob_service_client = get_async_blob_service_client()
     container_client = blob_service_client.get_container_client(source_container)   
     blob_client = container_client.get_blob_client(filename)
 
-    data = blob_client.download_blob().readall()
-
-    pdf_reader = PdfReader(BytesIO(data))
+    with stage_span('rasterize', file=filename, dpi=dpi, color=profile.color, format=profile.format) as span, track_peak_memory(span):
+        # Render from the local spool file shared with process_pdf_with_document_intelligence
+        async with spooled_pdf(blob_client, span) as pdf:
+            pages = await render_and_upload_pages(blob_service_client, source_container, filename, pdf.path, dpi, max_workers, span, profile, regions, max_buffered)
 
-    # Get the number of pages in the PDF file
-    num_pages = len(pdf_reader.pages)
+    # Return references to the uploaded images only, so that the image data never enters the orchestration history,
+    # together with the size and estimated prompt tokens of every image
+    return {'images': [{**page, 'page': index + 1} for index, page in enumerate(pages)], 'telemetry': [span.to_dict()]}
 
+async def render_and_upload_pages(blob_service_client, source_container, filename, source, dpi, max_workers, span, profile=None, regions=None, max_buffered=None):
+    """
+    Renders every page of a PDF (given as its bytes or the path of a local copy) and uploads each page image
+    as soon as it is rendered, recording the bytes written and estimated image tokens on the span. Rendering
+    waits while max_buffered rendered pages (4 by default) are still uploading, so that at most that many page
+    images are held in memory at once. Returns the name, size, bytes and estimated tokens of every
+    page image in page order.
+    """
+    profile = profile or ImageProfile()
     images_container_name = f"{source_container}-images"
     images_container = blob_service_client.get_container_client(images_container_name)
 
-    image_files = []
-
-    # For each page in the PDF file
-    for i in range(num_pages):
-        # Create a new file name for the PDF chunk
-        new_file_name = filename.replace('.pdf', '') + '_page_' + str(i+1) + '.png'
-
-        # Create a PdfWriter object
-        pdf_writer = PdfWriter()
-        # Add the page to the PdfWriter object
-        pdf_writer.add_page(pdf_reader.pages[i])
+    page_images = {}
+    uploads = []
+    loop = asyncio.get_running_loop()
+    buffered = threading.BoundedSemaphore(max(1, int(max_buffered or 4)))
 
-        # Create a BytesIO object for the output stream
-        output_stream = BytesIO()
-        # Write the PdfWriter object to the output stream
-        pdf_writer.write(output_stream)
-
-        # Reset the position of the output stream to the beginning
-        output_stream.seek(0)
-
-        png_bytes = pdf_bytes_to_png_bytes(output_stream)
-
-        images_blob_client = images_container.get_blob_client(new_file_name)
-        images_blob_client.upload_blob(png_bytes.read(), overwrite=True)
-
-        data = images_blob_client.download_blob().readall()
-
-        image_files.append({'file': new_file_name, 'image': base64.b64encode(data).decode('utf-8')})
-
-    return image_files
+    async def upload_page(page_index, image_bytes, info):
+        try:
+            # Create a new file name for the page image
+            new_file_name = filename.replace('.pdf', '') + '_page_' + str(page_index+1) + '.' + profile.extension
+            await images_container.get_blob_client(new_file_name).upload_blob(image_bytes, overwrite=True)
+            span.add('bytes_written', len(image_bytes))
+            span.add('image_tokens', info['tokens'])
+            page_images[page_index] = {'file': new_file_name, **info}
+        finally:
+            buffered.release()
+
+    def on_page(page_index, image_bytes, info):
+        # Called from the render thread, hand each page to the event loop for upload as soon as it is rendered,
+        # waiting first for a free upload slot
+        buffered.acquire()
+        uploads.append(asyncio.run_coroutine_threadsafe(upload_page(page_index, image_bytes, info), loop))
+
+    # Render all pages off the event loop (in worker processes for several workers), then wait for the remaining uploads
+    pages = await asyncio.to_thread(render_pdf_pages, source, dpi, max_workers, on_page, profile, regions)
+    await asyncio.gather(*[asyncio.wrap_future(upload) for upload in uploads])
+    span.set(pages=len(pages))
+
+    return [page_images[i] for i in range(len(pages))]
 
 @app.activity_trigger(input_name="activitypayload")
-def check_containers(activitypayload: str):
+async def check_containers(activitypayload: str):
 
     # Load the activity payload as a JSON string
     data = json.loads(activitypayload)
@@ -565,29 +1338,22 @@ def check_containers(activitypayload: str):
     document_intelligence_results_container = f"{source_container}-document-intelligence-results"
     processed_results_container = f"{source_container}-processed-results"
     
-    # Create a BlobServiceClient object which will be used to create a container client
-    blob_service_client = BlobServiceClient.from_connection_string(os.environ['STORAGE_CONN_STR'])
-
-    try:
-        blob_service_client.create_container(image_container)
-    except Exception as e:
-        pass
+    # Get the shared BlobServiceClient object which will be used to create a container client
+    blob_service_client = get_async_blob_service_client()
 
-    try:
-        blob_service_client.create_container(document_intelligence_results_container)
-    except Exception as e:
-        pass
+    async def create_container(container_name):
+        try:
+            await blob_service_client.create_container(container_name)
+        except Exception as e:
+            pass
 
-    try:
-        blob_service_client.create_container(processed_results_container)
-    except Exception as e:
-        pass
+    with stage_span('check_containers', container=source_container) as span:
+        await asyncio.gather(create_container(image_container), create_container(document_intelligence_results_container), create_container(processed_results_container))
 
-    # Return the list of file names
-    return True
+    return {'telemetry': [span.to_dict()]}
 
 @app.activity_trigger(input_name="activitypayload")
-def save_extract(activitypayload: str):
+async def save_extract(activitypayload: str):
 
     # Load the activity payload as a JSON string
     data = json.loads(activitypayload)
@@ -597,7 +1363,7 @@ def save_extract(activitypayload: str):
     filename = data.get("filename")
     extract = data.get("extract")
     
-    blob_service_client = BlobServiceClient.from_connection_string(os.environ['STORAGE_CONN_STR'])
+    blob_service_client = get_async_blob_service_client()
 
     container_client = blob_service_client.get_container_client(result_container)
 
@@ -605,81 +1371,92 @@ def save_extract(activitypayload: str):
 
     blob_client = container_client.get_blob_client(updated_filename)
 
-    blob_client.upload_blob(json.dumps(extract), overwrite=True)
+    with stage_span('save_extract', file=filename) as span:
+        serialized_extract = json.dumps(extract)
+        await blob_client.upload_blob(serialized_extract, overwrite=True)
+        span.add('bytes_written', len(serialized_extract))
 
-    return updated_filename
+    return {'file': updated_filename, 'telemetry': [span.to_dict()]}
 
 @app.activity_trigger(input_name="activitypayload")
-def create_status_record(activitypayload: str):
+async def create_status_record(activitypayload: str):
 
     # Load the activity payload as a JSON string
     data = json.loads(activitypayload)
     record = data.get("record")
     cosmos_id = data.get("cosmos_id")
-    cosmos_container = os.environ['COSMOS_CONTAINER']
-    cosmos_database = os.environ['COSMOS_DATABASE']
-    cosmos_endpoint = os.environ['COSMOS_ENDPOINT']
-    cosmos_key = os.environ['COSMOS_KEY']
     record['id'] = cosmos_id
 
     data['id'] = cosmos_id
 
-    client = CosmosClient(cosmos_endpoint, cosmos_key)
+    # Make sure the status log container exists, agent responses are appended there as separate items
+    await get_async_cosmos_database().create_container_if_not_exists(id=get_status_log_container_name(), partition_key=PartitionKey(path='/orchestration_id'))
 
-    # Select the database
-    database = client.get_database_client(cosmos_database)
-
-    # Select the container
-    container = database.get_container_client(cosmos_container)
+    # Select the status container
+    container = get_async_cosmos_container()
 
     # response = container.read_item(item=cosmos_id)
-    response = container.create_item(record)
+    response = await container.create_item(record)
     if type(response) == dict:
         return response
     return json.loads(response)
 
 
 @app.activity_trigger(input_name="activitypayload")
-def update_status_record(activitypayload: str):
+async def save_status_telemetry(activitypayload: str):
+
+    # Load the activity payload as a JSON string
+    data = json.loads(activitypayload)
+    cosmos_id = data.get("cosmos_id")
+
+    # Store the per-stage telemetry summary of the orchestration on its status record
+    container = get_async_cosmos_container()
+    await container.patch_item(item=cosmos_id, partition_key=cosmos_id, patch_operations=[{'op': 'set', 'path': '/telemetry', 'value': data.get("telemetry")}])
+
+    return True
+
+@app.activity_trigger(input_name="activitypayload")
+async def update_status_record(activitypayload: str):
 
     # Load the activity payload as a JSON string
     data = json.loads(activitypayload)
     response = data.get("response")
     agent = data.get("agent")
     tokens = data.get("tokens")
+    entry_id = data.get("entry_id")
     timestamp = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
     cosmos_id = data.get("cosmos_id")
     final_response = None
     if 'extract' in data.keys():
         final_response = data.get("extract")
 
-    cosmos_container = os.environ['COSMOS_CONTAINER']
-    cosmos_database = os.environ['COSMOS_DATABASE']
-    cosmos_endpoint = os.environ['COSMOS_ENDPOINT']
-    cosmos_key = os.environ['COSMOS_KEY']
-
-    client = CosmosClient(cosmos_endpoint, cosmos_key)
-
-    # Select the database
-    database = client.get_database_client(cosmos_database)
-
-    # Select the container
-    container = database.get_container_client(cosmos_container)
-
-    # Retrieve the existing record from Cosmos DB
-    existing_record = container.read_item(item=cosmos_id, partition_key=cosmos_id)
-
-    # Update the attribute on the retrieved record
-    if 'responses' not in existing_record:
-        existing_record['responses'] = []  
-
-    existing_record['responses'].append({'agent': agent, 'response': response, 'timestamp': timestamp})
-    # existing_record['tokens_consumed'] += tokens
-
+    # Append the response to the status log as its own item, so the cost of each update stays constant
+    # as the run progresses. The entry ID is deterministic, so a retried activity overwrites its own entry.
+    log_container = get_async_cosmos_container(get_status_log_container_name())
+    await log_container.upsert_item({
+        'id': entry_id,
+        'orchestration_id': cosmos_id,
+        'agent': agent,
+        'file': data.get("file"),
+        'response': response,
+        'tokens': tokens,
+        'convergence': data.get("convergence"),
+        'formatter': data.get("formatter"),
+        'uncertain_fields': data.get("uncertain_fields"),
+        'extract': final_response,
+        'timestamp': timestamp,
+        'logged_at': datetime.now(timezone.utc).isoformat(),
+    })
+
+    # Patch the running totals (and the final extract of the file) on the status record without reading it back.
+    # Every document of the orchestration shares the record, so extracts are kept per file; '~' and '/' in file
+    # names are escaped as the patch path is a JSON pointer.
+    patch_operations = [{'op': 'incr', 'path': '/tokens_consumed', 'value': tokens or 0}]
     if final_response is not None:
-        existing_record['extract'] = final_response
+        file_key = str(data.get("file")).replace('~', '~0').replace('/', '~1')
+        patch_operations.append({'op': 'set', 'path': f'/extracts/{file_key}', 'value': final_response})
 
-    # Upsert the updated record back into Cosmos DB
-    container.upsert_item(existing_record)
+    container = get_async_cosmos_container()
+    await container.patch_item(item=cosmos_id, partition_key=cosmos_id, patch_operations=patch_operations)
 
-    return True
\ No newline at end of file
+    return True
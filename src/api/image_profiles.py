@@ -0,0 +1,226 @@
+import io
+import json
+import math
+import os
+import fitz as pymupdf
+from PIL import Image
+from pdf_spool import PYMUPDF_LOCK, open_pdf
+
+# Vision models bill high detail images by 512 pixel tiles, after scaling them to fit within a 2048 x 2048
+# square and then so that their shortest side is at most 768 pixels. Low detail images cost the base tokens only.
+TILE_SIZE = 512
+MAX_DIMENSION = 2048
+MAX_SHORT_SIDE = 768
+BASE_TOKENS = 85
+TILE_TOKENS = 170
+
+# An image overshooting a tile boundary by at most this share of a tile is shrunk to the boundary when tile aligning
+TILE_SLACK = 0.1
+
+# Margin added around cropped regions, as a share of the page size
+CROP_MARGIN = 0.02
+
+# Formats the page images can be encoded in, with their file extension and MIME type
+IMAGE_FORMATS = {
+    'png': ('png', 'image/png'),
+    'jpeg': ('jpg', 'image/jpeg'),
+    'webp': ('webp', 'image/webp'),
+}
+
+class ImageProfile:
+    """
+    How page images are rendered and encoded for the agents.
+
+    Args:
+    color (str): 'rgb', 'grayscale' or 'bilevel' (black and white, suited to line drawings).
+    format (str): 'png', 'jpeg' or 'webp'.
+    quality (int): The JPEG or WebP quality.
+    max_long_edge (int): Resize pages so that their longest side is at most this many pixels, 0 for no limit.
+    tile_align (bool): Resize pages to the size the model scales them to, shrinking them to a tile boundary
+    when they barely cross one, so that no pixels are sent that only add bytes or tiles.
+    detail (str): The detail level requested from the model, 'high', 'low' or 'auto'.
+    crop (str): Crop pages to regions found by Document Intelligence: 'tables' for all tables on the page or
+    'title_block' for the table closest to the bottom right corner. Pages without tables are not cropped.
+    threshold (int): The gray level below which pixels are black in bilevel images.
+    """
+
+    def __init__(self, color='rgb', format='png', quality=80, max_long_edge=0, tile_align=False, detail='high', crop=None, threshold=192):
+        if format not in IMAGE_FORMATS:
+            raise ValueError(f'Unsupported image format {format}')
+        self.color = color
+        self.format = format
+        self.quality = quality
+        self.max_long_edge = max_long_edge
+        self.tile_align = tile_align
+        self.detail = detail
+        self.crop = crop
+        self.threshold = threshold
+
+    @property
+    def extension(self):
+        return IMAGE_FORMATS[self.format][0]
+
+    def to_dict(self):
+        return dict(vars(self))
+
+# Built-in profiles, 'default' keeps the original lossless RGB PNG pages
+IMAGE_PROFILES = {
+    'default': {},
+    'grayscale': {'color': 'grayscale', 'tile_align': True},
+    'line_art': {'color': 'bilevel', 'tile_align': True},
+    'jpeg': {'color': 'grayscale', 'format': 'jpeg', 'quality': 75, 'tile_align': True},
+    'webp': {'color': 'grayscale', 'format': 'webp', 'quality': 70, 'tile_align': True},
+    'title_block': {'color': 'grayscale', 'tile_align': True, 'crop': 'title_block'},
+}
+
+def get_image_profile(spec=None):
+    """
+    Returns the image profile for a built-in profile name, a dictionary of profile settings or a JSON string of
+    one, e.g. '{"color": "bilevel", "format": "webp"}'. Defaults to the IMAGE_PROFILE setting.
+    """
+    spec = spec if spec is not None else os.getenv('IMAGE_PROFILE', 'default')
+    if isinstance(spec, str):
+        spec = json.loads(spec) if spec.strip().startswith('{') else IMAGE_PROFILES[spec]
+    return ImageProfile(**spec)
+
+def model_image_size(width, height):
+    # The size a high detail image is scaled down to by the model before it is split into tiles
+    scale = min(1.0, MAX_DIMENSION / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, MAX_SHORT_SIDE / min(width, height))
+    return width * scale, height * scale
+
+def estimate_image_tokens(width, height, detail='high'):
+    """Estimates the prompt tokens of an image: 85 + 170 per 512 pixel tile of the scaled image."""
+    if detail == 'low' or width <= 0 or height <= 0:
+        return BASE_TOKENS
+    width, height = model_image_size(width, height)
+    return BASE_TOKENS + TILE_TOKENS * math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+
+def target_image_size(width, height, profile):
+    """
+    Returns the size a page rendered at width x height pixels is encoded at under a profile.
+    """
+    scale = 1.0
+    if profile.max_long_edge:
+        scale = min(scale, profile.max_long_edge / max(width, height))
+    if profile.tile_align and profile.detail != 'low':
+        model_width, _ = model_image_size(width * scale, height * scale)
+        scale *= model_width / (width * scale)
+        snap = 1.0
+        for dimension in (width * scale, height * scale):
+            tiles = math.ceil(dimension / TILE_SIZE)
+            if tiles > 1 and dimension - (tiles - 1) * TILE_SIZE <= TILE_SLACK * TILE_SIZE:
+                snap = min(snap, (tiles - 1) * TILE_SIZE / dimension)
+        scale *= snap
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def region_boxes(doc_intel_result, crop):
+    """
+    Finds the region of every page to crop the page image to, from the table bounding regions of a
+    Document Intelligence result.
+
+    Args:
+    doc_intel_result (dict): The Document Intelligence result.
+    crop (str): 'tables' or 'title_block', see ImageProfile.
+
+    Returns:
+    regions (dict): For every page number with a table, the crop box as [x0, y0, x1, y1] fractions of the page.
+    """
+    sizes = {page['pageNumber']: (page.get('width') or 0, page.get('height') or 0) for page in doc_intel_result.get('pages') or []}
+    boxes = {}
+    for table in doc_intel_result.get('tables') or []:
+        for region in table.get('boundingRegions') or []:
+            width, height = sizes.get(region['pageNumber'], (0, 0))
+            polygon = region.get('polygon') or []
+            if width <= 0 or height <= 0 or len(polygon) < 4:
+                continue
+            xs, ys = polygon[0::2], polygon[1::2]
+            boxes.setdefault(region['pageNumber'], []).append([min(xs) / width, min(ys) / height, max(xs) / width, max(ys) / height])
+
+    regions = {}
+    for page_number, page_boxes in boxes.items():
+        if crop == 'title_block':
+            # Title blocks sit in the bottom right corner of engineering drawings
+            box = min(page_boxes, key=lambda b: (1 - b[2]) ** 2 + (1 - b[3]) ** 2)
+        else:
+            box = [min(b[0] for b in page_boxes), min(b[1] for b in page_boxes), max(b[2] for b in page_boxes), max(b[3] for b in page_boxes)]
+        regions[page_number] = [max(0.0, box[0] - CROP_MARGIN), max(0.0, box[1] - CROP_MARGIN), min(1.0, box[2] + CROP_MARGIN), min(1.0, box[3] + CROP_MARGIN)]
+    return regions
+
+def render_page_image(page, dpi, profile, region=None):
+    """
+    Renders a PyMuPDF page (or a region of it) and encodes it under a profile, holding PYMUPDF_LOCK while
+    rendering.
+
+    Args:
+    page (Page): The PyMuPDF page.
+    dpi (int): The rendering resolution, before any resizing by the profile.
+    profile (ImageProfile): The image profile.
+    region (list): Optional [x0, y0, x1, y1] fractions of the page to crop to.
+
+    Returns:
+    image_bytes (bytes): The encoded image.
+    info (dict): The width and height of the image, its size in bytes and its estimated prompt tokens.
+    """
+    with PYMUPDF_LOCK:
+        clip = page.rect
+        if region is not None:
+            clip = pymupdf.Rect(page.rect.x0 + region[0] * page.rect.width, page.rect.y0 + region[1] * page.rect.height,
+                                page.rect.x0 + region[2] * page.rect.width, page.rect.y0 + region[3] * page.rect.height)
+
+        # Render straight at the target size rather than resampling a larger rendering
+        zoom = dpi / 72
+        width, height = target_image_size(clip.width * zoom, clip.height * zoom, profile)
+        matrix = pymupdf.Matrix(width / clip.width, height / clip.height)
+        colorspace = pymupdf.csRGB if profile.color == 'rgb' else pymupdf.csGRAY
+        pix = page.get_pixmap(matrix=matrix, clip=clip, colorspace=colorspace, alpha=False)
+        width, height = pix.width, pix.height
+        if profile.format == 'png' and profile.color != 'bilevel':
+            image_bytes = pix.tobytes("png")
+        else:
+            image_bytes = None
+            samples = pix.samples
+        # Release the pixmap while holding the lock
+        del pix
+
+    if image_bytes is None:
+        # Encode with Pillow outside the lock
+        image = Image.frombytes("RGB" if profile.color == 'rgb' else "L", [width, height], samples)
+        if profile.color == 'bilevel':
+            image = image.point(lambda value: 255 if value >= profile.threshold else 0, mode='1')
+            if profile.format != 'png':
+                # JPEG and WebP have no 1-bit mode
+                image = image.convert('L')
+        output = io.BytesIO()
+        if profile.format == 'png':
+            image.save(output, 'PNG', optimize=True)
+        else:
+            image.save(output, profile.format.upper(), quality=profile.quality)
+        image_bytes = output.getvalue()
+
+    return image_bytes, {'width': width, 'height': height, 'bytes': len(image_bytes),
+                         'tokens': estimate_image_tokens(width, height, profile.detail), 'detail': profile.detail}
+
+# The document open in a render worker process, see render_page_in_worker
+_worker_document = {}
+
+def render_page_in_worker(path, page_index, dpi, profile, region=None):
+    """
+    Renders one page of a PDF file in a render worker process (see render_pdf_pages), keeping the document
+    open between the pages the process renders. Returns the same as render_page_image.
+    """
+    with PYMUPDF_LOCK:
+        if _worker_document.get('path') != path:
+            if 'document' in _worker_document:
+                _worker_document['document'].close()
+            _worker_document.update(path=path, document=open_pdf(path))
+        return render_page_image(_worker_document['document'].load_page(page_index), dpi, profile, region)
+
+def image_mime_type(image_name):
+    # Page image names end with the extension of the format they were encoded in
+    extension = image_name.rsplit('.', 1)[-1].lower()
+    for format_extension, mime_type in IMAGE_FORMATS.values():
+        if extension == format_extension:
+            return mime_type
+    return 'image/png'
@@ -0,0 +1,172 @@
+import json
+import math
+import re
+
+# Paragraph roles Document Intelligence assigns to titles and headings, which name what a page is about
+HEADING_ROLES = {'title', 'sectionHeading', 'pageHeader'}
+
+# Words of field descriptions that say nothing about where a field is found
+STOPWORDS = {'the', 'and', 'for', 'are', 'this', 'that', 'with', 'from', 'each', 'every', 'all', 'any', 'its', 'which',
+             'list', 'value', 'values', 'field', 'fields', 'document', 'drawing', 'page', 'pages', 'should', 'include',
+             'included', 'contains', 'contain', 'provide', 'provided', 'extract', 'extracted', 'format', 'sample', 'description'}
+
+# Weights of the different places a field term can be found on a page
+TEXT_WEIGHT = 1.0
+HEADING_WEIGHT = 3.0
+TABLE_HEADER_WEIGHT = 2.0
+KEY_WEIGHT = 2.0
+
+def tokenize(text):
+    # Split snake_case and camelCase names as well as free text into lowercase words of two or more characters
+    text = re.sub(r'([a-z])([A-Z])', r'\1 \2', str(text)).replace('_', ' ')
+    return re.findall(r'[a-z0-9]{2,}', text.lower())
+
+def field_terms(name, spec):
+    """
+    Collects the words that identify a schema field on a page, weighted by where they come from: the field name
+    counts double, the keys of a sample list (usually the column headers of its table) one and a half times
+    and the words of its description once. Generic words are only dropped from the description and sample.
+
+    Returns:
+    terms (dict): The weight of every term.
+    """
+    terms = {}
+
+    def add(words, weight, skip_stopwords=True):
+        for word in words:
+            if not (skip_stopwords and word in STOPWORDS):
+                terms[word] = max(terms.get(word, 0), weight)
+
+    if isinstance(spec, dict):
+        add(tokenize(spec.get('description', '')), 1.0)
+        sample = spec.get('sample')
+        if isinstance(sample, list) and len(sample) > 0 and isinstance(sample[0], dict):
+            add(tokenize(' '.join(sample[0].keys())), 1.5)
+    elif isinstance(spec, str):
+        add(tokenize(spec), 1.0)
+    add(tokenize(name), 2.0, skip_stopwords=False)
+    return terms
+
+def is_list_field(spec):
+    return isinstance(spec, list) or (isinstance(spec, dict) and isinstance(spec.get('sample'), list))
+
+def page_features(doc_intel_result, page_texts):
+    """
+    Indexes the words of every page of a prebuilt-layout result: the page text (including its tables), the
+    paragraphs with a title or heading role, table column headers and the keys of key-value pairs.
+
+    Args:
+    doc_intel_result (dict): The Document Intelligence result.
+    page_texts (dict): The text of every page keyed by page number, as built by extract_results.
+
+    Returns:
+    features (dict): For every page number, the word counts of its text and the words of its headings, table
+    headers and keys, plus its number of tables.
+    """
+    features = {}
+    for page_number, text in page_texts.items():
+        counts = {}
+        for word in tokenize(text):
+            counts[word] = counts.get(word, 0) + 1
+        features[page_number] = {'text': counts, 'headings': set(), 'table_headers': set(), 'keys': set(), 'tables': 0}
+
+    def page_of(item):
+        regions = item.get('boundingRegions') or []
+        return regions[0]['pageNumber'] if len(regions) > 0 else None
+
+    for paragraph in doc_intel_result.get('paragraphs') or []:
+        if paragraph.get('role') in HEADING_ROLES and page_of(paragraph) in features:
+            features[page_of(paragraph)]['headings'].update(tokenize(paragraph.get('content', '')))
+
+    for table in doc_intel_result.get('tables') or []:
+        page = features.get(page_of(table))
+        if page is None:
+            continue
+        page['tables'] += 1
+        for cell in table.get('cells') or []:
+            if cell.get('kind') == 'columnHeader' or cell.get('rowIndex') == 0:
+                page['table_headers'].update(tokenize(cell.get('content', '')))
+
+    for pair in doc_intel_result.get('keyValuePairs') or []:
+        key = pair.get('key') or {}
+        if page_of(key) in features:
+            features[page_of(key)]['keys'].update(tokenize(key.get('content', '')))
+
+    return features
+
+def score_page(terms, page, list_field=False):
+    # Sum the weighted evidence of every term; repeated mentions in the text count with diminishing returns
+    score = 0.0
+    for term, weight in terms.items():
+        evidence = TEXT_WEIGHT * math.log1p(page['text'].get(term, 0))
+        if term in page['headings']:
+            evidence += HEADING_WEIGHT
+        if term in page['table_headers']:
+            evidence += TABLE_HEADER_WEIGHT
+        if term in page['keys']:
+            evidence += KEY_WEIGHT
+        score += weight * evidence
+    # List-valued fields are usually tables, so prefer pages with tables among pages that mention the field
+    if list_field and score > 0 and page['tables'] > 0:
+        score *= 1.5
+    return score
+
+def route_pages(schema, doc_intel_result, page_texts, top_k=3, fallback='full'):
+    """
+    Chooses the pages the agents need to see for every field of the target schema.
+
+    Args:
+    schema (dict or str): The target schema, as a dictionary of fields or its JSON string.
+    doc_intel_result (dict): The Document Intelligence result.
+    page_texts (dict): The text of every page keyed by page number, as built by extract_results.
+    top_k (int): The number of best scoring pages kept for every field.
+    fallback (str): What to send for a field no page mentions: 'full' for every page of the document,
+    'none' for no extra pages.
+
+    Returns:
+    routing (dict): The pages selected for every field, the union of all selected pages, the fields that
+    fell back to the full document and the page count.
+    """
+    all_pages = sorted(page_texts)
+    if isinstance(schema, str):
+        try:
+            schema = json.loads(schema)
+        except json.JSONDecodeError:
+            schema = None
+
+    # Nothing to route when the schema has no fields or the document is not longer than the selection
+    if not isinstance(schema, dict) or len(schema) == 0 or len(all_pages) <= top_k:
+        return {'fields': {}, 'pages': all_pages, 'fallback_fields': [], 'page_count': len(all_pages)}
+
+    features = page_features(doc_intel_result, page_texts)
+    fields = {}
+    fallback_fields = []
+    for name, spec in schema.items():
+        terms = field_terms(name, spec)
+        scores = [(score_page(terms, features[page], is_list_field(spec)), page) for page in all_pages]
+        ranked = [page for score, page in sorted(scores, key=lambda x: (-x[0], x[1])) if score > 0][:top_k]
+        if len(ranked) == 0:
+            fallback_fields.append(name)
+            ranked = all_pages if fallback == 'full' else []
+        fields[name] = sorted(ranked)
+
+    pages = sorted({page for field_pages in fields.values() for page in field_pages})
+    return {'fields': fields, 'pages': pages, 'fallback_fields': fallback_fields, 'page_count': len(all_pages)}
+
+def select_pages(routing, schema):
+    """
+    Returns the routed pages for the fields of a (partial) schema, e.g. one field group. Every routed page is
+    returned when the schema is not a dictionary of routed fields.
+    """
+    if isinstance(schema, str):
+        try:
+            schema = json.loads(schema)
+        except json.JSONDecodeError:
+            schema = None
+    if not isinstance(schema, dict) or any(name not in routing['fields'] for name in schema):
+        return routing['pages']
+    return sorted({page for name in schema for page in routing['fields'][name]})
+
+def join_page_text(page_texts, pages):
+    # Page texts come back from the orchestration history keyed by strings
+    return '\n'.join(page_texts.get(str(page), page_texts.get(page, '')) for page in pages)
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import fitz as pymupdf
+from azure.core import MatchConditions
+
+# PDFs are downloaded once per worker process into a spool file and shared by the activities reading them
+# (Document Intelligence and page rasterization usually run side by side on the same worker). Spool files
+# are kept for PDF_SPOOL_TTL_SECONDS after their last use, within PDF_SPOOL_MAX_MB on disk, and reused for
+# as long as the blob keeps its ETag. Spool files in use are never removed, so the disk used can exceed the
+# size limit while PDFs are processed; the default leaves room for them in the temporary storage of small plans.
+SPOOL_DIR = os.getenv('PDF_SPOOL_DIR') or os.path.join(tempfile.gettempdir(), 'pdf-spool')
+
+_spools = {}
+
+# PyMuPDF does not support multithreading, not even with a document per thread, so every PyMuPDF call in a
+# process (opening, rendering, copying pages, closing) is made while holding this lock. Rendering runs in
+# worker processes to use more than one core, see render_pdf_pages.
+PYMUPDF_LOCK = threading.RLock()
+
+class SpooledPdf:
+    """
+    A PDF downloaded to a local spool file.
+
+    Args:
+    path (str): The spool file.
+    size (int): The size of the PDF in bytes.
+    sha256 (str): The SHA-256 digest of the PDF, computed while it was downloaded.
+    etag (str): The ETag of the blob the PDF was downloaded from.
+    """
+
+    def __init__(self, path, size, sha256, etag):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.etag = etag
+
+    def read_bytes(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+class _SpoolEntry:
+    def __init__(self, etag, task):
+        self.etag = etag
+        self.task = task
+        self.users = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def pdf(self):
+        # The spooled PDF once the download has succeeded, None while it runs or when it failed
+        if self.task.done() and not self.task.cancelled() and self.task.exception() is None:
+            return self.task.result()
+        return None
+
+def open_pdf(source):
+    """
+    Opens a PDF with PyMuPDF from its bytes or from a file path. Documents opened from a file read their
+    pages from the file on demand rather than from a copy of the whole PDF in memory. Callers hold
+    PYMUPDF_LOCK while opening, using and closing the document.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        return pymupdf.open("pdf", source)
+    return pymupdf.open(source)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+async def _download(blob_client, etag):
+    # Stream the blob to the spool file chunk by chunk, hashing it on the way, so that the PDF is never
+    # held in memory as a whole
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    handle, path = tempfile.mkstemp(suffix='.pdf', dir=SPOOL_DIR)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            def write(chunk):
+                f.write(chunk)
+                digest.update(chunk)
+
+            # Fail rather than spool a revision other than the one the ETag was read from
+            downloader = await blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
+            async for chunk in downloader.chunks():
+                # Write and hash off the event loop, a spooled PDF can be several GB
+                await asyncio.to_thread(write, chunk)
+                size += len(chunk)
+    except BaseException:
+        _remove(path)
+        raise
+    return SpooledPdf(path, size, digest.hexdigest(), etag)
+
+def _evict(now):
+    """Removes unused spool files older than the TTL, then the least recently used ones beyond the size limit."""
+    ttl = float(os.getenv('PDF_SPOOL_TTL_SECONDS', 600))
+    max_bytes = float(os.getenv('PDF_SPOOL_MAX_MB', 256)) * 1024 * 1024
+
+    def spooled_size(entry):
+        return entry.pdf.size if entry.pdf is not None else 0
+
+    def remove(key):
+        entry = _spools.pop(key)
+        if entry.pdf is not None:
+            _remove(entry.pdf.path)
+
+    idle = sorted((key for key, entry in _spools.items() if entry.users == 0 and entry.task.done()), key=lambda key: _spools[key].last_used)
+    for key in [key for key in idle if now - _spools[key].last_used > ttl]:
+        remove(key)
+        idle.remove(key)
+
+    total_size = sum(spooled_size(entry) for entry in _spools.values())
+    for key in idle:
+        if total_size <= max_bytes:
+            break
+        total_size -= spooled_size(_spools[key])
+        remove(key)
+
+class spooled_pdf:
+    """
+    Downloads a PDF blob to a spool file, or reuses the spool file of the same blob revision when another
+    activity of this process downloaded it already (or is downloading it). Use as an async context manager,
+    the spool file stays in place while it is in use:
+
+        async with spooled_pdf(blob_client, span) as pdf:
+            with PYMUPDF_LOCK, open_pdf(pdf.path) as document:
+                ...
+
+    Records the bytes downloaded on the span, and whether the spool file was shared.
+    """
+
+    def __init__(self, blob_client, span=None):
+        self.blob_client = blob_client
+        self.span = span
+        self.entry = None
+
+    async def __aenter__(self):
+        key = (self.blob_client.container_name, self.blob_client.blob_name)
+        etag = (await self.blob_client.get_blob_properties()).etag
+        _evict(time.monotonic())
+
+        entry = _spools.get(key)
+        shared = entry is not None and entry.etag == etag and (not entry.task.done() or entry.pdf is not None)
+        if not shared:
+            if entry is not None and entry.users == 0 and entry.pdf is not None:
+                # An outdated revision of the blob that is no longer in use
+                _remove(entry.pdf.path)
+            entry = _SpoolEntry(etag, asyncio.ensure_future(_download(self.blob_client, etag)))
+            _spools[key] = entry
+
+        entry.users += 1
+        self.entry = entry
+        try:
+            # Shield the download so that a cancelled activity does not cancel it for the others waiting on it
+            pdf = await asyncio.shield(entry.task)
+        except BaseException:
+            self._release()
+            if _spools.get(key) is entry and entry.task.done():
+                _spools.pop(key)
+            raise
+
+        if self.span is not None:
+            self.span.set(spool='shared' if shared else 'download')
+            if not shared:
+                self.span.add('bytes_read', pdf.size)
+        return pdf
+
+    def _release(self):
+        self.entry.users -= 1
+        self.entry.last_used = time.monotonic()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._release()
+        if self.entry not in _spools.values() and self.entry.users == 0 and self.entry.pdf is not None:
+            # Replaced by a newer revision while in use
+            _remove(self.entry.pdf.path)
+        return False
+
+def clear_spools():
+    # Remove every unused spool file, e.g. between benchmark runs
+    for key in [key for key, entry in _spools.items() if entry.users == 0 and entry.task.done()]:
+        entry = _spools.pop(key)
+        if entry.pdf is not None:
+            _remove(entry.pdf.path)
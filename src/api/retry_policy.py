@@ -0,0 +1,218 @@
+from azure.core.exceptions import ClientAuthenticationError, HttpResponseError, ServiceRequestError, ServiceResponseError
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+# HTTP status codes worth retrying: timeouts, throttling and transient server errors
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+class RetryableError(Exception):
+    """Raised by callers for failures that are known to be transient (e.g. a throttled agent run)."""
+    pass
+
+class RetryStats:
+    """Counters describing the retries made by one call, or by every call made through a policy."""
+
+    def __init__(self):
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.failures = 0
+        self.wait_seconds = 0.0
+        self.elapsed_seconds = 0.0
+
+    def add(self, other):
+        self.calls += other.calls
+        self.attempts += other.attempts
+        self.retries += other.retries
+        self.failures += other.failures
+        self.wait_seconds += other.wait_seconds
+        self.elapsed_seconds += other.elapsed_seconds
+
+    def as_dict(self):
+        return {'calls': self.calls, 'attempts': self.attempts, 'retries': self.retries, 'failures': self.failures,
+                'wait_seconds': round(self.wait_seconds, 3), 'elapsed_seconds': round(self.elapsed_seconds, 3)}
+
+def is_retryable(exc):
+    """
+    Classifies an exception as retryable (transient) or fatal.
+
+    Authentication failures and other 4xx responses (bad keys, malformed requests) are fatal; throttling,
+    timeouts, transient server errors and connection failures are retryable.
+    """
+    if isinstance(exc, RetryableError):
+        return True
+    if isinstance(exc, ClientAuthenticationError):
+        return False
+    if isinstance(exc, HttpResponseError):
+        return exc.status_code is None or exc.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(exc, (ServiceRequestError, ServiceResponseError, ConnectionError, TimeoutError))
+
+def get_retry_after(exc):
+    """
+    Returns the delay in seconds requested by the service through Retry-After style headers, if any.
+    """
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    headers = {k.lower(): v for k, v in headers.items()}
+
+    for header in ['retry-after-ms', 'x-ms-retry-after-ms']:
+        if headers.get(header):
+            try:
+                return float(headers[header]) / 1000
+            except ValueError:
+                pass
+
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            # Retry-After can also be an HTTP date
+            try:
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return None
+
+class RetryPolicy:
+    """
+    Bounded retry policy with exponential backoff and full jitter that honours Retry-After headers and limits
+    the number of concurrent calls made to a service from this worker process.
+
+    Args:
+    service (str): The name of the service, used for logging and statistics.
+    max_attempts (int): The maximum number of attempts per call, including the first one.
+    base_delay (float): The delay in seconds before the first retry; doubled on every following retry.
+    max_delay (float): The maximum delay in seconds between two attempts.
+    max_concurrency (int): The maximum number of concurrent calls, or None for no limit.
+    """
+
+    def __init__(self, service, max_attempts=6, base_delay=1.0, max_delay=60.0, max_concurrency=None):
+        self.service = service
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.stats = RetryStats()
+        self._stats_lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._async_semaphores = {}
+
+    def _delay(self, attempt, exc):
+        retry_after = get_retry_after(exc)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def _next_delay(self, attempt, exc, call_stats):
+        # Returns the delay before the next attempt, or None if the exception should be raised
+        if not is_retryable(exc) or attempt >= self.max_attempts:
+            call_stats.failures += 1
+            return None
+        delay = self._delay(attempt, exc)
+        call_stats.retries += 1
+        call_stats.wait_seconds += delay
+        logging.warning(f'{self.service} call failed (attempt {attempt} of {self.max_attempts}), retrying in {delay:.1f}s: {exc}')
+        return delay
+
+    def _record(self, call_stats, retry_stats):
+        with self._stats_lock:
+            self.stats.add(call_stats)
+        if retry_stats is not None:
+            retry_stats.add(call_stats)
+
+    def call(self, func, *args, retry_stats=None, **kwargs):
+        """
+        Calls func(*args, **kwargs), retrying retryable failures. Statistics for this call are added to
+        retry_stats when provided, and always to the policy's own statistics.
+        """
+        call_stats = RetryStats()
+        call_stats.calls = 1
+        start = time.monotonic()
+        try:
+            attempt = 0
+            while True:
+                attempt += 1
+                call_stats.attempts += 1
+                try:
+                    if self._semaphore is None:
+                        return func(*args, **kwargs)
+                    with self._semaphore:
+                        return func(*args, **kwargs)
+                except Exception as e:
+                    delay = self._next_delay(attempt, e, call_stats)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+        finally:
+            call_stats.elapsed_seconds = time.monotonic() - start
+            self._record(call_stats, retry_stats)
+
+    async def call_async(self, func, *args, retry_stats=None, **kwargs):
+        """
+        Awaits func(*args, **kwargs), retrying retryable failures without blocking the event loop.
+        """
+        call_stats = RetryStats()
+        call_stats.calls = 1
+        start = time.monotonic()
+        semaphore = self._async_semaphore()
+        try:
+            attempt = 0
+            while True:
+                attempt += 1
+                call_stats.attempts += 1
+                try:
+                    if semaphore is None:
+                        return await func(*args, **kwargs)
+                    async with semaphore:
+                        return await func(*args, **kwargs)
+                except Exception as e:
+                    delay = self._next_delay(attempt, e, call_stats)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+        finally:
+            call_stats.elapsed_seconds = time.monotonic() - start
+            self._record(call_stats, retry_stats)
+
+    def _async_semaphore(self):
+        # asyncio semaphores are bound to the event loop they are used on
+        if not self.max_concurrency:
+            return None
+        loop = asyncio.get_running_loop()
+        with self._stats_lock:
+            if loop not in self._async_semaphores:
+                self._async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+            return self._async_semaphores[loop]
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+def get_retry_policy(service):
+    """
+    Returns the process-wide retry policy for a service. Limits are read from the environment, e.g. for the
+    'doc_intel' service: DOC_INTEL_MAX_CONCURRENCY, falling back to RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY
+    and RETRY_MAX_DELAY for the backoff settings shared by every service.
+    """
+    with _policies_lock:
+        if service not in _policies:
+            max_concurrency = os.getenv(f'{service.upper()}_MAX_CONCURRENCY')
+            _policies[service] = RetryPolicy(service,
+                                             max_attempts=int(os.getenv('RETRY_MAX_ATTEMPTS', 6)),
+                                             base_delay=float(os.getenv('RETRY_BASE_DELAY', 1.0)),
+                                             max_delay=float(os.getenv('RETRY_MAX_DELAY', 60.0)),
+                                             max_concurrency=int(max_concurrency) if max_concurrency else None)
+        return _policies[service]
+
+def get_retry_stats():
+    """Returns the retry statistics of every policy used in this worker process, keyed by service."""
+    with _policies_lock:
+        return {service: policy.stats.as_dict() for service, policy in _policies.items()}
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from clients import get_async_blob_service_client
+
+# Schemas (target schemas and format templates) are stored once in blob storage under an ID derived from
+# their content, and referenced by that ID in request bodies, orchestration inputs and activity payloads.
+# A registered schema never changes, so every process caches schemas and their rendered prompts forever.
+SCHEMA_ID_PREFIX = 'schema-'
+
+_schemas = {}
+_prompt_prefixes = {}
+_default_schema_ids = {}
+
+def get_schema_container_client():
+    return get_async_blob_service_client().get_container_client(os.getenv('SCHEMA_CONTAINER', 'schemas'))
+
+def parse_schema(schema):
+    # Schemas arrive as dictionaries or as their JSON text (e.g. from the Streamlit app), free text is kept as is
+    if isinstance(schema, str):
+        try:
+            return json.loads(schema)
+        except json.JSONDecodeError:
+            return schema
+    return schema
+
+def serialize_schema(schema):
+    # Whitespace does not change the ID of a schema, the order of its fields does since it is kept in prompts
+    schema = parse_schema(schema)
+    return schema if isinstance(schema, str) else json.dumps(schema, separators=(',', ':'))
+
+def compute_schema_id(schema):
+    return SCHEMA_ID_PREFIX + hashlib.sha256(serialize_schema(schema).encode()).hexdigest()[:32]
+
+async def register_schema(schema):
+    """
+    Stores a schema under its content ID, unless it was registered before.
+
+    Args:
+    schema (dict or str): The schema, as a dictionary or its JSON text.
+
+    Returns:
+    schema_id (str): The ID to reference the schema by.
+    """
+    schema_id = compute_schema_id(schema)
+    if schema_id in _schemas:
+        return schema_id
+
+    container_client = get_schema_container_client()
+    blob_client = container_client.get_blob_client(f"{schema_id}.json")
+    try:
+        await blob_client.upload_blob(serialize_schema(schema), overwrite=False)
+    except ResourceExistsError:
+        # Registered before, by this or another process
+        pass
+    except ResourceNotFoundError:
+        try:
+            await container_client.create_container()
+        except ResourceExistsError:
+            pass
+        try:
+            await blob_client.upload_blob(serialize_schema(schema), overwrite=False)
+        except ResourceExistsError:
+            pass
+
+    _schemas[schema_id] = parse_schema(schema)
+    return schema_id
+
+async def load_schema(schema_id):
+    """
+    Returns a registered schema, from the process cache or from blob storage.
+    """
+    if schema_id not in _schemas:
+        blob_client = get_schema_container_client().get_blob_client(f"{schema_id}.json")
+        try:
+            data = await (await blob_client.download_blob()).readall()
+        except ResourceNotFoundError:
+            raise ValueError(f'Unknown schema {schema_id}')
+        _schemas[schema_id] = parse_schema(data.decode('utf-8'))
+    return _schemas[schema_id]
+
+async def resolve_schema(schema=None, schema_id=None, default_path=None):
+    """
+    Returns the ID of a schema given inline or by ID, registering inline schemas. When neither is given, the
+    schema in default_path (e.g. schema.json) is registered, once per process.
+    """
+    if schema_id:
+        return schema_id
+    if schema is not None and len(schema) > 0:
+        return await register_schema(schema)
+    if default_path not in _default_schema_ids:
+        with open(default_path, 'r') as f:
+            _default_schema_ids[default_path] = await register_schema(f.read())
+    return _default_schema_ids[default_path]
+
+async def register_payload_schemas(payload):
+    """
+    Replaces the inline target schema and format template of an orchestration request with their IDs, so
+    that they are not copied into every orchestration input. Updates the payload in place and returns it.
+    """
+    for key in ('target_schema', 'schema_types'):
+        schema = payload.get(key)
+        if schema is not None and len(schema) > 0 and not payload.get(f'{key}_id'):
+            payload[f'{key}_id'] = await register_schema(schema)
+            payload.pop(key)
+    return payload
+
+def render_schema(schema):
+    # Render schemas the same way whether they arrived as dictionaries or JSON text, keeping prompts stable
+    return schema if isinstance(schema, str) else json.dumps(schema, indent=2)
+
+async def get_prompt_prefix(schema_id, heading, fields=None):
+    """
+    Returns the prompt section of a registered schema, e.g. '## Target Schema: {...}'. Sections are rendered
+    once per schema version and reused by every agent turn, so that prompts start with identical text and
+    benefit from prompt caching. When fields are given, only those fields of the schema are rendered (e.g. the
+    fields of a format template the local formatter could not convert), without caching the section.
+    """
+    if fields is not None:
+        schema = await load_schema(schema_id)
+        if isinstance(schema, dict):
+            return f"## {heading}: {render_schema({name: schema[name] for name in fields if name in schema})}"
+    key = (schema_id, heading)
+    if key not in _prompt_prefixes:
+        _prompt_prefixes[key] = f"## {heading}: {render_schema(await load_schema(schema_id))}"
+    return _prompt_prefixes[key]
@@ -0,0 +1,193 @@
+from contextlib import contextmanager
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+
+class Span:
+    """
+    Timing and usage measurements for one stage of the pipeline, e.g. a Document Intelligence analysis or an
+    agent turn. Numeric attributes (bytes read and written, tokens, retries...) are summed when spans are
+    aggregated per orchestration.
+    """
+
+    def __init__(self, stage, **attributes):
+        self.stage = stage
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self.duration_ms = 0.0
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key, amount):
+        self.attributes[key] = self.attributes.get(key, 0) + (amount or 0)
+
+    def to_dict(self):
+        span = {'stage': self.stage, 'start_time': self.start_time, 'duration_ms': round(self.duration_ms, 1), **self.attributes}
+        if self.error is not None:
+            span['error'] = self.error
+        return span
+
+class LoggingSink:
+    """Writes every span as one structured log line, picked up by Application Insights through the Functions host."""
+
+    def emit(self, span):
+        logging.info('telemetry.span %s', json.dumps(span.to_dict(), default=str))
+
+class OpenTelemetrySink:
+    """Records every span with the globally configured OpenTelemetry tracer provider."""
+
+    def __init__(self):
+        from opentelemetry import trace
+        self.tracer = trace.get_tracer('complex-doc-analysis')
+
+    def emit(self, span):
+        otel_span = self.tracer.start_span(span.stage, start_time=int(span.start_time * 1e9))
+        for key, value in span.attributes.items():
+            if isinstance(value, (str, bool, int, float)):
+                otel_span.set_attribute(key, value)
+        if span.error is not None:
+            otel_span.set_attribute('error', span.error)
+        otel_span.end(end_time=int((span.start_time + span.duration_ms / 1000) * 1e9))
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+def _create_sink(name):
+    if name == 'logging':
+        return LoggingSink()
+    if name == 'otel':
+        return OpenTelemetrySink()
+    # Any other value names a custom sink as 'module:attribute', where the attribute is a class or factory
+    # returning an object with an emit(span) method
+    module_name, attribute = name.split(':')
+    return getattr(importlib.import_module(module_name), attribute)()
+
+def get_telemetry_sinks():
+    """
+    Returns the sinks spans are emitted to, configured with TELEMETRY_SINKS as a comma separated list of
+    'logging' (default), 'otel' and 'module:attribute' custom sinks. Use 'none' to disable emitting spans.
+    """
+    global _sinks
+    with _sinks_lock:
+        if _sinks is None:
+            names = [x.strip() for x in os.getenv('TELEMETRY_SINKS', 'logging').split(',') if x.strip() and x.strip() != 'none']
+            _sinks = []
+            for name in names:
+                try:
+                    _sinks.append(_create_sink(name))
+                except Exception as e:
+                    logging.warning(f'Unable to create telemetry sink {name}: {e}')
+        return _sinks
+
+@contextmanager
+def stage_span(stage, **attributes):
+    """
+    Measures a stage of the pipeline. Use as a context manager (also around awaited calls):
+
+        with stage_span('doc_intel.analyze', file=file) as span:
+            ...
+            span.add('bytes_read', len(data))
+
+    The span is emitted to the configured sinks when the block exits, including when it raises.
+    """
+    span = Span(stage, **attributes)
+    start = time.monotonic()
+    try:
+        yield span
+    except Exception as e:
+        span.error = type(e).__name__
+        raise
+    finally:
+        span.duration_ms = (time.monotonic() - start) * 1000
+        for sink in get_telemetry_sinks():
+            try:
+                sink.emit(span)
+            except Exception as e:
+                logging.warning(f'Failed to emit telemetry span {stage}: {e}')
+
+def current_rss_bytes():
+    # The resident memory of this process, read from /proc on Linux (where the Functions workers run), None elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+@contextmanager
+def track_peak_memory(span, interval=0.02):
+    """
+    Samples the resident memory of the process in a background thread while the block runs, and records its
+    peak on the span as peak_rss_bytes, along with peak_rss_growth_bytes above the memory in use when the
+    block started. Use inside a stage span:
+
+        with stage_span('rasterize', file=file) as span, track_peak_memory(span):
+            ...
+
+    The memory of the whole process is measured, so activities running at the same time on the worker
+    are included. Nothing is recorded where the resident memory cannot be read.
+    """
+    start = current_rss_bytes()
+    if start is None:
+        yield span
+        return
+
+    peak = [start]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            peak[0] = max(peak[0], current_rss_bytes() or 0)
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield span
+    finally:
+        stop.set()
+        thread.join()
+        peak[0] = max(peak[0], current_rss_bytes() or 0)
+        span.set(peak_rss_bytes=peak[0], peak_rss_growth_bytes=peak[0] - start)
+
+def summarize_spans(spans, summary=None):
+    """
+    Aggregates spans per stage, for the status record of an orchestration.
+
+    Args:
+    spans (list): Spans as returned by Span.to_dict().
+    summary (dict): An existing summary to add the spans to.
+
+    Returns:
+    summary (dict): For every stage, the number of spans and errors, the total and maximum duration, the
+    maximum of every peak_ attribute (e.g. peak_rss_bytes) and the sum of every other numeric attribute.
+    """
+    summary = summary if summary is not None else {}
+    for span in spans:
+        stage = summary.setdefault(span['stage'], {'count': 0, 'errors': 0, 'duration_ms': 0.0, 'max_duration_ms': 0.0})
+        stage['count'] += 1
+        stage['errors'] += 1 if span.get('error') else 0
+        stage['duration_ms'] = round(stage['duration_ms'] + span['duration_ms'], 1)
+        stage['max_duration_ms'] = max(stage['max_duration_ms'], span['duration_ms'])
+        for key, value in span.items():
+            if key in ('stage', 'start_time', 'duration_ms') or isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if key.startswith('peak_'):
+                stage[key] = max(stage.get(key, 0), value)
+            else:
+                stage[key] = round(stage.get(key, 0) + value, 3)
+    return summary
+
+def merge_summaries(summary, other):
+    # Combine the per-stage summaries of two orchestrations (e.g. a document sub-orchestration into its parent)
+    for stage_name, other_stage in other.items():
+        stage = summary.setdefault(stage_name, {'count': 0, 'errors': 0, 'duration_ms': 0.0, 'max_duration_ms': 0.0})
+        for key, value in other_stage.items():
+            if key == 'max_duration_ms' or key.startswith('peak_'):
+                stage[key] = max(stage.get(key, 0), value)
+            else:
+                stage[key] = round(stage.get(key, 0) + value, 3)
+    return summary
@@ -0,0 +1,76 @@
+"""
+Unit tests for the convergence tracker of the analyze/review loop. Run from src/api:
+
+    python -m unittest discover tests
+"""
+import unittest
+
+from convergence import *
+
+EXTRACT = {'drawing_number': 'DWG-1', 'revisions': [{'number': 1, 'date': '2024-01-01'}], 'material': 'Steel'}
+
+class ConvergenceTrackerTest(unittest.TestCase):
+
+    def test_reviewer_complete_stops(self):
+        tracker = ConvergenceTracker()
+        tracker.add_extract(EXTRACT)
+        self.assertEqual(tracker.add_review({'complete': True}), STOP_REVIEWER_COMPLETE)
+
+    def test_fields_without_errors_are_verified(self):
+        tracker = ConvergenceTracker()
+        tracker.add_extract(EXTRACT)
+        self.assertIsNone(tracker.add_review({'complete': False, 'errors': [{'field': 'revisions[0].date', 'error': 'Wrong date'}]}))
+        self.assertEqual(tracker.verified_fields, {'drawing_number', 'material'})
+
+    def test_feedback_without_errors_list_verifies_nothing(self):
+        for feedback in ['The extract looks incomplete', {'complete': False, 'rationale': 'Missing revisions'},
+                         {'complete': False, 'errors': 'revisions'}, None]:
+            tracker = ConvergenceTracker()
+            tracker.add_extract(EXTRACT)
+            self.assertIsNone(tracker.add_review(feedback))
+            self.assertEqual(tracker.verified_fields, set(), feedback)
+
+    def test_all_fields_verified_stops(self):
+        tracker = ConvergenceTracker()
+        tracker.add_extract(EXTRACT)
+        tracker.add_review({'complete': False, 'errors': [{'field': 'material', 'error': 'Wrong material'}]})
+        self.assertIsNone(tracker.add_extract({**EXTRACT, 'material': 'Aluminium'}))
+        # An unstructured review in between does not verify the changed field
+        self.assertIsNone(tracker.add_review({'complete': False, 'rationale': 'Check the material'}))
+        self.assertEqual(tracker.add_review({'complete': False, 'errors': []}), STOP_ALL_FIELDS_VERIFIED)
+
+    def test_changed_fields_lose_verification(self):
+        tracker = ConvergenceTracker()
+        tracker.add_extract(EXTRACT)
+        tracker.add_review({'complete': False, 'errors': []})
+        tracker.add_extract({**EXTRACT, 'drawing_number': 'DWG-2'})
+        self.assertEqual(tracker.verified_fields, {'revisions', 'material'})
+
+    def test_unchanged_extract_stops(self):
+        tracker = ConvergenceTracker()
+        tracker.add_extract(EXTRACT)
+        tracker.add_review({'complete': False, 'errors': [{'field': 'material'}]})
+        self.assertEqual(tracker.add_extract(dict(EXTRACT)), STOP_NO_CHANGE)
+
+    def test_change_ratio_threshold(self):
+        tracker = ConvergenceTracker(threshold=0.5)
+        tracker.add_extract(EXTRACT)
+        self.assertEqual(tracker.add_extract({**EXTRACT, 'material': 'Aluminium'}), STOP_BELOW_THRESHOLD)
+
+    def test_negative_threshold_disables_change_stops(self):
+        tracker = ConvergenceTracker(threshold=-1)
+        tracker.add_extract(EXTRACT)
+        self.assertIsNone(tracker.add_extract(dict(EXTRACT)))
+
+class DiffExtractsTest(unittest.TestCase):
+
+    def test_changed_fields_and_ratio(self):
+        changed_fields, change_ratio = diff_extracts(EXTRACT, {**EXTRACT, 'revisions': [{'number': 1, 'date': '2024-02-01'}]})
+        self.assertEqual(changed_fields, ['revisions'])
+        self.assertAlmostEqual(change_ratio, 1 / 4)
+
+    def test_unparsed_extract_is_a_single_leaf(self):
+        self.assertEqual(flatten_extract('not json'), {'': 'not json'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""
+Unit tests for the local format coercion. Run from src/api:
+
+    python -m unittest discover tests
+"""
+import unittest
+
+from formatter import *
+
+TEMPLATE = {
+    'Drawing_Number': {'type': 'nvarchar', 'example': 'DWG-0001'},
+    'Revision_Number': {'type': 'integer', 'example': 1},
+    'Date': {'type': 'datetime', 'example': '2025-01-01T00:00:00Z'},
+}
+
+class FormatCoercerTest(unittest.TestCase):
+
+    def test_values_are_converted(self):
+        formatted, uncertain_fields = FormatCoercer(TEMPLATE).coerce({'Drawing_Number': 'DWG-1', 'Revision_Number': '2', 'Date': '15 Mar 2025'})
+        self.assertEqual(formatted, {'Drawing_Number': 'DWG-1', 'Revision_Number': 2, 'Date': '2025-03-15T00:00:00Z'})
+        self.assertEqual(uncertain_fields, [])
+
+    def test_unconvertible_values_are_uncertain(self):
+        _, uncertain_fields = FormatCoercer(TEMPLATE).coerce({'Drawing_Number': 'DWG-1', 'Revision_Number': 'A', 'Date': '03/04/2025'})
+        self.assertEqual(uncertain_fields, ['Revision_Number', 'Date'])
+
+    def test_missing_fields_are_null(self):
+        formatted, uncertain_fields = FormatCoercer(TEMPLATE).coerce({'Drawing_Number': 'DWG-1'})
+        self.assertEqual(formatted, {'Drawing_Number': 'DWG-1', 'Revision_Number': None, 'Date': None})
+        self.assertEqual(uncertain_fields, [])
+
+    def test_missing_fields_are_uncertain_with_unknown_keys(self):
+        # The unparsed response of a field group may hold the values of the fields missing from the extract
+        extract = {'Drawing_Number': 'DWG-1', 'field_group_1': 'Revision 2 dated 15 Mar 2025'}
+        formatted, uncertain_fields = FormatCoercer(TEMPLATE).coerce(extract)
+        self.assertNotIn('field_group_1', formatted)
+        self.assertEqual(uncertain_fields, ['Revision_Number', 'Date'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,9 +16,15 @@ import base64
 from doc_intel_utilities import *
 from datetime import date
 from openai import AzureOpenAI
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import multiprocessing
+import asyncio
+from clients import *
+from image_profiles import *
+from pdf_spool import *
 
 def load_doc_intel_result(source_container, results_filename):
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv('STORAGE_CONN_STR'))
+    blob_service_client = get_blob_service_client()
     container_client = blob_service_client.get_container_client(source_container)   
     blob_client = container_client.get_blob_client(results_filename)
 
@@ -39,7 +45,7 @@ def gather_document_inputs(source_container, filename):
     results_container_name = f"{source_container}-document-intelligence-results"
     images_container_name = f"{source_container}-images"
 
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv('STORAGE_CONN_STR'))
+    blob_service_client = get_blob_service_client()
     results_container = blob_service_client.get_container_client(results_container_name)
     images_container = blob_service_client.get_container_client(images_container_name)
 
@@ -62,11 +68,7 @@ def gather_document_inputs(source_container, filename):
 
 def review_extract(reviewer_system_message, current_extract, images, ocr_text, critiques=[]):
 
-    client = AzureOpenAI(
-        azure_endpoint = os.getenv("AOAI_ENDPOINT"), 
-        api_key=os.getenv("AOAI_KEY"),  
-        api_version="2024-05-01-preview"
-    )
+    client = get_openai_client()
     system_message = reviewer_system_message
     messages = [{'role': 'system', 'content': system_message}]
     messages.append({'role': 'user', 'content': f'# CURRENT INVOICE EXTRACTION: {json.dumps(current_extract)}\n# INVOICE OCR TEXT: {json.dumps(ocr_text)}\n# PREVIOUS CRITIQUES: {json.dumps(critiques)}'})
@@ -94,18 +96,23 @@ def review_extract(reviewer_system_message, current_extract, images, ocr_text, c
     return response.choices[0].message.content, response.usage.prompt_tokens, response.usage.completion_tokens
 
 def pdf_bytes_to_png_bytes(pdf_bytes, page_number=1):
-    # Load the PDF from a bytes object
-    # pdf_stream = io.BytesIO(pdf_bytes)
-    document = pymupdf.open("pdf", pdf_bytes)
+    with PYMUPDF_LOCK:
+        # Load the PDF from a bytes object
+        # pdf_stream = io.BytesIO(pdf_bytes)
+        document = pymupdf.open("pdf", pdf_bytes)
 
-    # Select the page
-    page = document.load_page(page_number - 1)  # Adjust for zero-based index
+        # Select the page
+        page = document.load_page(page_number - 1)  # Adjust for zero-based index
 
-    # Render page to an image
-    pix = page.get_pixmap(dpi=100)
+        # Render page to an image
+        pix = page.get_pixmap(dpi=100)
 
-    # Convert the PyMuPDF pixmap into a Pillow Image
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        # Convert the PyMuPDF pixmap into a Pillow Image
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+        # Close the document
+        del page, pix
+        document.close()
 
     # Create a BytesIO object for the output PNG
     png_bytes_io = io.BytesIO()
@@ -117,12 +124,158 @@ def pdf_bytes_to_png_bytes(pdf_bytes, page_number=1):
     # Rewind the BytesIO object to the beginning
     png_bytes_io.seek(0)
 
-    # Close the document
-    document.close()
-
     # Return the BytesIO object containing the PNG image
     return png_bytes_io
 
+def render_pdf_pages(source, dpi=100, max_workers=1, on_page=None, profile=None, regions=None):
+    """
+    Renders every page of a PDF to image bytes in a single pass.
+
+    PyMuPDF does not support multithreading, and rendering holds the GIL, so pages are never rendered on
+    several threads. A PDF given by file path is rendered by up to max_workers worker processes, each opening
+    the file itself and rendering one page at a time. Otherwise the pages are rendered one after another in
+    this thread, holding PYMUPDF_LOCK for every page.
+
+    Args:
+    source (bytes or str): The raw bytes of the PDF file, or the path of a local copy (see pdf_spool).
+        Documents opened from a file read their pages from it on demand.
+    dpi (int): The resolution used when rendering each page.
+    max_workers (int): The maximum number of worker processes rendering pages, 1 to render in this process.
+    on_page (callable): Optional callback invoked as on_page(page_index, image_bytes, info) from this thread
+        as soon as a page is rendered (e.g. to upload it while other pages are still rendering), where info
+        holds the image size, bytes and estimated tokens (see render_page_image). The callback may block to
+        hold back rendering until earlier pages are uploaded.
+    profile (ImageProfile): How pages are encoded, lossless RGB PNG by default.
+    regions (dict): Optional crop boxes keyed by page number, see region_boxes.
+
+    Returns:
+    pages (list): The image bytes for each page, in page order. When on_page is given, the image bytes
+    are only handed to on_page, so that they can be released once it is done with them, and the info
+    of each page is returned instead.
+    """
+    profile = profile or ImageProfile()
+    regions = regions or {}
+
+    def rendered(page_index, image_bytes, info):
+        if on_page is None:
+            pages[page_index] = image_bytes
+        else:
+            pages[page_index] = info
+            on_page(page_index, image_bytes, info)
+
+    with PYMUPDF_LOCK:
+        document = open_pdf(source)
+    try:
+        with PYMUPDF_LOCK:
+            page_count = document.page_count
+        pages = [None] * page_count
+        max_workers = max(1, min(int(max_workers), page_count))
+        if max_workers == 1 or isinstance(source, (bytes, bytearray)):
+            for page_index in range(page_count):
+                with PYMUPDF_LOCK:
+                    image_bytes, info = render_page_image(document.load_page(page_index), dpi, profile, regions.get(page_index + 1))
+                rendered(page_index, image_bytes, info)
+            return pages
+    finally:
+        with PYMUPDF_LOCK:
+            document.close()
+
+    # Spawn rather than fork the workers, so that they do not inherit the locks and threads of this process.
+    # At most two pages per worker are queued, so that rendered pages wait in the workers for on_page.
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        pending = {}
+        next_page = 0
+        while next_page < page_count or len(pending) > 0:
+            while next_page < page_count and len(pending) < 2 * max_workers:
+                pending[executor.submit(render_page_in_worker, source, next_page, dpi, profile, regions.get(next_page + 1))] = next_page
+                next_page += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Surface any rendering or callback errors
+                image_bytes, info = future.result()
+                rendered(pending.pop(future), image_bytes, info)
+
+    return pages
+
+async def load_page_images_async(images_container_name, image_names, max_concurrency=8):
+    """
+    Downloads page images by blob name concurrently on the event loop and returns them base64-encoded, in the
+    order given.
+    """
+    container_client = get_async_blob_service_client().get_container_client(images_container_name)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def load_image(image_name):
+        async with semaphore:
+            png_bytes = await (await container_client.get_blob_client(image_name).download_blob()).readall()
+        return base64.b64encode(png_bytes).decode('utf-8')
+
+    return await asyncio.gather(*[load_image(image_name) for image_name in image_names])
+
+def estimate_schema_tokens(schema):
+    # Schemas are counted at ~4 characters per token, like the rest of the document context
+    return len(json.dumps(schema)) // 4
+
+def estimate_context_tokens(schema_tokens, ocr_text, key_value_pairs, image_files, tokens_per_image=765):
+    """
+    Roughly estimates the prompt tokens taken by a document's context (schema, OCR text, key-value pairs
+    and page images), given the estimated tokens of the schema. Text is counted at ~4 characters per token;
+    images use the estimate recorded when they were rendered, or default to the cost of a high-detail
+    1024x1024 image.
+    """
+    text_length = len(ocr_text or '') + len(json.dumps(key_value_pairs))
+    return schema_tokens + text_length // 4 + sum(image.get('tokens', tokens_per_image) for image in image_files)
+
+def split_schema_fields(schema, field_groups=None, max_groups=1):
+    """
+    Splits a target schema into groups of fields, each extracted by its own analyze/review loop.
+
+    Args:
+    schema (dict or str): The target schema, as a dictionary of fields or its JSON string.
+    field_groups (list): Optional lists of field names to extract together. Fields not named in any group are
+    extracted together in one more group.
+    max_groups (int): When field_groups is not given, the maximum number of groups to create automatically.
+    Every list-valued field (e.g. a table of revisions) gets its own group and the remaining fields share one,
+    after which the smallest groups are merged until at most max_groups remain. 1 disables the split.
+
+    Returns:
+    groups (list): The schema of every group, in the same format as the given schema. A schema that is not a
+    dictionary of fields is returned as a single group.
+    """
+    parsed = schema
+    if isinstance(schema, str):
+        try:
+            parsed = json.loads(schema)
+        except json.JSONDecodeError:
+            return [schema]
+    if not isinstance(parsed, dict) or len(parsed) < 2:
+        return [schema]
+
+    if field_groups:
+        groups = [[name for name in group if name in parsed] for group in field_groups]
+        grouped = {name for group in groups for name in group}
+        groups.append([name for name in parsed if name not in grouped])
+    else:
+        if max_groups <= 1:
+            return [schema]
+        # A field is list-valued when its sample value is a list, as for the tables in schema.json
+        def is_list_field(value):
+            return isinstance(value, list) or (isinstance(value, dict) and isinstance(value.get('sample'), list))
+        groups = [[name] for name, value in parsed.items() if is_list_field(value)]
+        groups.append([name for name, value in parsed.items() if not is_list_field(value)])
+        groups = [group for group in groups if len(group) > 0]
+        # Merge the two smallest groups until the cap is met, keeping the fields in schema order
+        order = list(parsed)
+        while len(groups) > max_groups:
+            groups.sort(key=lambda group: len(json.dumps({name: parsed[name] for name in group})))
+            groups = [sorted(groups[0] + groups[1], key=order.index)] + groups[2:]
+        groups.sort(key=lambda group: order.index(group[0]))
+
+    group_schemas = [{name: parsed[name] for name in group} for group in groups if len(group) > 0]
+    if isinstance(schema, str):
+        group_schemas = [json.dumps(group_schema, indent=4) for group_schema in group_schemas]
+    return group_schemas
+
 def custom_serializer(obj):
     if isinstance(obj, date):
         return obj.isoformat()  # Convert date to string
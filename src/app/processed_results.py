@@ -0,0 +1,137 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import json
+import os
+import pandas as pd
+
+# Processed results are cached on disk, one JSON file per result blob, together with an index mapping each blob
+# name to the ETag of the cached copy. Later loads only download blobs that are new or have changed since.
+INDEX_FILE = 'index.json'
+
+def get_cache_dir(result_container):
+    return os.path.join(os.getenv('RESULTS_CACHE_DIR', './.results_cache'), result_container)
+
+def _cache_path(cache_dir, blob_name):
+    return os.path.join(cache_dir, hashlib.sha256(blob_name.encode()).hexdigest() + '.json')
+
+def _load_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, INDEX_FILE), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _save_index(cache_dir, index):
+    # Write to a temporary file first so an interrupted sync never leaves a truncated index behind
+    path = os.path.join(cache_dir, INDEX_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+
+def sync_processed_results(container_client, cache_dir, max_workers=16):
+    """
+    Brings the local cache of processed results up to date with the results container.
+
+    Args:
+    container_client (ContainerClient): The client for the processed results container.
+    cache_dir (str): The directory holding the cached results.
+    max_workers (int): The number of concurrent downloads.
+
+    Returns:
+    blob_names (list): The names of every result blob, in listing order.
+    stats (dict): The number of results downloaded, served from the cache and removed from the cache.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index = _load_index(cache_dir)
+
+    # Listing returns each blob's ETag, so unchanged blobs are identified without downloading them
+    etags = {blob.name: blob.etag for blob in container_client.list_blobs()}
+    changed = [name for name, etag in etags.items() if index.get(name) != etag]
+    removed = [name for name in index if name not in etags]
+
+    def download(blob_name):
+        downloader = container_client.get_blob_client(blob_name).download_blob()
+        data = downloader.readall()
+        with open(_cache_path(cache_dir, blob_name), 'wb') as f:
+            f.write(data)
+        return blob_name, downloader.properties.etag
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for blob_name, etag in executor.map(download, changed):
+            index[blob_name] = etag
+
+    for blob_name in removed:
+        index.pop(blob_name)
+        try:
+            os.remove(_cache_path(cache_dir, blob_name))
+        except FileNotFoundError:
+            pass
+
+    _save_index(cache_dir, index)
+    return list(etags), {'downloaded': len(changed), 'cached': len(etags) - len(changed), 'removed': len(removed)}
+
+def load_cached_results(cache_dir, blob_names):
+    """
+    Reads cached results into a DataFrame with one row per result and a Filename column.
+    """
+    rows = []
+    for blob_name in blob_names:
+        with open(_cache_path(cache_dir, blob_name), 'r') as f:
+            rows.append({'Filename': blob_name, **json.load(f)})
+    return pd.DataFrame(rows)
+
+def load_results_page(cache_dir, blob_names, page, page_size=100):
+    """
+    Reads a single page of cached results, so only the rows on screen are held in memory.
+
+    Args:
+    cache_dir (str): The directory holding the cached results.
+    blob_names (list): The names of every result blob, as returned by sync_processed_results.
+    page (int): The page number, starting at 1.
+    page_size (int): The number of results per page.
+
+    Returns:
+    df (DataFrame): The results on the requested page.
+    """
+    start = (page - 1) * page_size
+    return load_cached_results(cache_dir, blob_names[start:start + page_size])
+
+def _flatten_for_export(df):
+    # Nested objects and lists cannot be written to CSV or Parquet columns as-is, so store them as JSON strings.
+    # Other values of mixed-type columns are written as strings, since Parquet columns hold a single type.
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].map(lambda x: json.dumps(x) if isinstance(x, (dict, list)) else (None if pd.isna(x) else str(x)))
+    return df
+
+def export_results(cache_dir, blob_names, format='csv', chunk_size=1000):
+    """
+    Exports every cached result to CSV or Parquet.
+
+    Args:
+    cache_dir (str): The directory holding the cached results.
+    blob_names (list): The names of the result blobs to export.
+    format (str): Either 'csv' or 'parquet'.
+    chunk_size (int): The number of results read into memory at a time when writing CSV.
+
+    Returns:
+    data (bytes): The exported file.
+    """
+    if format == 'parquet':
+        buffer = io.BytesIO()
+        _flatten_for_export(load_cached_results(cache_dir, blob_names)).to_parquet(buffer, index=False)
+        return buffer.getvalue()
+
+    # Build the CSV chunk by chunk, writing the header with the columns of every result
+    columns = ['Filename']
+    for start in range(0, len(blob_names), chunk_size):
+        for column in load_cached_results(cache_dir, blob_names[start:start + chunk_size]).columns:
+            if column not in columns:
+                columns.append(column)
+
+    buffer = io.StringIO()
+    for start in range(0, len(blob_names), chunk_size):
+        chunk = _flatten_for_export(load_cached_results(cache_dir, blob_names[start:start + chunk_size]))
+        chunk.reindex(columns=columns).to_csv(buffer, index=False, header=(start == 0))
+    return buffer.getvalue().encode()
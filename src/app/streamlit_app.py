@@ -1,16 +1,19 @@
 import streamlit as st
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import os
 from dotenv import load_dotenv
 import requests
 import time
+import uuid
 from azure.cosmos import CosmosClient, PartitionKey, exceptions
 from azure.identity import DefaultAzureCredential
+from azure.core.exceptions import ResourceNotFoundError
 import re
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
 import pandas as pd
 from azure.ai.projects import AIProjectClient
+from processed_results import *
 
 
 # Load environment variables
@@ -124,26 +127,34 @@ def save_prompts():
 
     st.json(prompts_data)  # Display the saved data (for debugging/demo purposes)
 
-def get_cosmos_record(id):
-
-    cosmos_container = os.environ['COSMOS_CONTAINER']
-    cosmos_database = os.environ['COSMOS_DATABASE']
-    cosmos_endpoint = os.environ['COSMOS_ENDPOINT']
-    cosmos_key = os.environ['COSMOS_KEY']
-    cosmos_id = id
-
-    client = CosmosClient(cosmos_endpoint, cosmos_key)
-
-    # Select the database
-    database = client.get_database_client(cosmos_database)
-
-    # Select the container
-    container = database.get_container_client(cosmos_container)
-
-    # Retrieve the existing record from Cosmos DB
-    existing_record = container.read_item(item=cosmos_id, partition_key=cosmos_id)
-
-    return existing_record
+@st.cache_resource
+def get_status_log_container():
+    # Reuse one Cosmos client across reruns instead of connecting on every status poll
+    client = CosmosClient(os.environ['COSMOS_ENDPOINT'], os.environ['COSMOS_KEY'])
+    database = client.get_database_client(os.environ['COSMOS_DATABASE'])
+    return database.get_container_client(os.getenv('COSMOS_LOG_CONTAINER', os.environ['COSMOS_CONTAINER'] + '-log'))
+
+def get_new_status_entries(id, since=None, seen_ids=None):
+    """
+    Returns the status log entries of an orchestration that were not returned before, oldest first.
+
+    Entries are written concurrently (by field groups, documents and hosts) and timestamped with the clock of
+    the writer before they are stored, so an entry can become visible after entries with later timestamps.
+    The query therefore reaches STATUS_LOG_OVERLAP_SECONDS back from `since` (the latest timestamp already
+    shown) and drops the entries whose ID is in `seen_ids`, adding the IDs of the returned entries to it.
+    """
+    query = "SELECT * FROM c WHERE c.orchestration_id = @id"
+    parameters = [{'name': '@id', 'value': id}]
+    if since is not None:
+        since = (datetime.fromisoformat(since) - timedelta(seconds=float(os.getenv('STATUS_LOG_OVERLAP_SECONDS', 120)))).isoformat()
+        query += " AND c.logged_at > @since"
+        parameters.append({'name': '@since', 'value': since})
+    query += " ORDER BY c.logged_at"
+
+    seen_ids = seen_ids if seen_ids is not None else set()
+    entries = [x for x in get_status_log_container().query_items(query=query, parameters=parameters, partition_key=id) if x['id'] not in seen_ids]
+    seen_ids.update(x['id'] for x in entries)
+    return entries
 
 def cosmos_logging_changed_batch():
     print(st.session_state.cosmos_logging_batch)   
@@ -155,20 +166,108 @@ def cosmos_logging_changed_single():
     st.session_state.cosmos_logging = st.session_state.cosmos_logging_single
     print(st.session_state.cosmos_logging)
 
+@st.cache_data(show_spinner=False)
+def register_schema(schema_text):
+    """
+    Registers a schema with the function app and returns its ID, or None when it cannot be registered (e.g. it is
+    not valid JSON). Registration is cached by schema text, so each version of a schema is only sent once.
+    """
+    uri = os.getenv('FUNCTION_URI') + '/api/schemas?code=' + os.getenv('FUNCTION_KEY')
+    try:
+        response = requests.post(uri, data=schema_text.encode('utf-8'), timeout=30)
+        response.raise_for_status()
+        return response.json()['schema_id']
+    except (requests.exceptions.RequestException, KeyError, ValueError):
+        return None
+
+def analysis_settings():
+    # Orchestration settings shared by single document and batch submissions
+    settings = {
+        'container': os.getenv('DOCUMENT_CONTAINER'),
+        'max_iterations': st.session_state.max_iterations,
+        'cosmos_logging': st.session_state.cosmos_logging
+    }
+    # Reference the schemas by their registered IDs, sending them inline only when they could not be registered
+    for key, schema_text in [('target_schema', st.session_state.target_schema), ('schema_types', st.session_state.data_types)]:
+        schema_id = register_schema(schema_text)
+        if schema_id is None:
+            settings[key] = schema_text
+        else:
+            settings[f'{key}_id'] = schema_id
+    return settings
+
+def analyze_batch(filenames):
+    """
+    Starts the analysis of several documents with a single request to the batch endpoint.
+
+    Args:
+    filenames (list): The names of the documents to analyze.
+
+    Returns:
+    batch (dict): The batch ID and the orchestration instance started for each file.
+    """
+    uri = os.getenv('FUNCTION_URI') + '/api/batches/start/agent_document_analysis_orchestrator?code=' + os.getenv('FUNCTION_KEY')
+    body = {**analysis_settings(), 'filenames': filenames}
+
+    # Reusing the idempotency key when retrying a failed submission never starts a file twice
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+    for attempt in range(3):
+        try:
+            response = requests.post(uri, json=body, headers=headers, timeout=120)
+            response.raise_for_status()
+            break
+        except requests.exceptions.RequestException:
+            if attempt == 2:
+                raise
+    batch = response.json()
+    st.session_state.batch_id = batch['batchId']
+    return batch
+
+@st.cache_resource
+def get_blob_service_client():
+    return BlobServiceClient.from_connection_string(os.getenv('STORAGE_CONN_STR'))
+
+@st.cache_data(ttl=int(os.getenv('BLOB_LIST_TTL', 300)), show_spinner=False)
+def list_document_page(container_name, prefix, continuation_token, page_size=int(os.getenv('BLOB_PAGE_SIZE', 500))):
+    """
+    Lists one page of the documents container. Pages are cached for BLOB_LIST_TTL seconds, so widget
+    interactions do not list the container again.
+
+    Args:
+    container_name (str): The name of the documents container.
+    prefix (str): Only list blobs starting with this prefix, filtered by the storage service.
+    continuation_token (str): The token of the page to list, or None for the first page.
+    page_size (int): The maximum number of blobs per page.
+
+    Returns:
+    files (list): The name, size and last modified time of every blob on the page.
+    next_token (str): The continuation token of the next page, or None on the last page.
+    """
+    container_client = get_blob_service_client().get_container_client(container_name)
+    pages = container_client.list_blobs(name_starts_with=prefix or None, results_per_page=page_size).by_page(continuation_token=continuation_token)
+    files = [{'Filename': blob.name, 'Size': blob.size, 'Last Modified': blob.last_modified} for blob in next(pages, [])]
+    return files, pages.continuation_token
+
+@st.cache_data(ttl=int(os.getenv('BLOB_LIST_TTL', 300)), show_spinner=False)
+def list_processed_results(result_container):
+    # Names and last modified times of every processed result, used to show the processing status of documents
+    container_client = get_blob_service_client().get_container_client(result_container)
+    try:
+        return {blob.name: blob.last_modified for blob in container_client.list_blobs()}
+    except ResourceNotFoundError:
+        return {}
+
+def reset_document_pages():
+    st.session_state.browser_tokens = [None]
+    st.session_state.browser_page = 0
+
 # Define the analyze_document function
 def analyze_document(filename, max_iterations):
     # Replace with actual analysis logic
     # st.success(f"Analyzing '{filename}' with a maximum of {max_iterations} iterations...")
 
     uri = os.getenv('FUNCTION_URI') + '/api/orchestrators/agent_document_analysis_orchestrator?code=' + os.getenv('FUNCTION_KEY')
-    body = {
-        'container': os.getenv('DOCUMENT_CONTAINER'),
-        'filename': filename,
-        'target_schema': st.session_state.target_schema,
-        'schema_types': st.session_state.data_types,
-        'max_iterations': st.session_state.max_iterations,
-        'cosmos_logging': st.session_state.cosmos_logging
-    }
+    body = {**analysis_settings(), 'filename': filename}
 
     response = requests.post(uri, json=body)
     response.json()
@@ -179,6 +278,31 @@ def analyze_document(filename, max_iterations):
     st.session_state.processing = True
     st.session_state.status_uri = status_uri
 
+def follow_progress(instance_ids, include_children=False):
+    """
+    Follows the progress of one or more orchestrations over the long-poll progress endpoint.
+
+    Args:
+    instance_ids (list): The IDs of the orchestrations to follow.
+    include_children (bool): Whether to also report the per-document sub-orchestrations.
+
+    Returns:
+    A generator yielding the latest status of every instance, keyed by instance ID, each time one changes.
+    Iteration ends once every orchestration has reached a terminal state.
+    """
+    uri = os.getenv('FUNCTION_URI') + '/api/progress?code=' + os.getenv('FUNCTION_KEY')
+    statuses = {}
+    cursor = {}
+    done = False
+    while not done:
+        body = {'instances': instance_ids, 'cursor': cursor, 'timeout': 25, 'include_children': include_children}
+        response = requests.post(uri, json=body, timeout=60).json()
+        cursor = response['cursor']
+        done = response['done']
+        statuses.update(response['changes'])
+        if response['changes'] or done:
+            yield statuses
+
 
 # Content for 'Prompts' tab
 with tab1:
@@ -275,54 +399,81 @@ with tab2:
             output_placeholder = st.empty()
 
             with st.spinner(f'Running Agent Analysis on {filename}...'):
-                while True:
-                    resp = requests.get(st.session_state.status_uri)
+                responses = []
+                last_logged_at = None
+                seen_entry_ids = set()
+                for statuses in follow_progress([st.session_state.id], include_children=True):
+                    # Only statuses that changed since the last update are sent by the progress endpoint
+                    resp = statuses.get(st.session_state.id, {})
+                    # The per-document sub-orchestrations report the current agent response
+                    document_statuses = {x: status.get('customStatus') for x, status in statuses.items() if status.get('parentId') == st.session_state.id}
 
                     # Extract status and outputs
-                    status = resp.json().get('runtimeStatus', 'Unknown')
+                    status = resp.get('runtimeStatus', 'Unknown')
                     st.session_state.processing_status = status
                     status_placeholder.text(f"Status: {st.session_state.processing_status}")
-                    if type(resp.json().get('customStatus', '')) == dict:
+                    if type(resp.get('customStatus', '')) == dict:
                         if st.session_state.cosmos_logging:
-                            cosmos_record = get_cosmos_record(st.session_state.id)
-                            responses = cosmos_record['responses'][::-1]
+                            # Only fetch the log entries written around or after the last one already shown
+                            new_entries = get_new_status_entries(st.session_state.id, last_logged_at, seen_entry_ids)
+                            if len(new_entries) > 0:
+                                last_logged_at = max([last_logged_at or ''] + [x['logged_at'] for x in new_entries])
+                                responses = [{'agent': x['agent'], 'file': x.get('file'), 'response': x['response'], 'timestamp': x['timestamp']} for x in new_entries][::-1] + responses
                             st.session_state.agent_outputs = (responses)
                             output_placeholder.json(responses)
+                        elif len(document_statuses) > 0:
+                            st.session_state.agent_outputs = list(document_statuses.values())[0] if len(document_statuses) == 1 else document_statuses
+                            output_placeholder.json(st.session_state.agent_outputs)
                         else:
-                            st.session_state.agent_outputs = resp.json().get('customStatus', '')
+                            st.session_state.agent_outputs = resp.get('customStatus', '')
                             output_placeholder.json(st.session_state.agent_outputs)
                     else:
-                        st.session_state.agent_outputs = resp.json().get('customStatus', '')
+                        st.session_state.agent_outputs = resp.get('customStatus', '')
                         output_placeholder.markdown(st.session_state.agent_outputs)
 
-                    # Update placeholders with new status and output
-                   
-                    
-
-                    # Handle status updates
-                    if status == 'Completed':
-                        st.session_state.processing = False
-                        break
-                    elif status == 'Failed':
-                        st.error("Analysis failed!")
-                        st.session_state.processing = False
-                        break
-
-                    time.sleep(2)
+                # Handle the final status
+                st.session_state.processing = False
+                if st.session_state.processing_status != 'Completed':
+                    st.error("Analysis failed!")
         else:
             st.error('Analysis failed!')
 
 
 with tab3:
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv('STORAGE_CONN_STR'))
     container_name = os.getenv('DOCUMENT_CONTAINER')
-    container_client = blob_service_client.get_container_client(container_name)
-    blobs = container_client.list_blobs()
+    result_container = container_name + '-processed-results'
 
-    files = []
-    for blob in blobs:
-        files.append(blob.name)
-    df = pd.DataFrame(files, columns=['Filename'])
+    col1, col2, col3 = st.columns([4, 4, 1])
+    with col1:
+        prefix = st.text_input('Prefix', key='browser_prefix', placeholder='Only list files starting with...', on_change=reset_document_pages)
+    with col2:
+        search = st.text_input('Search', key='browser_search', placeholder='Only show files containing...')
+    with col3:
+        st.markdown('<br>', unsafe_allow_html=True)
+        if st.button('Refresh'):
+            list_document_page.clear()
+            list_processed_results.clear()
+            reset_document_pages()
+
+    # Only the current page of the container is listed, continuation tokens of visited pages are kept to go back
+    if 'browser_tokens' not in st.session_state:
+        reset_document_pages()
+    page_index = st.session_state.browser_page
+    files, next_token = list_document_page(container_name, prefix, st.session_state.browser_tokens[page_index])
+    if search:
+        files = [x for x in files if search.lower() in x['Filename'].lower()]
+
+    # Join against the (cached) processed results listing to show which files have already been processed
+    processed = list_processed_results(result_container)
+    for file in files:
+        processed_time = processed.get(file['Filename'].replace('.pdf', '.json'))
+        if processed_time is None:
+            file['Status'] = 'Not Processed'
+        else:
+            file['Status'] = 'Processed' if processed_time >= file['Last Modified'] else 'Outdated'
+        file['Processed'] = processed_time
+
+    df = pd.DataFrame(files, columns=['Filename', 'Status', 'Size', 'Last Modified', 'Processed'])
     st.session_state.df = df
     event = st.dataframe(
         st.session_state.df,
@@ -333,65 +484,71 @@ with tab3:
         hide_index=True
     )
 
+    col1, col2, col3 = st.columns([1, 1, 6])
+    with col1:
+        if st.button('Previous', disabled=page_index == 0):
+            st.session_state.browser_page -= 1
+            st.rerun()
+    with col2:
+        if st.button('Next', disabled=next_token is None):
+            del st.session_state.browser_tokens[page_index + 1:]
+            st.session_state.browser_tokens.append(next_token)
+            st.session_state.browser_page += 1
+            st.rerun()
+    with col3:
+        st.caption(f'Page {page_index + 1}')
+
     st.radio('Enable Cosmos Logging', [True, False], key="cosmos_logging_batch", on_change=cosmos_logging_changed_batch)
 
     if st.button('Analyze Selected Files'):
         st.markdown("---")
         if event is not None:
-            processing_dict = {}
-            for index in event.selection.rows:
-                filename = st.session_state.df.iloc[index]['Filename']
-                print(filename)
-                analyze_document(filename, 10)
-                processing_dict[filename] = st.session_state.status_uri
+            filenames = [st.session_state.df.iloc[index]['Filename'] for index in event.selection.rows]
+            batch = analyze_batch(filenames)
+            processing_dict = {x['filename']: x['id'] for x in batch['instances']}
 
+            # Follow every orchestration over a single long-poll request at a time instead of polling each one
             processing_placeholder = st.empty()
-            done = False
-            while not done:
+            for statuses in follow_progress(list(processing_dict.values())):
                 rows = []
-                done = True
-                for filename, uri in processing_dict.items():
-                    resp = requests.get(uri)
-
-                    # Extract status and outputs
-                    status = resp.json().get('runtimeStatus', 'Unknown')
-                    custom_status = resp.json().get('customStatus', '')
-                    if status != 'Completed' and status != 'Failed':
-                        done = False
-                
+                for filename, id in processing_dict.items():
+                    status = statuses.get(id, {}).get('runtimeStatus', 'Unknown')
+                    custom_status = statuses.get(id, {}).get('customStatus', '')
                     rows.append([filename, status, custom_status])
                 df = pd.DataFrame(rows, columns=['Filename', 'Status', 'Output'])
                 processing_placeholder.dataframe(df, hide_index=True, use_container_width=True)
-                time.sleep(2)
 
 
+    cache_dir = get_cache_dir(result_container)
+
     if st.button('Retrieve Processed Results'):
-        blob_service_client = BlobServiceClient.from_connection_string(os.getenv('STORAGE_CONN_STR'))
-        result_container = os.getenv('DOCUMENT_CONTAINER') + '-processed-results'
-        result_container_client = blob_service_client.get_container_client(result_container)
-        results = []
-        for blob in result_container_client.list_blobs():
-            blob_client = result_container_client.get_blob_client(blob.name)
-            result_data = {'Filename': blob.name}
-            data = json.loads(blob_client.download_blob().readall())
-            data = {**result_data, **data}
-            results.append(data)
-        
-        # Lists to hold flattened data  
-        revision_rows = []  
-        bom_rows = []  
-        rows = []
-        
-        # Process each object in the list  
-        for data in results:  
-            print(data)
-            copy = dict(data).copy()
-           
-            rows.append(copy)
-       
-        print(rows)
-        new_df = pd.DataFrame(rows)
-        st.session_state.results_df = new_df
+        result_container_client = get_blob_service_client().get_container_client(result_container)
+
+        # Only results that are new or changed since the last retrieval are downloaded, in parallel
+        with st.spinner('Retrieving processed results...'):
+            names, stats = sync_processed_results(result_container_client, cache_dir, max_workers=int(os.getenv('RESULTS_DOWNLOAD_WORKERS', 16)))
+        st.session_state.results_names = names
+        st.session_state.results_stats = stats
+        st.session_state.pop('results_export', None)
+        list_processed_results.clear()
+
+    if 'results_names' in st.session_state:
+        names = st.session_state.results_names
+        stats = st.session_state.results_stats
         st.markdown("---")
+        st.caption(f"{len(names)} results ({stats['downloaded']} downloaded, {stats['cached']} from cache, {stats['removed']} removed)")
+
+        page_size = 100
+        page_count = max(1, -(-len(names) // page_size))
+        page = st.number_input('Page', key='results_page', min_value=1, max_value=page_count, value=1, step=1)
+        st.session_state.results_df = load_results_page(cache_dir, names, page, page_size)
         st.dataframe(st.session_state.results_df, hide_index=True, use_container_width=True)
-            
\ No newline at end of file
+
+        export_format = st.selectbox('Export Format', ['csv', 'parquet'], key='results_export_format')
+        if st.button('Prepare Export'):
+            with st.spinner('Preparing export...'):
+                st.session_state.results_export = (export_format, export_results(cache_dir, names, export_format))
+        if 'results_export' in st.session_state:
+            export_format, data = st.session_state.results_export
+            st.download_button(f'Download {export_format.upper()}', data, file_name=f'{result_container}.{export_format}',
+                               mime='text/csv' if export_format == 'csv' else 'application/octet-stream')